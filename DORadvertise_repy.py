@@ -109,6 +109,57 @@ def DORadvertise_announce(key, value, ttlval, timeout=None):
 
 
 
+def DORadvertise_announce_many(entrylist, timeout=None):
+  """
+  <Purpose>
+    Announce many (key, value) pairs to the Digital Object Registry from a
+    single event.
+
+  <Arguments>
+    entrylist:
+            A list of (key, value, ttlval) tuples, each as for
+            DORadvertise_announce.
+
+    timeout:
+            The number of seconds to spend on each announcement before 
+            failing early.
+
+  <Exceptions>
+    None.
+
+  <Side Effects>
+    The key <-> value associations get stored in openDHT for a while.
+
+  <Returns>
+    A list with an entry for each in entrylist, None if it was stored, or
+    the exception that stopped it (as DORadvertise_announce would have 
+    raised).   If the registry can't be reached, the entries after the one
+    that found out are not tried and get the same exception.
+  """
+
+  # The registry only takes one key per request, and httpretrieve doesn't
+  # keep connections open, so this just saves the caller an event per key.
+  resultlist = []
+  for key, value, ttlval in entrylist:
+    try:
+      DORadvertise_announce(key, value, ttlval, timeout=timeout)
+    except (DORadvertise_BadRequest, DORadvertise_XMLError, \
+        xmlparse_XMLParseError), e:
+      # The registry answered, it just didn't like this one
+      resultlist.append(e)
+    except Exception, e:
+      while len(resultlist) < len(entrylist):
+        resultlist.append(e)
+      break
+    else:
+      resultlist.append(None)
+
+  return resultlist
+
+
+
+
+
 def DORadvertise_lookup(key, maxvals=100, timeout=None):
   """
   <Purpose>
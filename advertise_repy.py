@@ -53,6 +53,26 @@ class AdvertiseError(Exception):
   pass
 
 
+# Lookups are cached for a fraction of the ttl the values were announced 
+# with.   That is only known for keys announced by this program, for others
+# we assume they were announced with advertise_default_announce_ttl.   Past
+# that fraction, cached results are still returned (while they are refreshed
+# in the background) until the whole ttl is up.
+advertise_lookup_fresh_fraction = 0.25
+advertise_default_announce_ttl = 240
+advertise_lookup_cache_size = 1000
+
+# (key, maxvals, lookuptypes) -> (results, fresh until, stale until), times
+# are from getruntime()
+_advertise_lookup_cache = {}
+# (key, maxvals, lookuptypes) -> {'donelock':lock held until the lookup is 
+# done, 'results':values found, 'error':exception raised or None}
+_advertise_lookup_inflight = {}
+# key -> the ttl it was last announced with by this program
+_advertise_announce_ttls = {}
+_advertise_lookup_cache_lock = getlock()
+
+
 
 
 def _try_advertise_announce(args):
@@ -196,6 +216,8 @@ def advertise_announce(key, value, ttlval, concurrentevents=2, \
   key = str(key)
   value = str(value)
 
+  _advertise_note_announce(key, ttlval)
+
   # Wrapped in an array so we can modify the reference (python strings are immutable).
   exceptions = [''] # track exceptions that occur and raise them at the end
 
@@ -225,12 +247,7 @@ def advertise_announce(key, value, ttlval, concurrentevents=2, \
   # Once we have either timed out or exceeded graceperiod with at least one 
   # service reporting, return whatever data we have. Remaining threads will 
   # be forsaken and allowed to terminate at their leisure.
-  while not parallelize_isfunctionfinished(ph):
-    sleep(0.015)
-    if getruntime() - start_time > timeout or \
-        (getruntime() - start_time > graceperiod and onefinished[0]):
-      parallelize_abortfunction(ph)
-      break
+  _advertise_wait(ph, start_time, timeout, graceperiod, onefinished)
 
   # This does not terminate all parallel threads; do not assume it does.
   parallelize_closefunction(ph)
@@ -248,6 +265,56 @@ def advertise_announce(key, value, ttlval, concurrentevents=2, \
 
 
 
+def _advertise_wait(ph, start_time, timeout, graceperiod, onefinished):
+  """
+  <Purpose>
+    Waits for the parallel announces or lookups in ph until they have all 
+    finished, timeout seconds have passed since start_time, or graceperiod
+    seconds have passed and at least one succeeded. Anything still running
+    after that is aborted. We are woken as each service finishes rather than 
+    polling, so this returns as soon as one of those happens.
+
+  <Arguments>
+    ph
+      The parallelize handle.
+    start_time
+      The getruntime() the operation started at.
+    timeout, graceperiod
+      As for advertise_announce.
+    onefinished
+      The array reference the workers set to [True] once one succeeds.
+
+  <Exceptions>
+    None.
+
+  <Side Effects>
+    May abort ph.
+
+  <Returns>
+    None.
+  """
+  seen = 0
+  while True:
+    elapsed = getruntime() - start_time
+    if onefinished[0]:
+      remaining = min(timeout, graceperiod) - elapsed
+    else:
+      remaining = timeout - elapsed
+
+    if remaining <= 0:
+      break
+
+    newresults = parallelize_getnewresults(ph, seen, remaining)
+    if not newresults and parallelize_isfunctionfinished(ph):
+      return
+    seen = seen + len(newresults)
+
+  if not parallelize_isfunctionfinished(ph):
+    parallelize_abortfunction(ph)
+
+
+
+
 def _try_advertise_lookup(args):
   """
   <Purpose>
@@ -295,8 +362,191 @@ def _try_advertise_lookup(args):
 
 
 
+def _try_advertise_announce_many(args):
+  """
+  <Purpose>
+    Like _try_advertise_announce, but announces a whole list of entries to 
+    one service.
+
+  <Arguments>
+    args (tuple)
+      A tuple containing the following:
+        which_service (string)
+          The service we should use to advertise, such as "central" or "DOR".
+        entrylist (list)
+          The (key, value, ttlval) tuples to announce.
+        serviceresults (list)
+          (which_service, results) is appended to this once the service 
+          has answered, results having None for each entry stored and the 
+          exception for each that wasn't.
+        finishedref (List with boolean in zero index)
+          Set to True once any entry has been stored.
+
+  <Exceptions>
+    AdvertiseError
+      If an invalid service type is specified, this exception will be raised.
+    ValueError
+      Too many, or too few values passed in the args tuple.
+
+  <Side Effects>
+    As for _try_advertise_announce, but the sockets are shared by the whole
+    list where the service allows it.
+
+  <Returns>
+    None
+  """
+  # ValueError if there are too many or too few values.
+  which_service, entrylist, serviceresults, finishedref = args
+
+  if which_service not in _advertise_all_services:
+    raise AdvertiseError("Incorrect service type used in internal function _try_advertise_announce_many.")
+
+  try:
+    if which_service == "central":
+      results = centralizedadvertise_announce_many(entrylist)
+    elif which_service == "central_v2":
+      results = v2centralizedadvertise_announce_many(entrylist)
+    elif which_service == "DOR":
+      results = DORadvertise_announce_many(entrylist)
+    elif which_service == "UDP":
+      results = udpcentralizedadvertise_announce_many(entrylist)
+    else:
+      raise AdvertiseError("Did not understand service type.")
+  except Exception, e:
+    results = [e] * len(entrylist)
+
+  serviceresults.append((which_service, results))
+
+  if None in results:
+    finishedref[0] = True
+    nodemanager_announce_context_lock.acquire()
+    try:
+      nodemanager_announce_context["previous" + which_service + "skip"] = 1
+    finally:
+      nodemanager_announce_context_lock.release()
+
+  else:
+    # Nothing got through, so back off this service as an announce would
+    nodemanager_announce_context_lock.acquire()
+    try:
+      nodemanager_announce_context["skip" + which_service] = \
+          nodemanager_announce_context["previous" + which_service + "skip"] + 1
+      nodemanager_announce_context["previous" + which_service + "skip"] = \
+          min(nodemanager_announce_context["previous" + which_service + "skip"] * 2, 16)
+    finally:
+      nodemanager_announce_context_lock.release()
+
+
+
+
+
+def advertise_announce_many(entrylist, concurrentevents=2, graceperiod=10, \
+    timeout=60):
+  """
+  <Purpose>
+    Announce (PUT) many key : value pairs to all default advertise services.
+    Each service gets one worker event for the whole list, which sends the
+    entries over a shared connection (or from a shared port) where the 
+    service allows it.
+
+  <Arguments>
+    entrylist (list)
+      The (key, value, ttlval) tuples to announce, each as for 
+      advertise_announce.
+
+    concurrentevents (int) (optional)
+      How many services to announce on in parallel.
+
+    graceperiod (float) (optional)
+      As for advertise_announce.   The grace period starts once some service 
+      has stored at least one entry.
+
+    timeout (int) (optional)
+      As for advertise_announce.
+
+  <Exceptions>
+    AdvertiseError if none of the services stored anything.
+
+  <Side Effects>
+    Spawns as many worker events as concurrentevents specifies, limited by the
+    number of services available.
+
+  <Returns>
+    A list of booleans, one for each entry in entrylist, True if at least 
+    one service stored it.
+  """
+  # convert different types to strings to avoid type conversion errors #874
+  announcelist = []
+  for key, value, ttlval in entrylist:
+    key = str(key)
+    value = str(value)
+    _advertise_note_announce(key, ttlval)
+    announcelist.append((key, value, ttlval))
+
+  if not announcelist:
+    return []
+
+  serviceresults = []
+  parallize_worksets = []
+  start_time = getruntime()
+
+  onefinished = [False]
+
+  # Populate parallel jobs list, skipping services which are backing off.
+  for service_type in _advertise_all_services:
+    if nodemanager_announce_context["skip" + service_type] == 0:
+      parallize_worksets.append((service_type, announcelist, serviceresults, \
+          onefinished))
+    else:
+      nodemanager_announce_context_lock.acquire()
+      try:
+        nodemanager_announce_context["skip" + service_type] = \
+            nodemanager_announce_context["skip" + service_type] - 1
+      finally:
+        nodemanager_announce_context_lock.release()
+
+  ph = parallelize_initfunction(parallize_worksets, _try_advertise_announce_many, \
+      concurrentevents=concurrentevents)
+
+  _advertise_wait(ph, start_time, timeout, graceperiod, onefinished)
+
+  # This does not terminate all parallel threads; do not assume it does.
+  parallelize_closefunction(ph)
+
+  if onefinished == [False]:
+    raise AdvertiseError("None of the advertise services could be contacted")
+
+  stored = [False] * len(announcelist)
+  # services still running may add to this, so only look at what is here now
+  for which_service, results in serviceresults[:]:
+    for index in range(len(stored)):
+      if results[index] is None:
+        stored[index] = True
+
+  return stored
+
+
+
+
+
+def _advertise_note_announce(key, ttlval):
+  # Cached lookups of this key are out of date now, and later lookups can be
+  # cached for as long as this announcement lasts.
+  _advertise_lookup_cache_lock.acquire(True)
+  try:
+    _advertise_announce_ttls[key] = ttlval
+    for cachekey in _advertise_lookup_cache.keys():
+      if cachekey[0] == key:
+        del _advertise_lookup_cache[cachekey]
+  finally:
+    _advertise_lookup_cache_lock.release()
+
+
+
+
+
 def advertise_lookup(key, maxvals=100, lookuptype=None, \
-    concurrentevents=2, graceperiod=10, timeout=60):
+    concurrentevents=2, graceperiod=10, timeout=60, usecache=True):
   """
   <Purpose>
     Lookup (GET) (a) value(s) stored at the given key in the central advertise
@@ -322,12 +572,19 @@ def advertise_lookup(key, maxvals=100, lookuptype=None, \
     timeout (optional, defaults to 60):
       After this many seconds (can be a float or int type), give up.
 
+    usecache (optional, defaults to True):
+      Whether results of recent identical lookups may be returned. Results
+      are fresh for advertise_lookup_fresh_fraction of the key's announce
+      ttl. After that, until the announce ttl is up, the cached results are
+      returned and refreshed in the background. Lookups of the same thing
+      that are made at the same time share one query.
+
   <Exceptions>
     AdvertiseError if something goes wrong.
 
   <Side Effects>
     Spawns as many worker events as concurrentevents specifies, limited by the
-    number of services in lookuptype.
+    number of services in lookuptype. A background refresh uses one more.
 
   <Returns>
     All unique values stored at the key.
@@ -339,6 +596,76 @@ def advertise_lookup(key, maxvals=100, lookuptype=None, \
   if lookuptype is None:
     lookuptype = ['central','DOR', 'central_v2', 'UDP']
 
+  lookupargs = (key, maxvals, lookuptype, concurrentevents, graceperiod, timeout)
+
+  if not usecache:
+    return _advertise_lookup_uncached(*lookupargs)[0]
+
+  cachekey = (key, maxvals, tuple(lookuptype))
+
+  _advertise_lookup_cache_lock.acquire(True)
+  try:
+    now = getruntime()
+    if cachekey in _advertise_lookup_cache:
+      results, freshuntil, staleuntil = _advertise_lookup_cache[cachekey]
+      if now < freshuntil:
+        return results[:]
+      if now < staleuntil:
+        # Stale but probably still right.   Hand it back and get a new copy
+        # for next time, unless someone already is.
+        if cachekey not in _advertise_lookup_inflight:
+          flight = _advertise_start_flight(cachekey)
+          try:
+            settimer(0, _advertise_refresh, (cachekey, flight, lookupargs))
+          except Exception:
+            # No events to spare, the next lookup will have to wait for it
+            _advertise_end_flight(cachekey, flight)
+        return results[:]
+      del _advertise_lookup_cache[cachekey]
+
+    # Only one lookup of the same thing goes out at a time, the others wait 
+    # for its results.
+    if cachekey in _advertise_lookup_inflight:
+      flight = _advertise_lookup_inflight[cachekey]
+      leader = False
+    else:
+      flight = _advertise_start_flight(cachekey)
+      leader = True
+  finally:
+    _advertise_lookup_cache_lock.release()
+
+  if leader:
+    _advertise_run_flight(cachekey, flight, lookupargs)
+  else:
+    flight['donelock'].acquire(True)
+    flight['donelock'].release()
+
+  if flight['error'] is not None:
+    raise flight['error']
+  return flight['results'][:]
+
+
+
+
+def _advertise_lookup_uncached(key, maxvals, lookuptype, concurrentevents, \
+    graceperiod, timeout):
+  """
+  <Purpose>
+    Does the work of advertise_lookup, without the cache.
+
+  <Arguments>
+    As for advertise_lookup.
+
+  <Exceptions>
+    AdvertiseError if something goes wrong.
+
+  <Side Effects>
+    As for advertise_lookup.
+
+  <Returns>
+    A tuple of (all unique values stored at the key, whether any service 
+    answered).
+  """
   parallel_worksets = []
   start_time = getruntime()
 
@@ -363,12 +690,7 @@ def advertise_lookup(key, maxvals=100, lookuptype=None, \
 
   # Wait until either timeout or graceperiod with at least one service 
   # success, and then continue.
-  while not parallelize_isfunctionfinished(ph):
-    sleep(0.015)
-    if getruntime() - start_time > timeout or \
-        (getruntime() - start_time > graceperiod and onefinished[0]):
-      parallelize_abortfunction(ph)
-      break
+  _advertise_wait(ph, start_time, timeout, graceperiod, onefinished)
 
   parallel_results = parallelize_getresults(ph)['returned']
   results = []
@@ -381,6 +703,91 @@ def advertise_lookup(key, maxvals=100, lookuptype=None, \
   parallelize_closefunction(ph)
 
   # Filter results and return.
-  return listops_uniq(results)
+  return (listops_uniq(results), onefinished[0])
+
+
+
+
+def _advertise_start_flight(cachekey):
+  # Records that a lookup for cachekey is under way.   The caller must hold
+  # _advertise_lookup_cache_lock.
+  flight = {'donelock':getlock(), 'results':None, 'error':None}
+  flight['donelock'].acquire(True)
+  _advertise_lookup_inflight[cachekey] = flight
+  return flight
+
+
+
+
+def _advertise_end_flight(cachekey, flight):
+  # Wakes up everyone waiting on the flight.   The caller must hold
+  # _advertise_lookup_cache_lock.
+  if _advertise_lookup_inflight.get(cachekey) is flight:
+    del _advertise_lookup_inflight[cachekey]
+  flight['donelock'].release()
+
+
+
+
+def _advertise_run_flight(cachekey, flight, lookupargs):
+  # Does the lookup for everyone waiting on flight, caching the results if
+  # any service answered.
+  try:
+    results, answered = _advertise_lookup_uncached(*lookupargs)
+  except Exception, e:
+    results = []
+    answered = False
+    flight['error'] = e
+
+  flight['results'] = results
+
+  _advertise_lookup_cache_lock.acquire(True)
+  try:
+    try:
+      if answered:
+        now = getruntime()
+        announcettl = _advertise_announce_ttls.get(cachekey[0], advertise_default_announce_ttl)
+        _advertise_lookup_cache[cachekey] = (results, \
+            now + announcettl * advertise_lookup_fresh_fraction, now + announcettl)
+        _advertise_trim_lookup_cache(now)
+    finally:
+      # Whatever happened to the cache, no one may be left waiting
+      _advertise_end_flight(cachekey, flight)
+  finally:
+    _advertise_lookup_cache_lock.release()
+
+
+
+
+def _advertise_refresh(cachekey, flight, lookupargs):
+  # Runs in its own event to refresh a stale cache entry.
+  try:
+    _advertise_run_flight(cachekey, flight, lookupargs)
+  except Exception:
+    pass
+
+
+
+
+def _advertise_trim_lookup_cache(now):
+  # Keeps the cache within advertise_lookup_cache_size, dropping expired 
+  # entries first and then the ones that will expire soonest.   The caller 
+  # must hold _advertise_lookup_cache_lock.
+  if len(_advertise_lookup_cache) <= advertise_lookup_cache_size:
+    return
+
+  for cachekey in _advertise_lookup_cache.keys():
+    if _advertise_lookup_cache[cachekey][2] <= now:
+      del _advertise_lookup_cache[cachekey]
+
+  if len(_advertise_lookup_cache) <= advertise_lookup_cache_size:
+    return
+
+  bystaletime = []
+  for cachekey in _advertise_lookup_cache:
+    bystaletime.append((_advertise_lookup_cache[cachekey][2], cachekey))
+  bystaletime.sort()
+  for staleuntil, cachekey in bystaletime[:len(bystaletime) - advertise_lookup_cache_size]:
+    del _advertise_lookup_cache[cachekey]
 
 ### Automatically generated by repyhelper.py ### /home/stredger/Documents/vpts/viewpoints/advertise.repy
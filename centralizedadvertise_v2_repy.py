@@ -98,6 +98,102 @@ def v2centralizedadvertise_announce(key, value, ttlval):
     # This isn't a big problem, but it is the "wrong" exception
     sockobj.close()
   
+  _v2centralizedadvertise_check_announce_response(rawresponse)
+
+
+
+
+def v2centralizedadvertise_announce_many(entrylist):
+  """
+   <Purpose>
+     Announce many key / value pairs into the CHT, reusing one connection
+     for as long as the server keeps it open.
+
+   <Arguments>
+     entrylist: a list of (key, value, ttlval) tuples, each as for
+                v2centralizedadvertise_announce.
+
+   <Exceptions>
+     TypeError if a ttlval is of the wrong type.
+
+     ValueError if a ttlval is not positive 
+
+   <Side Effects>
+     The CHT will store the key / value pairs.
+
+   <Returns>
+     A list with an entry for each in entrylist, None if it was stored, or
+     the exception that stopped it (as v2centralizedadvertise_announce would 
+     have raised).
+  """
+  # check everything before sending anything
+  requestlist = []
+  for key, value, ttlval in entrylist:
+    key = str(key)
+    value = str(value)
+
+    if not type(ttlval) is int and not type(ttlval) is long:
+      raise TypeError("Invalid type '"+str(type(ttlval))+"' for ttlval.")
+
+    if ttlval < 1:
+      raise ValueError("The argument ttlval must be positive, not '"+str(ttlval)+"'")
+
+    requestlist.append(serialize_serializedata(('PUT',key,value,ttlval)))
+
+  resultlist = []
+  sockobj = None
+  # whether the server seems to keep connections open between requests
+  reuseconnection = True
+  # whether sockobj has already carried a request
+  sockobjused = False
+
+  try:
+    while len(resultlist) < len(requestlist):
+      if sockobj is None:
+        try:
+          sockobj = timeout_openconn(v2servername,v2serverport, timeout=10)
+        except Exception, e:
+          # Nothing else is going to get through either
+          while len(resultlist) < len(requestlist):
+            resultlist.append(e)
+          break
+        sockobjused = False
+
+      try:
+        session_sendmessage(sockobj, requestlist[len(resultlist)])
+        rawresponse = session_recvmessage(sockobj)
+      except Exception, e:
+        _v2centralizedadvertise_close(sockobj)
+        sockobj = None
+        if sockobjused and reuseconnection:
+          # The server only takes one request per connection, so try again
+          # on a new one and stop reusing them.
+          reuseconnection = False
+          continue
+        resultlist.append(e)
+        continue
+
+      sockobjused = True
+      try:
+        _v2centralizedadvertise_check_announce_response(rawresponse)
+        resultlist.append(None)
+      except CentralAdvertiseError, e:
+        resultlist.append(e)
+
+      if not reuseconnection:
+        _v2centralizedadvertise_close(sockobj)
+        sockobj = None
+
+  finally:
+    if sockobj is not None:
+      _v2centralizedadvertise_close(sockobj)
+
+  return resultlist
+
+
+
+
+def _v2centralizedadvertise_check_announce_response(rawresponse):
   # We should check that the response is 'OK'
   try:
     response = serialize_deserializedata(rawresponse)
@@ -105,7 +201,18 @@ def v2centralizedadvertise_announce(key, value, ttlval):
       raise CentralAdvertiseError("Centralized announce failed with '"+response+"'")
   except ValueError, e:
     raise CentralAdvertiseError("Received unknown response from server '"+rawresponse+"'")
-      
+
+
+
+
+def _v2centralizedadvertise_close(sockobj):
+  # BUG: This raises an error right now if the call times out ( #260 )
+  # We are done with the socket either way.
+  try:
+    sockobj.close()
+  except Exception:
+    pass
+
 
 
 
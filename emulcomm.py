@@ -57,6 +57,9 @@ import time
 # Armon: Used for decoding the error messages
 import errno
 
+# for the pipe used to wake the SocketSelector
+import os
+
 # Armon: Used for getting the constant IP values for resolving our external IP
 import repy_constants 
 
@@ -65,6 +68,11 @@ import repy_constants
 # oriented socket has a connection pending, or a message-based socket has a
 # message pending, and there are enough events it calls the appropriate
 # function.
+#
+# Where the platform has epoll or poll, listening sockets are registered 
+# with a poller when they are created and unregistered when they are cleaned
+# up instead, so the thread wakes as soon as one is ready rather than 
+# rebuilding its list of sockets each time around.
 
 
 
@@ -76,6 +84,23 @@ import repy_constants
 
 comminfo = {}
 
+# Indexes on comminfo, so finding an entry by address or socket doesn't mean
+# scanning the table.   Each maps a key to the list of commhandles with it,
+# oldest first.   Entries are only added, removed or readdressed through
+# add_comminfo_entry, remove_comminfo_entry and set_comminfo_remote, which
+# keep the table and the indexes in step under comminfolock.
+
+# (type, localip, localport)
+comminfo_tip_index = {}
+# (type, localip, localport, outgoing)
+comminfo_tipo_index = {}
+# (localip, localport, remotehost, remoteport) of outgoing TCP sockets
+comminfo_connection_index = {}
+# id() of the socket object
+comminfo_socket_index = {}
+
+comminfolock = threading.Lock()
+
 # If we have a preference for an IP/Interface this flag is set to True
 user_ip_interface_preferences = False
 
@@ -422,13 +447,156 @@ selectorlock = threading.Lock()
 selectorstarted = False
 
 
+# which poller the platform has.   This is worked out now since hasattr isn't
+# available once user code is running (see #1039)
+if hasattr(select, 'epoll'):
+  SELECTOR_POLLER_TYPE = 'epoll'
+elif hasattr(select, 'poll'):
+  SELECTOR_POLLER_TYPE = 'poll'
+else:
+  SELECTOR_POLLER_TYPE = None
+
+# the poller listening sockets are registered with.   None until the first
+# one is registered, or if the platform has neither epoll nor poll (in which
+# case the SocketSelector uses select)
+selectorpoller = None
+
+# what to multiply a timeout in seconds by for the poller
+selectortimescale = 1
+
+# fd -> (commhandle, serial) for registered sockets.   serial says when it 
+# was registered, so a ready fd that was closed and reused by a socket 
+# registered while the selector was waiting isn't mistaken for the new one
+selectorfds = {}
+
+# commhandle -> fd for registered sockets
+selectorhandles = {}
+selectorserial = 0
+
+# (read end, write end) of a pipe the poller also watches.   A byte is 
+# written to it when the registered sockets change, so the selector notices
+# new sockets and checks whether it should exit
+selectorwakeup = None
+selectorwakeuppending = False
+
+# protects the poller and the tables above
+selectorpollerlock = threading.Lock()
+
+# the events listening sockets are registered for.   They are ready when
+# they can be read, and errors are handled by trying to read them
+selectorpollevents = None
+
+# the longest the selector waits on the poller before checking if it should
+# exit anyway
+SELECTOR_POLL_TIMEOUT = 1.0
+
+
+
 #### helper functions
 
+# Private.   Returns the poller, creating it the first time.   Must hold 
+# selectorpollerlock
+def get_selector_poller():
+  global selectorpoller, selectortimescale, selectorpollevents, selectorwakeup
+
+  if selectorpoller is None:
+    if SELECTOR_POLLER_TYPE == 'epoll':
+      selectorpoller = select.epoll()
+      selectortimescale = 1
+      selectorpollevents = select.EPOLLIN | select.EPOLLPRI | select.EPOLLERR | select.EPOLLHUP
+    elif SELECTOR_POLLER_TYPE == 'poll':
+      selectorpoller = select.poll()
+      selectortimescale = 1000
+      selectorpollevents = select.POLLIN | select.POLLPRI | select.POLLERR | select.POLLHUP
+    else:
+      return None
+
+    selectorwakeup = os.pipe()
+    selectorpoller.register(selectorwakeup[0], select.POLLIN)
+
+  return selectorpoller
+
+
+
+# Private.   Gets the selector to look at its sockets again.   Must hold
+# selectorpollerlock
+def wake_selector():
+  global selectorwakeuppending
+
+  # one byte is enough, the selector reads it once it is awake
+  if not selectorwakeuppending:
+    selectorwakeuppending = True
+    os.write(selectorwakeup[1], 'x')
+
+
+
+# Private.   Called by the SocketSelector once it sees the wakeup byte
+def clear_selector_wakeup():
+  global selectorwakeuppending
+
+  selectorpollerlock.acquire()
+  try:
+    os.read(selectorwakeup[0], 1)
+    selectorwakeuppending = False
+  finally:
+    selectorpollerlock.release()
+
+
+
+# Private.   Starts watching the listening socket of this comminfo entry.
+# Without a poller this does nothing, the select loop finds its sockets in
+# comminfo.
+def register_listening_socket(handle):
+  global selectorserial
+
+  selectorpollerlock.acquire()
+  try:
+    poller = get_selector_poller()
+    if poller is None:
+      return
+
+    fd = comminfo[handle]['socket'].fileno()
+    selectorserial = selectorserial + 1
+    poller.register(fd, selectorpollevents)
+    selectorfds[fd] = (handle, selectorserial)
+    selectorhandles[handle] = fd
+    wake_selector()
+  finally:
+    selectorpollerlock.release()
+
+
+
+# Private.   Stops watching the socket of this comminfo entry, if it was.
+# This must happen before the socket is closed, so its fd is never reused
+# while still registered.
+def unregister_listening_socket(handle):
+  selectorpollerlock.acquire()
+  try:
+    if handle not in selectorhandles:
+      return
+
+    fd = selectorhandles.pop(handle)
+    del selectorfds[fd]
+    try:
+      selectorpoller.unregister(fd)
+    except (KeyError, IOError, OSError, ValueError):
+      # it's already gone
+      pass
+    wake_selector()
+  finally:
+    selectorpollerlock.release()
+
+
+
 # return the table entry for this socketobject
 def find_socket_entry(socketobject):
-  for commhandle in comminfo.keys():
-    if comminfo[commhandle]['socket'] is socketobject:
-      return comminfo[commhandle], commhandle
+  comminfolock.acquire()
+  try:
+    for commhandle in comminfo_socket_index.get(id(socketobject), []):
+      if comminfo[commhandle]['socket'] is socketobject:
+        return comminfo[commhandle], commhandle
+  finally:
+    comminfolock.release()
   raise KeyError, "Can't find commhandle"
 
 
@@ -529,7 +697,7 @@ def start_event(entry, handle,eventhandle):
     
     # put this handle in the table
     newhandle = generate_commhandle()
-    comminfo[newhandle] = {'type':'TCP','remotehost':addr[0], 'remoteport':addr[1],'localip':entry['localip'],'localport':entry['localport'],'socket':realsocket,'outgoing':True, 'closing_lock':threading.Lock()}
+    add_comminfo_entry(newhandle, {'type':'TCP','remotehost':addr[0], 'remoteport':addr[1],'localip':entry['localip'],'localport':entry['localport'],'socket':realsocket,'outgoing':True, 'closing_lock':threading.Lock()})
     # I don't think it makes sense to count this as an outgoing socket, does 
     # it?
 
@@ -620,6 +788,93 @@ class SocketSelector(threading.Thread):
 
 
   def run(self):
+    selectorpollerlock.acquire()
+    try:
+      poller = get_selector_poller()
+    finally:
+      selectorpollerlock.release()
+
+    if poller is None:
+      self.run_select()
+    else:
+      self.run_poller(poller)
+
+
+
+  # Waits on the poller, which the listening sockets are registered with
+  def run_poller(self, poller):
+    while True:
+
+      # I'll stop myself only when there are no active threads to monitor
+      if should_selector_exit():
+        return
+
+      # anything registered after this may be using the fd of a socket 
+      # that was closed while we waited
+      startserial = selectorserial
+
+      try:
+        readylist = poller.poll(SELECTOR_POLL_TIMEOUT * selectortimescale)
+      except (IOError, OSError, select.error), e:
+        if e.args[0] == errno.EINTR:
+          continue
+        raise
+
+      for fd, events in readylist:
+        if fd == selectorwakeup[0]:
+          clear_selector_wakeup()
+          continue
+
+        # select.poll reports fds that were closed while registered until 
+        # they are unregistered.   That shouldn't happen, but don't spin on it
+        if events & select.POLLNVAL:
+          selectorpollerlock.acquire()
+          try:
+            if fd not in selectorfds:
+              try:
+                poller.unregister(fd)
+              except (KeyError, IOError, OSError, ValueError):
+                pass
+          finally:
+            selectorpollerlock.release()
+          continue
+
+        registration = selectorfds.get(fd)
+        if registration is None or registration[1] > startserial:
+          # it was unregistered (and possibly reused) in the interim
+          continue
+
+        commhandle = registration[0]
+        try:
+          commtableentry = comminfo[commhandle]
+        except KeyError:
+          # let's skip this one, it's likely it was closed in the interim
+          continue
+
+        self.handle_ready_socket(commtableentry, commhandle)
+
+
+
+  # Start an event for a ready listening socket
+  def handle_ready_socket(self, commtableentry, commhandle):
+    # now it's time to get the event...   I'll loop until there is a free
+    # event
+    eventhandle = idhelper.getuniqueid()
+    wait_for_event(eventhandle)
+
+    # wait if already oversubscribed
+    if is_loopback(commtableentry['localip']):
+      nanny.tattle_quantity('looprecv',0)
+    else:
+      nanny.tattle_quantity('netrecv',0)
+
+    # Now I can start a thread to run the user's code...
+    start_event(commtableentry,commhandle,eventhandle)
+
+
+
+  # Used when there is no poller
+  def run_select(self):
     # Keep track of the last sample time
     # updated when there are no ready sockets
     last_sample = 0
@@ -654,19 +909,7 @@ class SocketSelector(threading.Thread):
           # let's skip this one, it's likely it was closed in the interim
           continue
 
-        # now it's time to get the event...   I'll loop until there is a free
-        # event
-        eventhandle = idhelper.getuniqueid()
-        wait_for_event(eventhandle)
-
-        # wait if already oversubscribed
-        if is_loopback(commtableentry['localip']):
-          nanny.tattle_quantity('looprecv',0)
-        else:
-          nanny.tattle_quantity('netrecv',0)
-
-        # Now I can start a thread to run the user's code...
-        start_event(commtableentry,commhandle,eventhandle)
+        self.handle_ready_socket(commtableentry, commhandle)
       
 
 
@@ -739,32 +982,114 @@ def check_selector():
 
 # return the table entry for this type of socket, ip, port 
 def find_tip_entry(socktype, ip, port):
-  for commhandle in comminfo.keys():
-    if comminfo[commhandle]['type'] == socktype and comminfo[commhandle]['localip'] == ip and comminfo[commhandle]['localport'] == port:
-      return comminfo[commhandle], commhandle
+  comminfolock.acquire()
+  try:
+    commhandles = comminfo_tip_index.get((socktype, ip, port))
+    if commhandles:
+      return comminfo[commhandles[0]], commhandles[0]
+  finally:
+    comminfolock.release()
   return (None,None)
 
 
 
 # Find a commhandle, given TIPO: type, ip, port, outgoing
 def find_tipo_commhandle(socktype, ip, port, outgoing):
-  for commhandle in comminfo.keys():
-    if comminfo[commhandle]['type'] == socktype and comminfo[commhandle]['localip'] == ip and comminfo[commhandle]['localport'] == port and comminfo[commhandle]['outgoing'] == outgoing:
-      return commhandle
+  comminfolock.acquire()
+  try:
+    commhandles = comminfo_tipo_index.get((socktype, ip, port, outgoing))
+    if commhandles:
+      return commhandles[0]
+  finally:
+    comminfolock.release()
   return None
 
 
 # Find an outgoing TCP commhandle, given local ip, local port, remote ip, remote port, 
 def find_outgoing_tcp_commhandle(localip, localport, remoteip, remoteport):
-  for commhandle in comminfo.keys():
-    if comminfo[commhandle]['type'] == "TCP" and comminfo[commhandle]['localip'] == localip \
-    and comminfo[commhandle]['localport'] == localport and comminfo[commhandle]['remotehost'] == remoteip \
-    and comminfo[commhandle]['remoteport'] == remoteport and comminfo[commhandle]['outgoing'] == True:
-      return commhandle
+  comminfolock.acquire()
+  try:
+    commhandles = comminfo_connection_index.get((localip, localport, remoteip, remoteport))
+    if commhandles:
+      return commhandles[0]
+  finally:
+    comminfolock.release()
   return None
 
 
 
+# Private.   The (index, key) pairs a comminfo entry is filed under
+def get_comminfo_index_keys(entry):
+  indexkeys = [(comminfo_tip_index, (entry['type'], entry['localip'], entry['localport'])),
+      (comminfo_tipo_index, (entry['type'], entry['localip'], entry['localport'], entry['outgoing'])),
+      (comminfo_socket_index, id(entry['socket']))]
+  if entry['type'] == 'TCP' and entry['outgoing']:
+    indexkeys.append((comminfo_connection_index, (entry['localip'], entry['localport'], entry['remotehost'], entry['remoteport'])))
+  return indexkeys
+
+
+
+# Private.   Files a commhandle under its entry's keys.   Must hold 
+# comminfolock
+def index_comminfo_entry(handle, entry):
+  for index, key in get_comminfo_index_keys(entry):
+    if key in index:
+      index[key].append(handle)
+    else:
+      index[key] = [handle]
+
+
+
+# Private.   Undoes index_comminfo_entry.   Must hold comminfolock
+def unindex_comminfo_entry(handle, entry):
+  for index, key in get_comminfo_index_keys(entry):
+    commhandles = index[key]
+    commhandles.remove(handle)
+    if not commhandles:
+      del index[key]
+
+
+
+# Private.   Puts an entry in comminfo.   The same entry may be added under
+# more than one handle.
+def add_comminfo_entry(handle, entry):
+  comminfolock.acquire()
+  try:
+    if handle in comminfo:
+      unindex_comminfo_entry(handle, comminfo[handle])
+    comminfo[handle] = entry
+    index_comminfo_entry(handle, entry)
+  finally:
+    comminfolock.release()
+
+
+
+# Private.   Takes an entry out of comminfo, raising KeyError if it isn't
+# there
+def remove_comminfo_entry(handle):
+  comminfolock.acquire()
+  try:
+    entry = comminfo.pop(handle)
+    unindex_comminfo_entry(handle, entry)
+  finally:
+    comminfolock.release()
+
+
+
+# Private.   Records the remote end of a connection once it is made
+def set_comminfo_remote(handle, remotehost, remoteport):
+  comminfolock.acquire()
+  try:
+    entry = comminfo[handle]
+    unindex_comminfo_entry(handle, entry)
+    entry['remotehost'] = remotehost
+    entry['remoteport'] = remoteport
+    index_comminfo_entry(handle, entry)
+  finally:
+    comminfolock.release()
+
+
+
 
 
 
@@ -982,6 +1307,10 @@ def stopcomm(commhandle):
 # Armon: How frequently should we check for the availability of the socket?
 RETRY_INTERVAL = 0.2 # In seconds
 
+# The longest recv or send wait in wait_for_socket before looking at the
+# socket again.   Closing the socket wakes them sooner.
+SOCKET_WAIT_TIMEOUT = 1.0
+
 # Private
 def cleanup(handle):
   # Armon: lock the cleanup so that only one thread will do the cleanup, but
@@ -998,10 +1327,13 @@ def cleanup(handle):
   # if it's in the table then remove the entry and tattle...
   try:
     if handle in comminfo:
-      # Armon: Shutdown the socket for writing prior to close
-      # to unblock any threads that are writing
+      # The selector must let go of it before the fd can be reused
+      unregister_listening_socket(handle)
+
+      # Armon: Shutdown the socket prior to close to unblock any threads 
+      # that are writing, or waiting to read or write in wait_for_socket
       try:
-        comminfo[handle]['socket'].shutdown(socket.SHUT_WR)
+        comminfo[handle]['socket'].shutdown(socket.SHUT_RDWR)
       except:
         pass
 
@@ -1035,7 +1367,7 @@ def cleanup(handle):
       
       # Delete the entry last, so that other stopcomm operations will block
       try: # Guard against a rare and poorly understood error. #1052
-        del comminfo[handle]
+        remove_comminfo_entry(handle)
       except KeyError:
         pass
 
@@ -1268,7 +1600,7 @@ def recvmess(localip, localport, function):
     comminfo[oldhandle]['function'] = function
 
     # Armon: Create a new comminfo entry with the same info
-    comminfo[handle] = comminfo[oldhandle]
+    add_comminfo_entry(handle, comminfo[oldhandle])
 
     # Remove the old entry
     cleanup(oldhandle)
@@ -1304,7 +1636,13 @@ def recvmess(localip, localport, function):
     raise
 
   # set up our table entry
-  comminfo[handle] = {'type':'UDP','localip':localip, 'localport':localport,'function':function,'socket':s, 'outgoing':False, 'closing_lock':threading.Lock() }
+  add_comminfo_entry(handle, {'type':'UDP','localip':localip, 'localport':localport,'function':function,'socket':s, 'outgoing':False, 'closing_lock':threading.Lock() })
+
+  try:
+    register_listening_socket(handle)
+  except:
+    cleanup(handle)
+    raise
 
   # start the selector if it's not running already
   check_selector()
@@ -1458,7 +1796,7 @@ def openconn(desthost, destport,localip=None, localport=None,timeout=None):
 
   
     # add the socket to the comminfo table
-    comminfo[handle] = {'type':'TCP','remotehost':None, 'remoteport':None,'localip':localip,'localport':localport,'socket':s, 'outgoing':True, 'closing_lock':threading.Lock()}
+    add_comminfo_entry(handle, {'type':'TCP','remotehost':None, 'remoteport':None,'localip':localip,'localport':localport,'socket':s, 'outgoing':True, 'closing_lock':threading.Lock()})
   except:
     # the socket wasn't passed to the user prog...
     nanny.tattle_remove_item('outsockets',handle)
@@ -1503,8 +1841,7 @@ def openconn(desthost, destport,localip=None, localport=None,timeout=None):
       if connect_exception != None:
         raise connect_exception
 
-    comminfo[handle]['remotehost']=desthost
-    comminfo[handle]['remoteport']=destport
+    set_comminfo_remote(handle, desthost, destport)
   
   except:
     cleanup(handle)
@@ -1574,7 +1911,7 @@ def waitforconn(localip, localport,function):
     comminfo[oldhandle]['function'] = function
 
     # Armon: Create an entry for the handle, replicate the information
-    comminfo[handle] = comminfo[oldhandle]
+    add_comminfo_entry(handle, comminfo[oldhandle])
     
     # Remove the entry for the old socket
     cleanup(oldhandle)
@@ -1600,11 +1937,17 @@ def waitforconn(localip, localport,function):
     # NOTE: Should this be anything other than a hardcoded number?
     mainsock.listen(5)
     # set up our table entry
-    comminfo[handle] = {'type':'TCP','remotehost':None, 'remoteport':None,'localip':localip,'localport':localport,'socket':mainsock, 'outgoing':False, 'function':function, 'closing_lock':threading.Lock()}
+    add_comminfo_entry(handle, {'type':'TCP','remotehost':None, 'remoteport':None,'localip':localip,'localport':localport,'socket':mainsock, 'outgoing':False, 'function':function, 'closing_lock':threading.Lock()})
   except:
     nanny.tattle_remove_item('insockets',handle)
     raise
 
+  try:
+    register_listening_socket(handle)
+  except:
+    cleanup(handle)
+    raise
+
 
   # start the selector if it's not running already
   check_selector()
@@ -1697,6 +2040,25 @@ def socket_state(realsock, waitfor="rw", timeout=0.0):
 
 
 
+# Private.   Blocks until realsock can be written (if forwrite) or read, has 
+# an error or is shut down, or timeout seconds pass.   cleanup shuts sockets
+# down before closing them, so a thread waiting here on a socket that is 
+# closed wakes at once.   Errors are left for the caller's next recv or send
+# to find.   Only used where SELECTOR_POLLER_TYPE says there is poll.
+def wait_for_socket(realsock, forwrite, timeout):
+  try:
+    poller = select.poll()
+    if forwrite:
+      poller.register(realsock, select.POLLOUT)
+    else:
+      poller.register(realsock, select.POLLIN | select.POLLPRI)
+    poller.poll(timeout * 1000)
+  except (socket.error, select.error, IOError, OSError, ValueError):
+    pass
+
+
+
+
 # Public.   We pass these to the users for communication purposes
 class emulated_socket:
   # This is an index into the comminfo table...
@@ -1800,19 +2162,20 @@ class emulated_socket:
     # loop until we recv the information (looping is needed for Windows)
     while True:
       try:
-        # the timeout is needed so that if the socket is closed in another 
-        # thread, we notice it
-        # BUG: What should the timeout be?   What is the right value?
-        #comminfo[mycommid]['socket'].settimeout(0.2)
-        
         # Armon: Get the real socket
         realsocket = comminfo[mycommid]['socket']
-	
-        # Check if the socket is ready for reading
-        (read_will_block, write_will_block) = socket_state(realsocket, "r", 0.2)	
-        if not read_will_block:
-          datarecvd = realsocket.recv(bytes)
-          break
+
+        if SELECTOR_POLLER_TYPE is None:
+          # the timeout is needed so that if the socket is closed in another 
+          # thread, we notice it
+          (read_will_block, write_will_block) = socket_state(realsocket, "r", 0.2)	
+          if read_will_block:
+            continue
+
+        # Otherwise just try, if there's nothing to read we'll wait in 
+        # wait_for_socket
+        datarecvd = realsocket.recv(bytes)
+        break
 
       # they likely closed the connection
       except KeyError:
@@ -1822,6 +2185,8 @@ class emulated_socket:
       except Exception, e:
         # Check if this error is recoverable
         if is_recoverable_network_exception(e):
+          if SELECTOR_POLLER_TYPE is not None:
+            wait_for_socket(realsocket, False, SOCKET_WAIT_TIMEOUT)
           continue
 
         # Otherwise, raise the exception
@@ -1898,12 +2263,15 @@ class emulated_socket:
       try:
         # Armon: Get the real socket
         realsocket = comminfo[mycommid]['socket']
-	
-        # Check if the socket is ready for writing, wait 0.2 seconds
-        (read_will_block, write_will_block) = socket_state(realsocket, "w", 0.2)
-        if not write_will_block:
-          bytessent = realsocket.send(message)
-          break
+
+        if SELECTOR_POLLER_TYPE is None:
+          # Check if the socket is ready for writing, wait 0.2 seconds
+          (read_will_block, write_will_block) = socket_state(realsocket, "w", 0.2)
+          if write_will_block:
+            continue
+
+        bytessent = realsocket.send(message)
+        break
       
       except KeyError:
         raise Exception, "Socket closed"
@@ -1911,6 +2279,8 @@ class emulated_socket:
       except Exception,e:
         # Determine if the exception is fatal
         if is_recoverable_network_exception(e):
+          if SELECTOR_POLLER_TYPE is not None:
+            wait_for_socket(realsocket, True, SOCKET_WAIT_TIMEOUT)
           continue
         else:
           # Check if this is a conn. term., and give a more specific exception.
@@ -104,11 +104,17 @@
     docstring.
 """
 
+import atexit
+import hashlib
 import os
 import random
+import sys
+import threading
 import time
 import traceback
+import Queue
 import xmlrpclib
+from collections import OrderedDict
 
 import seattleclearinghouse_xmlrpc
 
@@ -136,6 +142,32 @@ defaulttimeout = 10
 # The number of worker threads to use for each parallelized operation.
 num_worker_threads = 5
 
+# Whether to reuse connections to node managers across requests. Node managers
+# that don't support this are detected and fallen back from automatically.
+use_nm_keepalive = True
+
+# How long, in seconds, a node's location is trusted before the node's
+# advertised locations are looked up again.
+node_location_cache_ttl = 60 * 60
+
+# How long, in seconds, to remember that a node couldn't be located so that
+# asking again doesn't redo the advertise lookup (and probing) every time.
+node_location_negative_ttl = 60
+
+# The most node locations to remember. The least recently used are dropped.
+node_location_cache_size = 100000
+
+# If not None, a file that node locations are loaded from the first time one
+# is needed and saved to when the program exits, so they survive across runs.
+node_location_cache_file = None
+
+# The most nmhandles to keep. The least recently used are destroyed.
+nmhandle_cache_size = 1000
+
+# Cached nmhandles that haven't been used for this many seconds are destroyed
+# rather than reused.
+nmhandle_idle_timeout = 15 * 60
+
 # Whether additional information and debugging messages should be printed
 # to stderr by this library.
 print_debug_messages = True
@@ -201,13 +233,32 @@ VESSEL_STATUS_SET_INACTIVE = set([VESSEL_STATUS_NO_SUCH_NODE, VESSEL_STATUS_NO_S
 # Whether _initialize_time() has been called.
 _initialize_time_called = False
 
-# Keys are node locations (a string of "host:port"), values are nmhandles.
-# Note that this method of caching nmhandles will cause problems if multiple
-# identities/keys are being used to contact the name node.
-_nmhandle_cache = {}
+# Keys are (nodelocation, identity key fingerprint, whether the identity has a
+# private key), values are [nmhandle, lastusedtime]. Least recently used
+# first. Only use it through _get_nmhandle(), _release_nmhandle() and
+# _invalidate_nmhandle().
+_nmhandle_cache = OrderedDict()
+_nmhandle_cache_lock = threading.Lock()
+
+# Keys are nmhandles that callers of _get_nmhandle() are using, values are how
+# many of them haven't called _release_nmhandle() yet. Protected by
+# _nmhandle_cache_lock.
+_nmhandle_users = {}
+
+# Keys are in use nmhandles that have been removed from _nmhandle_cache,
+# values are their cache keys. They are destroyed when the last user releases
+# them. Protected by _nmhandle_cache_lock.
+_retired_nmhandles = {}
+
+# Keys are nodeids, values are (nodelocation, expiretime, error) where
+# expiretime is a time.time() value and, for nodes we couldn't locate,
+# nodelocation is None and error is the exception to raise again. Least
+# recently used first. Only use it through the _*_node_location* functions.
+_node_location_cache = OrderedDict()
+_node_location_cache_lock = threading.Lock()
 
-# Keys are nodeids, values are nodelocations.
-_node_location_cache = {}
+# Whether node_location_cache_file has been loaded.
+_node_location_cache_loaded = False
 
 
 
@@ -396,11 +447,158 @@ def _create_list_from_key_in_dictlist(dictlist, key):
 
 
 
+def _debug_print(msg):
+  if print_debug_messages:
+    print >> sys.stderr, msg
+
+
+
+
+
+def _nmhandle_cache_key(nodelocation, identity):
+  # Handles are specific to the keys they sign with, so each identity gets
+  # its own. A fingerprint keeps the whole key out of the cache.
+  if identity is None:
+    return (nodelocation, None, False)
+  fingerprint = hashlib.sha1(identity['publickey_str']).hexdigest()
+  return (nodelocation, fingerprint, 'privatekey_dict' in identity)
+
+
+
+
+
+def _destroy_nmhandle(cachekey, nmhandle):
+  # Destroys an nmhandle that is no longer cached or used. Pooled connections
+  # to a node are closed once no cached handle for that node is left. Must
+  # not be called with the lock held.
+  _nmhandle_cache_lock.acquire()
+  try:
+    nodeinuse = False
+    for othercachekey in _nmhandle_cache:
+      if othercachekey[0] == cachekey[0]:
+        nodeinuse = True
+        break
+  finally:
+    _nmhandle_cache_lock.release()
+
+  if not nodeinuse:
+    fastnmclient.nmclient_closeconnections(nmhandle)
+  fastnmclient.nmclient_destroyhandle(nmhandle)
+
+
+
+
+
+def _destroy_nmhandles(entrylist):
+  # Destroys the nmhandles of cache entries that have been removed from
+  # _nmhandle_cache. Handles that are still in use are left for the last
+  # _release_nmhandle() to destroy. Must not be called with the lock held.
+  for cachekey, (nmhandle, lastused) in entrylist:
+    _nmhandle_cache_lock.acquire()
+    try:
+      inuse = nmhandle in _nmhandle_users
+      if inuse:
+        _retired_nmhandles[nmhandle] = cachekey
+    finally:
+      _nmhandle_cache_lock.release()
+
+    if not inuse:
+      _destroy_nmhandle(cachekey, nmhandle)
+
+
+
+
+
+def _checkout_nmhandle(nmhandle):
+  # Counts another user of the nmhandle. Must be called with
+  # _nmhandle_cache_lock held.
+  _nmhandle_users[nmhandle] = _nmhandle_users.get(nmhandle, 0) + 1
+
+
+
+
+
+def _release_nmhandle(nmhandle):
+  """
+  Done using an nmhandle from _get_nmhandle(). If it was evicted or
+  invalidated meanwhile and this was its last user, it is destroyed now.
+  """
+  _nmhandle_cache_lock.acquire()
+  try:
+    _nmhandle_users[nmhandle] -= 1
+    if _nmhandle_users[nmhandle] > 0:
+      return
+    del _nmhandle_users[nmhandle]
+    cachekey = _retired_nmhandles.pop(nmhandle, None)
+  finally:
+    _nmhandle_cache_lock.release()
+
+  if cachekey is not None:
+    _destroy_nmhandle(cachekey, nmhandle)
+
+
+
+
+
+def _evict_nmhandles():
+  # Removes expired and excess entries from _nmhandle_cache, returning them.
+  # Must be called with _nmhandle_cache_lock held.
+  evicted = []
+  oldest = time.time() - nmhandle_idle_timeout
+  # The least recently used are first, so we can stop at the first one that
+  # is still fresh.
+  while _nmhandle_cache:
+    cachekey = next(iter(_nmhandle_cache))
+    entry = _nmhandle_cache[cachekey]
+    if entry[1] >= oldest and len(_nmhandle_cache) <= nmhandle_cache_size:
+      break
+    del _nmhandle_cache[cachekey]
+    evicted.append((cachekey, entry))
+  return evicted
+
+
+
+
+
+def _invalidate_nmhandle(nodelocation, identity=None):
+  """
+  Destroy the cached nmhandle for the nodelocation and identity, if there is
+  one. Used when communication with the node fails, since the node may have
+  restarted or moved and a new handle will check that it's the same node.
+  """
+  _nmhandle_cache_lock.acquire()
+  try:
+    cachekey = _nmhandle_cache_key(nodelocation, identity)
+    entry = _nmhandle_cache.pop(cachekey, None)
+  finally:
+    _nmhandle_cache_lock.release()
+
+  if entry is not None:
+    _destroy_nmhandles([(cachekey, entry)])
+
+
+
+
+
+def _is_node_manager_error(e):
+  """
+  Whether an NMClientException is the node manager answering with an error
+  (such as for a bad request), as opposed to a failure to communicate.
+  """
+  return str(e).startswith("Node Manager error") or str(e).startswith("Node Manager warning")
+
+
+
+
+
 def _get_nmhandle(nodelocation, identity=None):
   """
   Get an nmhandle for the nodelocation and identity, if provided. This will look
   use a cache of nmhandles and only create a new one if the requested nmhandle
-  has not previously been requested.
+  has not previously been requested, or has been destroyed (see
+  nmhandle_cache_size, nmhandle_idle_timeout and _invalidate_nmhandle()).
+  Every nmhandle returned must be given back with _release_nmhandle(), so
+  that it isn't destroyed while it is still being used.
   """
   
   # Call _initialize_time() here because time must be updated at least once before
@@ -410,36 +608,84 @@ def _get_nmhandle(nodelocation, identity=None):
   host, port = nodelocation.split(':')
   port = int(port)
   
-  if identity is None:
-    identitystring = "None"
-  else:
-    identitystring = identity['publickey_str']
-    
-  if identitystring not in _nmhandle_cache:
-    _nmhandle_cache[identitystring] = {}
+  cachekey = _nmhandle_cache_key(nodelocation, identity)
 
-  if nodelocation not in _nmhandle_cache[identitystring]:
-    try:
-      if identity is None:
-        nmhandle = fastnmclient.nmclient_createhandle(host, port, timeout=defaulttimeout)
-      elif 'privatekey_dict' in identity:
-        nmhandle = fastnmclient.nmclient_createhandle(host, port, privatekey=identity['privatekey_dict'],
-                                           publickey=identity['publickey_dict'], timeout=defaulttimeout)
-      else:
-        nmhandle = fastnmclient.nmclient_createhandle(host, port, publickey=identity['publickey_dict'],
-                                                  timeout=defaulttimeout)
-    except fastnmclient.NMClientException, e:
-      raise NodeCommunicationError(str(e))
-    
-    _nmhandle_cache[identitystring][nodelocation] = nmhandle
+  _nmhandle_cache_lock.acquire()
+  try:
+    evicted = _evict_nmhandles()
+    entry = _nmhandle_cache.pop(cachekey, None)
+    if entry is not None:
+      entry[1] = time.time()
+      _nmhandle_cache[cachekey] = entry
+      _checkout_nmhandle(entry[0])
+  finally:
+    _nmhandle_cache_lock.release()
+
+  _destroy_nmhandles(evicted)
+
+  if entry is not None:
+    return entry[0]
+
+  # Creating a handle contacts the node, so it's done without the lock held.
+  try:
+    if identity is None:
+      nmhandle = fastnmclient.nmclient_createhandle(host, port, timeout=defaulttimeout,
+                                                    keepalive=use_nm_keepalive)
+    elif 'privatekey_dict' in identity:
+      nmhandle = fastnmclient.nmclient_createhandle(host, port, privatekey=identity['privatekey_dict'],
+                                         publickey=identity['publickey_dict'], timeout=defaulttimeout,
+                                         keepalive=use_nm_keepalive)
+    else:
+      nmhandle = fastnmclient.nmclient_createhandle(host, port, publickey=identity['publickey_dict'],
+                                                timeout=defaulttimeout, keepalive=use_nm_keepalive)
+  except fastnmclient.NMClientException, e:
+    raise NodeCommunicationError(str(e))
+
+  _nmhandle_cache_lock.acquire()
+  try:
+    # Another thread may have beaten us to it, in which case we use theirs.
+    entry = _nmhandle_cache.get(cachekey)
+    if entry is None:
+      _nmhandle_cache[cachekey] = [nmhandle, time.time()]
+      _checkout_nmhandle(nmhandle)
+      evicted = _evict_nmhandles()
+    else:
+      _checkout_nmhandle(entry[0])
+      evicted = []
+  finally:
+    _nmhandle_cache_lock.release()
+
+  _destroy_nmhandles(evicted)
+
+  if entry is not None:
+    fastnmclient.nmclient_destroyhandle(nmhandle)
+    return entry[0]
     
-  return _nmhandle_cache[identitystring][nodelocation]
+  return nmhandle
+
+
+
 
 
+def _start_parallelized(targetlist, func, args, kwargs, callername):
+  # Starts parallelize on targetlist with the keyword arguments accepted by
+  # run_parallelized and returns the handle.
+  num_threads = kwargs.pop('num_threads', None)
+  max_threads = kwargs.pop('max_threads', None)
+  item_timeout = kwargs.pop('item_timeout', None)
+  if kwargs:
+    raise TypeError("Unexpected keyword arguments to " + callername + ": " + str(kwargs.keys()))
+  if num_threads is None:
+    num_threads = num_worker_threads
 
+  return parallelize.parallelize_initfunction_adaptive(targetlist, func, num_threads,
+                                                       max_threads, item_timeout, args)
 
 
-def run_parallelized(targetlist, func, *args):
+
+
+
+def run_parallelized(targetlist, func, *args, **kwargs):
   """
   <Purpose>
     Parallelize the calling of a given function using multiple threads.
@@ -452,14 +698,29 @@ def run_parallelized(targetlist, func, *args):
       (optional) every additional argument will be passed to func after an
       item from targetlist. That is, these will be the second, third, etc.
       argument to func, if provided. These are not required a.
+    num_threads
+      (optional, keyword only) the number of threads to use. Defaults to
+      num_worker_threads (a global variable).
+    max_threads
+      (optional, keyword only) if given, more threads are added, up to this
+      many, while the calls to func are slow (such as when they wait on the
+      network) and adding threads isn't making them slower.
+    item_timeout
+      (optional, keyword only) the most seconds a single call to func may
+      take. A call that takes longer is reported as a failure with a timeout
+      message. The call can't be interrupted, so its thread keeps running
+      until it returns.
   <Exceptions>
     SeattleExperimentError
       Raised if there is a problem performing parallel processing. This will
       not be raised just because func raises exceptions. If func raises
       exceptions when it is called, that exception information will be
       available through the run_parallelized's return value.
+    TypeError
+      If a keyword argument other than num_threads, max_threads or
+      item_timeout is given.
   <Side Effects>
-    Up to num_worker_threads (a global variable) threads will be spawned to
+    Up to num_threads threads (or max_threads, if given) will be spawned to
     call func once for every item in targetlist.
   <Returns>
     A tuple of:
@@ -472,16 +733,21 @@ def run_parallelized(targetlist, func, *args):
     only the string representation of the exception.
   """
   
+  # Started outside the try below so that a bad keyword argument gets its
+  # TypeError, and there is no handle to close if starting fails.
+  try:
+    phandle = _start_parallelized(targetlist, func, args, kwargs, "run_parallelized")
+  except parallelize.ParallelizeError:
+    raise SeattleExperimentError("Error occurred in run_parallelized: " + 
+                                 traceback.format_exc())
+
   try:
-    phandle = parallelize.parallelize_initfunction(targetlist, func, num_worker_threads, *args)
-  
-    while not parallelize.parallelize_isfunctionfinished(phandle):
-      # TODO: Give up after a timeout? This seems risky as run_parallelized may
-      # be used with functions that take a long time to complete and very large
-      # lists of targets. It would be a shame to break a user's program because
-      # of an assumption here. Maybe it should be an optional argument to 
-      # run_parallelized.
-      time.sleep(.1)
+    # TODO: Give up after a timeout? This seems risky as run_parallelized may
+    # be used with functions that take a long time to complete and very large
+    # lists of targets. It would be a shame to break a user's program because
+    # of an assumption here. Maybe it should be an optional argument to 
+    # run_parallelized.
+    parallelize.parallelize_wait(phandle)
     
     results = parallelize.parallelize_getresults(phandle)
   except parallelize.ParallelizeError:
@@ -499,6 +765,62 @@ def run_parallelized(targetlist, func, *args):
 
 
 
+def run_parallelized_iter(targetlist, func, *args, **kwargs):
+  """
+  <Purpose>
+    Like run_parallelized, but rather than waiting for every call to finish,
+    hands back each result as soon as its call returns so the caller can
+    start working on it.
+  <Arguments>
+    The same as run_parallelized.
+  <Exceptions>
+    SeattleExperimentError
+      Raised if there is a problem performing parallel processing. This will
+      not be raised just because func raises exceptions.
+    TypeError
+      If a keyword argument run_parallelized doesn't accept is given.
+  <Side Effects>
+    As for run_parallelized. If the caller stops iterating early, the calls that
+    haven't started yet are aborted.
+  <Returns>
+    An iterator of tuples of the format:
+      (target, succeeded, value)
+    in the order the calls finish, where value is the return value from func
+    if succeeded is True and the exception string if it is False.
+  """
+  
+  try:
+    phandle = _start_parallelized(targetlist, func, args, kwargs, "run_parallelized_iter")
+  except parallelize.ParallelizeError:
+    raise SeattleExperimentError("Error occurred in run_parallelized_iter: " + 
+                                 traceback.format_exc())
+
+  try:
+    seen = 0
+    while True:
+      try:
+        newresults = parallelize.parallelize_getnewresults(phandle, seen)
+      except parallelize.ParallelizeError:
+        raise SeattleExperimentError("Error occurred in run_parallelized_iter: " + 
+                                     traceback.format_exc())
+      if not newresults:
+        return
+      seen += len(newresults)
+
+      for resulttype, target, value in newresults:
+        if resulttype == 'returned':
+          yield (target, True, value)
+        elif resulttype == 'exception':
+          yield (target, False, value)
+
+  finally:
+    parallelize.parallelize_abortfunction(phandle)
+    parallelize.parallelize_closefunction(phandle)
+
+
+
+
+
 def create_identity_from_key_files(publickey_fn, privatekey_fn=None):
   """
   <Purpose>
@@ -590,15 +912,15 @@ def create_identity_from_key_strings(publickey_string, privatekey_string=None, u
 
 
 
-def _lookup_node_locations(keystring, lookuptype=None):
+def _lookup_node_locations(keystring, lookuptype=None, usecache=True):
   """Does the actual work of an advertise lookup."""
   
   keydict = rsa.rsa_string_to_publickey(keystring)
   try:
     if lookuptype is not None:
-      nodelist = advertise.advertise_lookup(keydict, maxvals=max_lookup_results, timeout=defaulttimeout, lookuptype=lookuptype)
+      nodelist = advertise.advertise_lookup(keydict, maxvals=max_lookup_results, timeout=defaulttimeout, lookuptype=lookuptype, usecache=usecache)
     else:
-      nodelist = advertise.advertise_lookup(keydict, maxvals=max_lookup_results, timeout=defaulttimeout)
+      nodelist = advertise.advertise_lookup(keydict, maxvals=max_lookup_results, timeout=defaulttimeout, usecache=usecache)
   except advertise.AdvertiseError, e:
     raise UnableToPerformLookupError("Failure when trying to perform advertise lookup: " + 
                                      traceback.format_exc())
@@ -636,7 +958,7 @@ def lookup_node_locations_by_identity(identity):
 
 
 
-def lookup_node_locations_by_nodeid(nodeid):
+def lookup_node_locations_by_nodeid(nodeid, usecache=True):
   """
   <Purpose>
     Lookup the locations that a specific node has advertised under. There may
@@ -644,13 +966,16 @@ def lookup_node_locations_by_nodeid(nodeid):
   <Arguments>
     nodeid
       The nodeid of the node whose advertised locations are to be looked up.
+    usecache
+      (optional, default is True) Whether the advertise lookup may be
+      answered from recent lookups of the same key.
   <Exceptions>
     UnableToPerformLookupError
       If a failure occurs when trying lookup advertised node locations.
   <Returns>
     A list of nodelocations.
   """
-  return _lookup_node_locations(nodeid, lookuptype=advertise_lookup_types)
+  return _lookup_node_locations(nodeid, lookuptype=advertise_lookup_types, usecache=usecache)
 
 
 
@@ -725,7 +1050,11 @@ def browse_node(nodelocation, identity=None):
     try:
       nodeinfo = fastnmclient.nmclient_getvesseldict(nmhandle)
     except fastnmclient.NMClientException, e:
+      if not _is_node_manager_error(e):
+        _invalidate_nmhandle(nodelocation, identity)
       raise NodeCommunicationError("Failed to communicate with node " + nodelocation + ": " + str(e))
+    finally:
+      _release_nmhandle(nmhandle)
   
     # We do our own looking through the nodeinfo rather than use the function
     # nmclient_listaccessiblevessels() as we don't want to contact the node a
@@ -744,7 +1073,7 @@ def browse_node(nodelocation, identity=None):
     # For efficiency, let's update the _node_location_cache with this info.
     # This can prevent individual advertise lookups of each nodeid by other
     # functions in the experimentlib that may be called later.
-    _node_location_cache[nodeid] = nodelocation
+    _cache_node_location(nodeid, nodelocation)
 
     vesseldict_list = []
     for vesselname in usablevessels:
@@ -792,14 +1121,36 @@ def get_vessel_status(vesselhandle, identity):
   """
   _validate_vesselhandle(vesselhandle)
   _validate_identity(identity)
-    
-  # Determine the last known location of the node. 
+
   nodeid, vesselname = vesselhandle.split(":")
+  status = _get_node_vessel_statuses(nodeid, [vesselhandle], identity)[vesselhandle]
+
+  # The node is up and the vessel must have the identity's key as the owner
+  # or a user, but the status returned isn't one of the statuses we
+  # expect. If this does occur, it may indicate a bug in the experiment
+  # library where it doesn't know about all possible status a nodemanager
+  # may return for a vessel.
+  if status not in VESSEL_STATUS_SET_ACTIVE and status not in VESSEL_STATUS_SET_INACTIVE:
+    raise UnexpectedVesselStatusError(status)
+
+  return status
+
+
+
+
+
+def _get_node_vessel_statuses(nodeid, vesselhandle_list, identity):
+  # Finds the status of every vessel in vesselhandle_list, all of which must
+  # be on the node nodeid, by contacting the node once. Returns a dict of
+  # vesselhandle -> status. A status the node reports that we don't know
+  # about is returned as is, it's up to the caller what to do with it.
+
+  # Determine the last known location of the node. 
   try:
     # This will get a cached node location if one exists.
     nodelocation = get_node_location(nodeid)
   except NodeLocationNotAdvertisedError, e:
-    return VESSEL_STATUS_NO_SUCH_NODE
+    return dict.fromkeys(vesselhandle_list, VESSEL_STATUS_NO_SUCH_NODE)
   
   try:
     vesselinfolist = browse_node(nodelocation, identity)
@@ -808,29 +1159,86 @@ def get_vessel_status(vesselhandle, identity):
     try:
       nodelocation = get_node_location(nodeid, ignorecache=True)
     except NodeLocationNotAdvertisedError, e:
-      return VESSEL_STATUS_NO_SUCH_NODE
+      return dict.fromkeys(vesselhandle_list, VESSEL_STATUS_NO_SUCH_NODE)
 
     # Try to communicate again.
     try:
       vesselinfolist = browse_node(nodelocation, identity)
     except NodeCommunicationError, e:
-      return VESSEL_STATUS_NODE_UNREACHABLE
+      return dict.fromkeys(vesselhandle_list, VESSEL_STATUS_NODE_UNREACHABLE)
 
+  # The node is up, any vessel it doesn't list doesn't exist (or isn't usable
+  # by this identity).
+  statusdict = dict.fromkeys(vesselhandle_list, VESSEL_STATUS_NO_SUCH_VESSEL)
   for vesselinfo in vesselinfolist:
-    if vesselinfo['vesselhandle'] == vesselhandle:
-      # The node is up and the vessel must have the identity's key as the owner
-      # or a user, but the status returned isn't one of the statuses we
-      # expect. If this does occur, it may indicate a bug in the experiment
-      # library where it doesn't know about all possible status a nodemanager
-      # may return for a vessel.
-      if vesselinfo['status'] not in VESSEL_STATUS_SET_ACTIVE:
-        raise UnexpectedVesselStatusError(vesselinfo['status'])
+    if vesselinfo['vesselhandle'] in statusdict:
+      statusdict[vesselinfo['vesselhandle']] = vesselinfo['status']
+
+  return statusdict
+
+
+
+
+
+def _get_vessel_statuses_helper(nodeid, vesselhandles_by_node, identity):
+  # Called through run_parallelized, once for each node.
+  return _get_node_vessel_statuses(nodeid, vesselhandles_by_node[nodeid], identity)
+
+
+
+
+
+def get_vessel_statuses(vesselhandle_list, identity, num_threads=None):
+  """
+  <Purpose>
+    Determine the status of many vessels at once. The vessels are grouped by
+    node and each node is contacted only once, with the nodes being
+    contacted in parallel.
+  <Arguments>
+    vesselhandle_list
+      A list of vesselhandles of the vessels whose status is to be checked.
+    identity
+      The identity of the owner or a user of the vessels.
+    num_threads
+      (optional) The number of nodes to contact at the same time. Defaults
+      to num_worker_threads (a global variable).
+  <Exceptions>
+    SeattleExperimentError
+      If there is a problem performing parallel processing.
+  <Side Effects>
+    The nodes the vessels are on are communicated with.
+  <Returns>
+    A dict of vesselhandle -> status, where status is one of the
+    VESSEL_STATUS_* constants. A vessel whose status could not be determined
+    (because the node reported a status this library doesn't know about or
+    something unexpected went wrong talking to it) is left out of the dict.
+  """
+  _validate_vesselhandle_list(vesselhandle_list)
+  _validate_identity(identity)
+
+  vesselhandles_by_node = {}
+  for vesselhandle in vesselhandle_list:
+    nodeid, vesselname = vesselhandle.split(":")
+    vesselhandles_by_node.setdefault(nodeid, []).append(vesselhandle)
+
+  successlist, failurelist = run_parallelized(vesselhandles_by_node.keys(),
+                                              _get_vessel_statuses_helper,
+                                              vesselhandles_by_node, identity,
+                                              num_threads=num_threads)
+
+  for nodeid, errormsg in failurelist:
+    _debug_print("Failed to get vessel statuses from node " + nodeid + ": " + errormsg)
+
+  statusdict = {}
+  for nodeid, nodestatusdict in successlist:
+    for vesselhandle, status in nodestatusdict.items():
+      if status in VESSEL_STATUS_SET_ACTIVE or status in VESSEL_STATUS_SET_INACTIVE:
+        statusdict[vesselhandle] = status
       else:
-        return vesselinfo['status']
-  else:
-    # The node is up but this vessel doesn't exist.
-    return VESSEL_STATUS_NO_SUCH_VESSEL
-      
+        _debug_print("Unexpected status " + str(status) + " for vessel " + vesselhandle)
+
+  return statusdict
+
 
 
 
@@ -842,7 +1250,14 @@ def _do_public_node_request(nodeid, requestname, *args):
   try:
     return fastnmclient.nmclient_rawsay(nmhandle, requestname, *args)
   except fastnmclient.NMClientException, e:
+    if not _is_node_manager_error(e):
+      # The node may have moved or restarted, so find it and check it's the
+      # same node again next time.
+      _invalidate_nmhandle(nodelocation)
+      invalidate_node_location(nodeid)
     raise NodeCommunicationError(str(e))
+  finally:
+    _release_nmhandle(nmhandle)
 
 
 
@@ -858,7 +1273,14 @@ def _do_signed_vessel_request(identity, vesselhandle, requestname, *args):
   try:
     return fastnmclient.nmclient_signedsay(nmhandle, requestname, vesselname, *args)
   except fastnmclient.NMClientException, e:
+    if not _is_node_manager_error(e):
+      # The node may have moved or restarted, so find it and check it's the
+      # same node again next time.
+      _invalidate_nmhandle(nodelocation, identity)
+      invalidate_node_location(nodeid)
     raise NodeCommunicationError(str(e))
+  finally:
+    _release_nmhandle(nmhandle)
 
 
 
@@ -1011,6 +1433,39 @@ def upload_file_to_vessel(vesselhandle, identity, local_filename, remote_filenam
   filedata = fileobj.read()
   fileobj.close()
   
+  upload_data_to_vessel(vesselhandle, identity, filedata, remote_filename)
+
+
+
+
+
+def upload_data_to_vessel(vesselhandle, identity, filedata, remote_filename):
+  """
+  <Purpose>
+    Upload a string to a file on a vessel. Useful when the same file is being
+    uploaded to many vessels, as it only needs to be read from disk once.
+  <Arguments>
+    vesselhandle
+      The vesselhandle of the vessel that the data is to be uploaded to.
+    identity
+      The identity of either the owner or a user of the vessel.
+    filedata
+      A string containing the contents of the file.
+    remote_filename
+      The filename to use when storing the data on the vessel. This is
+      subject to the same restrictions as with upload_file_to_vessel.
+  <Exceptions>
+    NodeCommunicationError
+      If communication with the node failed, either because the node is down,
+      the communication timed out, the signature was invalid, or the identity
+      unauthorized for this action.
+  <Side Effects>
+    The file has been uploaded to the vessel.
+  <Returns>
+    None
+  """
+  _validate_vesselhandle(vesselhandle)
+  
   _do_signed_vessel_request(identity, vesselhandle, "AddFileToVessel", remote_filename, filedata)
 
 
@@ -1482,6 +1937,204 @@ def get_host_and_port(nodelocation):
 
 
 
+def _load_node_location_cache():
+  # Reads node_location_cache_file the first time any location is needed.
+  # Must be called with _node_location_cache_lock held.
+  global _node_location_cache_loaded
+
+  if _node_location_cache_loaded:
+    return
+  _node_location_cache_loaded = True
+
+  if node_location_cache_file is None:
+    return
+
+  # Whatever we learn gets written back out when we exit.
+  atexit.register(save_node_location_cache)
+
+  if not os.path.exists(node_location_cache_file):
+    return
+
+  now = time.time()
+  try:
+    cachefileobj = open(node_location_cache_file, "r")
+    try:
+      for line in cachefileobj:
+        # nodeids have spaces in them, so the fields are tab separated.
+        try:
+          nodeid, nodelocation, expiretime = line.rstrip('\n').split('\t')
+          expiretime = float(expiretime)
+        except ValueError:
+          continue
+        if expiretime > now and nodeid not in _node_location_cache:
+          _node_location_cache[nodeid] = (nodelocation, expiretime, None)
+    finally:
+      cachefileobj.close()
+  except IOError, e:
+    _debug_print("Unable to read node location cache " + node_location_cache_file + ": " + str(e))
+
+  _trim_node_location_cache()
+
+
+
+
+
+def _trim_node_location_cache():
+  # Must be called with _node_location_cache_lock held.
+  while len(_node_location_cache) > node_location_cache_size:
+    _node_location_cache.popitem(last=False)
+
+
+
+
+
+def _cache_node_location(nodeid, nodelocation, error=None):
+  # Remembers where a node is, or if nodelocation is None, the error we got
+  # trying to find it.
+  if nodelocation is None:
+    expiretime = time.time() + node_location_negative_ttl
+  else:
+    expiretime = time.time() + node_location_cache_ttl
+
+  _node_location_cache_lock.acquire()
+  try:
+    _load_node_location_cache()
+    _node_location_cache.pop(nodeid, None)
+    _node_location_cache[nodeid] = (nodelocation, expiretime, error)
+    _trim_node_location_cache()
+  finally:
+    _node_location_cache_lock.release()
+
+
+
+
+
+def _get_cached_node_location(nodeid):
+  # Returns the unexpired (nodelocation, expiretime, error) for nodeid, or
+  # None if there isn't one.
+  _node_location_cache_lock.acquire()
+  try:
+    _load_node_location_cache()
+    entry = _node_location_cache.pop(nodeid, None)
+    if entry is None or entry[1] <= time.time():
+      return None
+    _node_location_cache[nodeid] = entry
+    return entry
+  finally:
+    _node_location_cache_lock.release()
+
+
+
+
+
+def invalidate_node_location(nodeid):
+  """
+  <Purpose>
+    Forget the cached location of a node, so the next request for it does
+    a fresh advertise lookup. This is done automatically when communication
+    with a node fails.
+  <Arguments>
+    nodeid
+      The nodeid of the node.
+  <Exceptions>
+    None
+  <Side Effects>
+    None
+  <Returns>
+    None
+  """
+  _node_location_cache_lock.acquire()
+  try:
+    _node_location_cache.pop(nodeid, None)
+  finally:
+    _node_location_cache_lock.release()
+
+
+
+
+
+def save_node_location_cache(filename=None):
+  """
+  <Purpose>
+    Write the known node locations to a file so a later run can start with
+    them. Nodes we failed to locate aren't saved.
+  <Arguments>
+    filename
+      (optional) The file to write. Defaults to node_location_cache_file.
+  <Exceptions>
+    IOError
+      If the file can't be written.
+  <Side Effects>
+    The file is replaced.
+  <Returns>
+    None
+  """
+  if filename is None:
+    filename = node_location_cache_file
+  if filename is None:
+    return
+
+  _node_location_cache_lock.acquire()
+  try:
+    entries = _node_location_cache.items()
+  finally:
+    _node_location_cache_lock.release()
+
+  # Write then rename so a crash never leaves a partial file behind.
+  tempfilename = filename + ".tmp"
+  cachefileobj = open(tempfilename, "w")
+  try:
+    now = time.time()
+    for nodeid, (nodelocation, expiretime, error) in entries:
+      if nodelocation is not None and expiretime > now:
+        cachefileobj.write(nodeid + '\t' + nodelocation + '\t' + repr(expiretime) + '\n')
+  finally:
+    cachefileobj.close()
+  os.rename(tempfilename, filename)
+
+
+
+
+
+def _probe_node_location(nodelocation, resultqueue):
+  # Tests basic communication with a possible location of a node, putting
+  # (nodelocation, success) on resultqueue.
+  host, portstr = nodelocation.split(':')
+  try:
+    # We create an nmhandle directly because we want to use it to test
+    # basic communication, which is done when an nmhandle is created.
+    nmhandle = fastnmclient.nmclient_createhandle(host, int(portstr), timeout=defaulttimeout)
+  except Exception, e:
+    resultqueue.put((nodelocation, False))
+  else:
+    fastnmclient.nmclient_destroyhandle(nmhandle)
+    resultqueue.put((nodelocation, True))
+
+
+
+
+
+def _probe_node_locations(locationlist):
+  # Contacts every location at once and returns the first that answers, or
+  # None if none do. The others are left to finish on their own.
+  resultqueue = Queue.Queue()
+  for possiblelocation in locationlist:
+    probethread = threading.Thread(target=_probe_node_location,
+                                   args=(possiblelocation, resultqueue))
+    probethread.setDaemon(True)
+    probethread.start()
+
+  for count in range(len(locationlist)):
+    possiblelocation, success = resultqueue.get()
+    if success:
+      return possiblelocation
+
+  return None
+
+
+
+
+
 def get_node_location(nodeid, ignorecache=False):
   """
   <Purpose>
@@ -1494,50 +2147,58 @@ def get_node_location(nodeid, ignorecache=False):
       node's location, forcing an advertise lookup and possibly also
       attempting to contact potential nodelocations.
   <Exceptions>
-    NodeLocationLookupError
-      If no node locations are being advertised under the nodeid or if a
+    NodeLocationNotAdvertisedError
+      If no node locations are being advertised under the nodeid.
     NodeCommunicationError
       If multiple node locations are being advertised under the nodeid but
       successful communication cannot be performed with any of the locations.
   <Side Effects>
-    If the node location isn't already known (or if ignorecache is True),
-    then an advertise lookup of the nodeid is done. In that case, if
-    multiple nodelocations are advertised under the nodeid, then each location
-    will be contacted until one is determined to be a valid nodelocation
-    that can be communicated with.
+    If the node location isn't already known, has expired from the cache (see
+    node_location_cache_ttl), or ignorecache is True, then an advertise lookup
+    of the nodeid is done. In that case, if multiple nodelocations are
+    advertised under the nodeid, then they are all contacted at once and the
+    first one to respond is used.
+    Failures are remembered for node_location_negative_ttl seconds and raised
+    again without another lookup.
   <Returns>
     A nodelocation. This nodelocation may or may not have been communicated
     with and is instead only the most likely location of a node at the time
     this function was called.
   """
-  if ignorecache or nodeid not in _node_location_cache:
-    locationlist = lookup_node_locations_by_nodeid(nodeid)
-    if not locationlist:
-      raise NodeLocationLookupError("Nothing advertised under node's key.")
-    # If there is more than one advertised location, we need to figure out
-    # which one is valid. For example, if a node moves then there will be
-    # a period of time in which the old advertised location and the new
-    # one are both returned. We need to determine the correct one.
-    elif len(locationlist) > 1:
-      for possiblelocation in locationlist:
-        host, portstr = possiblelocation.split(':')
-        try:
-          # We create an nmhandle directly because we want to use it to test
-          # basic communication, which is done when an nmhandle is created.
-          nmhandle = fastnmclient.nmclient_createhandle(host, int(portstr))
-        except fastnmclient.NMClientException, e:
-          continue
-        else:
-          fastnmclient.nmclient_destroyhandle(nmhandle)
-          _node_location_cache[nodeid] = possiblelocation
-          break
-      else:
-        raise NodeCommunicationError("Multiple node locations advertised but none " + 
+  if not ignorecache:
+    entry = _get_cached_node_location(nodeid)
+    if entry is not None:
+      nodelocation, expiretime, error = entry
+      if nodelocation is None:
+        raise error
+      return nodelocation
+
+  # If the advertise services can't be reached that doesn't tell us anything
+  # about the node, so that error isn't remembered.   Ignoring the cache 
+  # means asking the advertise services too, not the advertise lookup cache.
+  locationlist = lookup_node_locations_by_nodeid(nodeid, usecache=not ignorecache)
+
+  if not locationlist:
+    error = NodeLocationNotAdvertisedError("Nothing advertised under node's key.")
+    _cache_node_location(nodeid, None, error)
+    raise error
+
+  # If there is more than one advertised location, we need to figure out
+  # which one is valid. For example, if a node moves then there will be
+  # a period of time in which the old advertised location and the new
+  # one are both returned. We need to determine the correct one.
+  if len(locationlist) > 1:
+    nodelocation = _probe_node_locations(locationlist)
+    if nodelocation is None:
+      error = NodeCommunicationError("Multiple node locations advertised but none " + 
                                      "can be communicated with: " + str(locationlist))
-    else:
-      _node_location_cache[nodeid] = locationlist[0]
-      
-  return _node_location_cache[nodeid]
+      _cache_node_location(nodeid, None, error)
+      raise error
+  else:
+    nodelocation = locationlist[0]
+
+  _cache_node_location(nodeid, nodelocation)
+  return nodelocation
 
 
 
@@ -1622,7 +2283,7 @@ def _seattlegeni_cache_node_locations(seattlegeni_vessel_list):
     nodeid = seattlegeni_vessel['node_id']
     ip = seattlegeni_vessel['node_ip']
     portstr = str(seattlegeni_vessel['node_port'])
-    _node_location_cache[nodeid] = ip + ':' + portstr
+    _cache_node_location(nodeid, ip + ':' + portstr)
 
 
 
@@ -77,19 +77,52 @@ nmclient_handledictlock = getlock()
 
 
 
-# Note: I open a new connection for every request.   Is this really what I want
-# to do?   It seemed easiest but likely has performance implications
+# Keep-alive.   Node managers have always closed the connection after each
+# response, so by default a new connection is opened for every request.   A
+# handle created with keepalive=True instead returns its connection to a per
+# node pool after each request and later requests (from any keepalive handle
+# for the same node) reuse it.   Several requests can be sent down one
+# connection before reading the responses (see nmclient_signedsay_many).
+# A node manager that closes the connection anyway is noticed (the pooled
+# connection fails its health check, or a pipelined request gets no
+# response) and from then on the node is treated as not supporting it.
+
+# seconds a pooled connection may sit idle before we close it
+nmclient_keepalive_idletimeout = 30
+
+# most idle connections kept per node
+nmclient_keepalive_maxidle = 2
+
+# node key -> list of [connobject, time it went idle], newest last
+nmclient_connpool = {}
+nmclient_connpoollock = getlock()
+
+# node keys whose node managers close the connection after each response
+nmclient_nokeepalive = {}
+
+
+
+def _nmclient_nodekey(nmhandle):
+  if 'natlayermac' in nmclient_handledict[nmhandle]:
+    return ('NAT', nmclient_handledict[nmhandle]['natlayermac'], nmclient_handledict[nmhandle]['port'])
+  return (nmclient_handledict[nmhandle]['IP'], nmclient_handledict[nmhandle]['port'])
+
 
-# Sends data to a node (opens the connection, writes the 
-# communication header, sends all the data, receives the result, and returns
-# the result)...
-def nmclient_rawcommunicate(nmhandle, *args):
+
+def _nmclient_usekeepalive(nmhandle):
+  return nmclient_handledict[nmhandle].get('keepalive') and \
+      _nmclient_nodekey(nmhandle) not in nmclient_nokeepalive
+
+
+
+# opens a fresh connection to the handle's node manager
+def _nmclient_openconn(nmhandle):
 
   # the node is behind a nat and using nat layer
   if 'natlayermac' in nmclient_handledict[nmhandle]:
     try:
       # add 5 to timeout for nat delay
-      thisconnobject = nat_openconn(nmclient_handledict[nmhandle]['natlayermac'],nmclient_handledict[nmhandle]['port'],timeout=nmclient_handledict[nmhandle]['timeout']+5,usetimeoutsock=True) 
+      return nat_openconn(nmclient_handledict[nmhandle]['natlayermac'],nmclient_handledict[nmhandle]['port'],timeout=nmclient_handledict[nmhandle]['timeout']+5,usetimeoutsock=True) 
     except Exception, e:
       raise NMClientException, str(e)
   
@@ -97,29 +130,178 @@ def nmclient_rawcommunicate(nmhandle, *args):
   else:
     # do the normal openconn
     try:
-      thisconnobject = timeout_openconn(nmclient_handledict[nmhandle]['IP'], nmclient_handledict[nmhandle]['port'],timeout=nmclient_handledict[nmhandle]['timeout']) 
+      return timeout_openconn(nmclient_handledict[nmhandle]['IP'], nmclient_handledict[nmhandle]['port'],timeout=nmclient_handledict[nmhandle]['timeout']) 
     except Exception, e:
       raise NMClientException, str(e)
 
-  
-  # always close the connobject
+
+
+# An idle connection should have nothing to read.   If it does the node
+# manager either closed it or sent something we didn't ask for, and either
+# way it's no good to us.
+def _nmclient_connhealthy(connobject):
   try:
+    (recvwillblock, sendwillblock) = connobject.willblock()
+  except Exception:
+    return False
+  return recvwillblock
 
-    # send the args separated by '|' chars (as is expected by the node manager)
-    session_sendmessage(thisconnobject, '|'.join(args))
-    return session_recvmessage(thisconnobject)
-  except Exception, e:
-    raise NMClientException, str(e)
+
+
+def _nmclient_closeconn(connobject):
+  try:
+    connobject.close()
+  except Exception:
+    pass
+
+
+
+# Returns (connobject, reused) where reused says whether the connection came
+# from the pool
+def _nmclient_getconn(nmhandle):
+
+  if _nmclient_usekeepalive(nmhandle):
+    nodekey = _nmclient_nodekey(nmhandle)
+    now = getruntime()
+
+    while True:
+      nmclient_connpoollock.acquire()
+      try:
+        if not nmclient_connpool.get(nodekey):
+          break
+        (connobject, idlesince) = nmclient_connpool[nodekey].pop()
+      finally:
+        nmclient_connpoollock.release()
+
+      if now - idlesince > nmclient_keepalive_idletimeout:
+        _nmclient_closeconn(connobject)
+      elif not _nmclient_connhealthy(connobject):
+        # it was fine when we put it back, so the node manager closed it
+        nmclient_nokeepalive[nodekey] = True
+        _nmclient_closeconn(connobject)
+        _nmclient_dropconns(nodekey)
+        break
+      else:
+        return (connobject, True)
+
+  return (_nmclient_openconn(nmhandle), False)
+
+
+
+def _nmclient_putconn(nmhandle, connobject):
+
+  if not _nmclient_usekeepalive(nmhandle):
+    _nmclient_closeconn(connobject)
+    return
+
+  nodekey = _nmclient_nodekey(nmhandle)
+  nmclient_connpoollock.acquire()
+  try:
+    idlelist = nmclient_connpool.setdefault(nodekey, [])
+    idlelist.append([connobject, getruntime()])
+    while len(idlelist) > nmclient_keepalive_maxidle:
+      _nmclient_closeconn(idlelist.pop(0)[0])
   finally:
-    thisconnobject.close()
+    nmclient_connpoollock.release()
 
 
 
+def _nmclient_dropconns(nodekey):
+  nmclient_connpoollock.acquire()
+  try:
+    idlelist = nmclient_connpool.pop(nodekey, [])
+  finally:
+    nmclient_connpoollock.release()
+  for (connobject, idlesince) in idlelist:
+    _nmclient_closeconn(connobject)
 
-# Sends data to a node (opens the connection, writes the 
-# communication header, sends all the data, receives the result, and returns
-# the result)...
-def nmclient_signedcommunicate(nmhandle, *args):
+
+
+# public.   Closes the pooled connections to the handle's node, or to every
+# node if nmhandle is None
+def nmclient_closeconnections(nmhandle=None):
+  if nmhandle is None:
+    nodekeys = nmclient_connpool.keys()
+  else:
+    nodekeys = [_nmclient_nodekey(nmhandle)]
+  for nodekey in nodekeys:
+    _nmclient_dropconns(nodekey)
+
+
+
+# Sends each message in messagelist to the node, then reads a response for
+# each, and returns the responses.   With keep-alive the messages all go
+# down one connection, which goes back to the pool afterwards.   A
+# connection from the pool that fails before we get any response is
+# replaced with a fresh one and the messages sent again, and a node that
+# stops answering after the first message is marked as not supporting
+# keep-alive and sent the rest one connection at a time.   errorlabel is
+# used to label exceptions.
+def _nmclient_exchange(nmhandle, messagelist, errorlabel=None):
+
+  responselist = []
+  while len(responselist) < len(messagelist):
+    pending = messagelist[len(responselist):]
+    if not _nmclient_usekeepalive(nmhandle):
+      # one message per connection, as the node manager expects
+      pending = pending[:1]
+
+    (thisconnobject, reused) = _nmclient_getconn(nmhandle)
+    received = 0
+    try:
+      try:
+        for message in pending:
+          session_sendmessage(thisconnobject, message)
+      except Exception, e:
+        if reused:
+          continue
+        if errorlabel:
+          raise NMClientException, errorlabel+" failed on session_sendmessage with error '"+str(e)+"'"
+        raise NMClientException, str(e)
+
+      try:
+        for message in pending:
+          responselist.append(session_recvmessage(thisconnobject))
+          received = received + 1
+      except Exception, e:
+        if received == 0 and reused:
+          continue
+        if received > 0 and isinstance(e, SessionEOF):
+          # answered one and hung up, this node manager doesn't keep alive
+          nmclient_nokeepalive[_nmclient_nodekey(nmhandle)] = True
+          continue
+        if errorlabel:
+          raise NMClientException, errorlabel+" failed on session_recvmessage with error '"+str(e)+"'"
+        raise NMClientException, str(e)
+
+    finally:
+      if received == len(pending):
+        _nmclient_putconn(nmhandle, thisconnobject)
+      else:
+        _nmclient_closeconn(thisconnobject)
+
+  return responselist
+
+
+
+# Sends data to a node (gets a connection, writes the communication header,
+# sends all the data, receives the result, and returns the result)...
+def nmclient_rawcommunicate(nmhandle, *args):
+  # send the args separated by '|' chars (as is expected by the node manager)
+  return _nmclient_exchange(nmhandle, ['|'.join(args)])[0]
+
+
+
+# Signs a request to the node (a list of args as passed to nmclient_signedsay)
+def _nmclient_signrequest(nmhandle, args):
+  return _nmclient_signrequests(nmhandle, [args])[0]
+
+
+
+# Signs each list of args in requestlist as _nmclient_signrequest would, all
+# with the handle's keys and the same timestamp so they can be signed as one
+# batch.
+def _nmclient_signrequests(nmhandle, requestlist):
   
   # need to check lots of the nmhandle settings...
 
@@ -162,54 +344,31 @@ def nmclient_signedcommunicate(nmhandle, *args):
   identity = nmclient_handledict[nmhandle]['identity']
 
 
-  # build the data to send.   Ideally we'd do: datatosend = '|'.join(args)
-  # we can't do this because some args may be non-strings...
-  datatosend = args[0]
-  for arg in args[1:]:
-    datatosend = datatosend + '|' + str(arg)
+  signinglist = []
+  for args in requestlist:
+    # build the data to send.   Ideally we'd do: datatosend = '|'.join(args)
+    # we can't do this because some args may be non-strings...
+    datatosend = args[0]
+    for arg in args[1:]:
+      datatosend = datatosend + '|' + str(arg)
+
+    signinglist.append((datatosend, timestamp, expirationtime, sequenceid, identity))
   
 
-  # Sign first before opening the connection to prevent connections from idling
   try:
-    signeddata = fastsigneddata.signeddata_signdata(datatosend, privatekey, publickey, timestamp, expirationtime, sequenceid, identity)
+    return fastsigneddata.signeddata_signdata_many(signinglist, privatekey, publickey)
   except ValueError, e:
     raise NMClientException, str(e)
 
 
-  # the node is behind a nat
-  if 'natlayermac' in nmclient_handledict[nmhandle]:
-    try:
-      # add 5 to timeout for nat delay
-      thisconnobject = nat_openconn(nmclient_handledict[nmhandle]['natlayermac'], nmclient_handledict[nmhandle]['port'],timeout=nmclient_handledict[nmhandle]['timeout']+5,usetimeoutsock=True) 
-    except Exception, e:
-      raise NMClientException, str(e)
-  
-  # not a natlayer conn
-  else:  
 
-    try:
-      thisconnobject = timeout_openconn(nmclient_handledict[nmhandle]['IP'], nmclient_handledict[nmhandle]['port'], timeout=nmclient_handledict[nmhandle]['timeout'])
-    except Exception, e:
-      raise NMClientException, str(e)
-
-  
-  # always close the connobject afterwards...
-  try:
-    try:
-      session_sendmessage(thisconnobject, signeddata)
-    except Exception, e:
-      # label the exception and change the type...
-      raise NMClientException, "signedcommunicate failed on session_sendmessage with error '"+str(e)+"'"
 
-    try:
-      message = session_recvmessage(thisconnobject)
-    except Exception, e:
-      # label the exception and change the type...
-      raise NMClientException, "signedcommunicate failed on session_recvmessage with error '"+str(e)+"'"
-
-    return message
-  finally:
-    thisconnobject.close()
+# Sends data to a node (gets a connection, writes the communication header,
+# sends all the data, receives the result, and returns the result)...
+def nmclient_signedcommunicate(nmhandle, *args):
+  # Sign first before getting the connection to prevent connections from idling
+  signeddata = _nmclient_signrequest(nmhandle, args)
+  return _nmclient_exchange(nmhandle, [signeddata], "signedcommunicate")[0]
 
 
 
@@ -240,8 +399,9 @@ def nmclient_safelygethandle():
 # specified elsewhere.   Regardless, the keys and vesselid are not used to 
 # create the handle and so are merely transfered to the created handle.
 # Per #537, the default timeout (15) should be greater than the wait period 
-# for starting a vessel.
-def nmclient_createhandle(nmIP, nmport, sequenceid = None, timestamp=True, identity = True, expirationtime = 60*60, publickey = None, privatekey = None, vesselid = None, timeout=15):
+# for starting a vessel.   keepalive lets the handle reuse connections (see
+# the keep-alive notes above).
+def nmclient_createhandle(nmIP, nmport, sequenceid = None, timestamp=True, identity = True, expirationtime = 60*60, publickey = None, privatekey = None, vesselid = None, timeout=15, keepalive=False):
 
   thisentry = {}
 
@@ -260,6 +420,7 @@ def nmclient_createhandle(nmIP, nmport, sequenceid = None, timestamp=True, ident
   thisentry['privatekey'] = privatekey
   thisentry['vesselid'] = vesselid
   thisentry['timeout'] = timeout
+  thisentry['keepalive'] = keepalive
 
     
   newhandle = nmclient_safelygethandle()
@@ -349,6 +510,13 @@ def nmclient_rawsay(nmhandle, *args):
 def nmclient_signedsay(nmhandle, *args):
 
   fullresponse = nmclient_signedcommunicate(nmhandle, *args)
+  return _nmclient_checkresponse(fullresponse)
+
+
+
+# Splits the status off a node manager's response, raising if it isn't
+# Success
+def _nmclient_checkresponse(fullresponse):
 
   try:
     (response, status) = fullresponse.rsplit('\n',1)
@@ -366,6 +534,21 @@ def nmclient_signedsay(nmhandle, *args):
   
 
 
+# Public:  Sends several signed requests, each a list of args as would be
+# passed to nmclient_signedsay, down one connection if the node allows it.
+# Returns the list of responses, raising on the first one that failed.
+def nmclient_signedsay_many(nmhandle, requestlist):
+
+  # Large batches are signed by fastsigneddata's signing pool, if started
+  signeddatalist = _nmclient_signrequests(nmhandle, requestlist)
+
+  responselist = []
+  for fullresponse in _nmclient_exchange(nmhandle, signeddatalist, "signedcommunicate"):
+    responselist.append(_nmclient_checkresponse(fullresponse))
+  return responselist
+
+
+
 # public, use this to do raw communication with a vessel
 def nmclient_rawsaytovessel(nmhandle, call, *args):
   vesselid = nmclient_handledict[nmhandle]['vesselid']
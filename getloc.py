@@ -1,5 +1,14 @@
 
 import socket
+import httplib
+import json
+import struct
+import bisect
+import csv
+import shelve
+import time
+import threading
+from collections import OrderedDict
 
 # server used to get lat/long from ip addr
 LOC_HOST = {\
@@ -17,57 +26,187 @@ LOC_HOST = {\
 # size of chunk to read from socket
 READ_SIZE = 4096
 
+# connections kept open to each geolocation server, and how long we give
+#  it to answer
+MAX_CONNS = 4
+HTTP_TIMEOUT = 10
+
+# seconds a cached location stays good for
+CACHE_TTL = 7 * 24 * 60 * 60
+
+# number of locations the in memory cache holds
+LRU_SIZE = 4096
+
 
 # Continuously try to read from the socket until
 #  either no more data is present, or the conn is closed
 def recv_data(sock):
 
-   data = ""
+   chunks = []
    try:	
       chunk = sock.recv(READ_SIZE)
       while (chunk != ""):
-         data += chunk
+         chunks.append(chunk)
          chunk = sock.recv(READ_SIZE)
 			
    except Exception, e:
       if "Socket closed" not in str(e):
          raise
 		
-   return data
+   return "".join(chunks)
 
 
-# Gets the lat/long from an ip addr by sending an http request to 
-#  a geolocation server, Returns the lat and long 
-def get_location(ip=None, server=LOC_HOST):
-
-   if ip is None:
-      ip_req = ""
-   else:
-      ip_req = "?ip=" + ip
+# Pulls the location fields we care about out of a server's json reply
+def parse_location(body, server=LOC_HOST):
 
+   reply = json.loads(body)
    loc = {}
+   for key in ['city', 'region', 'country']:
+      value = reply.get(server[key + '_field'])
+      if value:
+         loc[key] = value.encode('utf-8') if isinstance(value, unicode) else str(value)
+   return loc
+
+
+# Looks ips up on a geolocation server, reusing a few keep-alive HTTP/1.1
+#  connections rather than connecting for every ip. lookup_many spreads a
+#  batch of ips over those connections
+class locclient():
+
+   def __init__(self, server=LOC_HOST, maxconns=MAX_CONNS, timeout=HTTP_TIMEOUT):
+
+      self.server = server
+      self.maxconns = maxconns
+      self.timeout = timeout
+
+      # idle connections, and a count of the ones anyone may use
+      self.idle = []
+      self.lock = threading.Lock()
+      self.slots = threading.Semaphore(maxconns)
+
+
+   def _getconn(self):
+      self.slots.acquire()
+      self.lock.acquire()
+      try:
+         if self.idle:
+            return self.idle.pop()
+      finally:
+         self.lock.release()
+      return httplib.HTTPConnection(self.server['name'], self.server['port'], timeout=self.timeout)
+
+
+   def _putconn(self, conn):
+      if conn is not None:
+         self.lock.acquire()
+         self.idle.append(conn)
+         self.lock.release()
+      self.slots.release()
+
+
+   def _request(self, conn, ip):
+      path = self.server['page']
+      if ip is not None:
+         path += "?ip=" + ip
+      conn.request("GET", path)
+      resp = conn.getresponse()
+      # always read the body, the connection can't be reused otherwise
+      body = resp.read()
+      if resp.status != 200:
+         raise httplib.HTTPException("%s %s" % (resp.status, resp.reason))
+      return body, resp.will_close
+
+
+   # Returns the location of ip (or of us if ip is None), {} on failure
+   def lookup(self, ip=None):
+
+      conn = self._getconn()
+      loc = {}
+      try:
+         try:
+            try:
+               body, closing = self._request(conn, ip)
+            except (httplib.HTTPException, socket.error):
+               # the server may have dropped an idle connection, try once
+               #  more on a fresh one
+               conn.close()
+               conn = httplib.HTTPConnection(self.server['name'], self.server['port'], timeout=self.timeout)
+               body, closing = self._request(conn, ip)
+            if closing:
+               conn.close()
+               conn = None
+            loc = parse_location(body, self.server)
+         except Exception, e:
+            print "error getting location!", type(e), str(e)
+            conn.close()
+            conn = None
+      finally:
+         self._putconn(conn)
+
+      return loc
+
+   __call__ = lookup
+
+
+   # Looks up every ip in ips, returns a dict of ip: loc
+   def lookup_many(self, ips):
+
+      pending = list(set(ips))
+      results = {}
+      lock = threading.Lock()
+
+      def worker():
+         while True:
+            lock.acquire()
+            try:
+               if not pending:
+                  return
+               ip = pending.pop()
+            finally:
+               lock.release()
+            loc = self.lookup(ip)
+            lock.acquire()
+            results[ip] = loc
+            lock.release()
+
+      threads = [threading.Thread(target=worker) for i in range(min(self.maxconns, len(pending)))]
+      for thread in threads:
+         thread.start()
+      for thread in threads:
+         thread.join()
+
+      return results
+
+
+   def close(self):
+      self.lock.acquire()
+      try:
+         for conn in self.idle:
+            conn.close()
+         self.idle = []
+      finally:
+         self.lock.release()
+
+
+# one client per server for get_location
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+# Gets the location of an ip addr (or ours if ip is None) from a
+#  geolocation server, Returns a dict of city, region and country
+def get_location(ip=None, server=LOC_HOST):
+
+   key = (server['name'], server['port'], server['page'])
+   _clients_lock.acquire()
    try:
-      sock = socket.create_connection((server['name'], server['port']))
-  
-      http_req = "GET " + server['page'] + ip_req + " HTTP/1.0\r\n\r\n"
-      sock.send(http_req)
-
-      html = recv_data(sock)
-      sock.close()
-
-      fields = html.split(',')
-      for field in fields:
-         if server['city_field'] in field:
-            loc['city'] = field.split(':')[1]
-         elif server['region_field'] in field:
-            loc['region'] = field.split(':')[1]
-         elif server['country_field'] in field:
-            loc['country'] = field.split(':')[1]
-      
-   except Exception, e:
-      print "error getting location!", type(e), str(e)
+      if key not in _clients:
+         _clients[key] = locclient(server)
+      client = _clients[key]
+   finally:
+      _clients_lock.release()
 
-   return loc
+   return client.lookup(ip)
 
 
 def stringify_location(loc):
@@ -88,3 +227,221 @@ def stringify_location(loc):
 
     return s
 
+
+
+# Turns a dotted quad into an int so addresses can be compared
+def ip_to_int(ip):
+   return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+# Offline backend, looks ips up in a table of address ranges loaded from a
+#  csv file of start,end,city,region,country rows. start and end are either
+#  dotted quads or integers, lines starting with # are skipped. Ranges must
+#  not overlap. Returns {} for addresses the table doesn't cover
+class iprangedb():
+
+   def __init__(self, path):
+
+      rows = []
+      csvfile = open(path, 'rb')
+      try:
+         for row in csv.reader(csvfile):
+            if not row or row[0].startswith('#'):
+               continue
+            start, end = [self._toint(field.strip()) for field in row[:2]]
+            loc = {}
+            for key, value in zip(['city', 'region', 'country'], row[2:5]):
+               if value.strip():
+                  loc[key] = value.strip()
+            rows.append((start, end, loc))
+      finally:
+         csvfile.close()
+
+      rows.sort()
+      self.starts = [row[0] for row in rows]
+      self.ends = [row[1] for row in rows]
+      self.locs = [row[2] for row in rows]
+
+
+   def _toint(self, field):
+      if '.' in field:
+         return ip_to_int(field)
+      return int(field)
+
+
+   def __call__(self, ip):
+      ipnum = ip_to_int(ip)
+      index = bisect.bisect_right(self.starts, ipnum) - 1
+      if index >= 0 and ipnum <= self.ends[index]:
+         return dict(self.locs[index])
+      return {}
+
+
+# Sits in front of a backend (get_location, an iprangedb, or anything else
+#  taking an ip and returning a location dict) and remembers its answers,
+#  in memory and, given a cachefile, on disk across runs. Concurrent
+#  lookups of the same ip wait for a single backend query
+class locator():
+
+   def __init__(self, backend=None, cachefile=None, ttl=CACHE_TTL, cachesize=LRU_SIZE):
+
+      if backend is None:
+         backend = locclient()
+      self.backend = backend
+      self.ttl = ttl
+      self.cachesize = cachesize
+
+      # ip -> (time looked up, loc), least recently used first
+      self.memory = OrderedDict()
+      self.lock = threading.Lock()
+
+      self.disk = None
+      if cachefile is not None:
+         self.disk = shelve.open(cachefile)
+
+      # ip -> [event, loc] for lookups underway
+      self.inflight = {}
+
+
+   def lookup(self, ip):
+
+      self.lock.acquire()
+      try:
+         loc = self._cached(ip)
+         if loc is not None:
+            return loc
+
+         # someone is already asking about this ip, wait for their answer
+         if ip in self.inflight:
+            waiter = self.inflight[ip]
+            self.lock.release()
+            try:
+               waiter[0].wait()
+            finally:
+               self.lock.acquire()
+            return dict(waiter[1])
+
+         waiter = [threading.Event(), {}]
+         self.inflight[ip] = waiter
+      finally:
+         self.lock.release()
+
+      loc = {}
+      try:
+         loc = self.backend(ip)
+      finally:
+         self.lock.acquire()
+         # failed lookups come back empty, don't hang on to those
+         if loc:
+            self._remember(ip, loc)
+         waiter[1] = loc
+         del self.inflight[ip]
+         self.lock.release()
+         waiter[0].set()
+
+      return dict(loc)
+
+
+   # Looks up a batch of ips, returns a dict of ip: loc. Ips nobody else
+   #  is looking up go to the backend together, in one lookup_many call if
+   #  it has one
+   def lookup_many(self, ips):
+
+      results = {}
+      mine = {}
+      theirs = {}
+
+      self.lock.acquire()
+      try:
+         for ip in set(ips):
+            loc = self._cached(ip)
+            if loc is not None:
+               results[ip] = loc
+            elif ip in self.inflight:
+               theirs[ip] = self.inflight[ip]
+            else:
+               mine[ip] = [threading.Event(), {}]
+               self.inflight[ip] = mine[ip]
+      finally:
+         self.lock.release()
+
+      found = {}
+      try:
+         if mine:
+            if hasattr(self.backend, 'lookup_many'):
+               found = self.backend.lookup_many(mine.keys())
+            else:
+               for ip in mine:
+                  found[ip] = self.backend(ip)
+      finally:
+         self.lock.acquire()
+         for ip, waiter in mine.items():
+            loc = found.get(ip, {})
+            if loc:
+               self._remember(ip, loc)
+            waiter[1] = loc
+            del self.inflight[ip]
+         self.lock.release()
+         for waiter in mine.values():
+            waiter[0].set()
+
+      for ip in mine:
+         results[ip] = dict(mine[ip][1])
+      for ip, waiter in theirs.items():
+         waiter[0].wait()
+         results[ip] = dict(waiter[1])
+
+      return results
+
+
+   # Looks in memory then on disk, must hold the lock
+   def _cached(self, ip):
+
+      now = time.time()
+
+      if ip in self.memory:
+         stamp, loc = self.memory.pop(ip)
+         if now - stamp < self.ttl:
+            self.memory[ip] = (stamp, loc)
+            return dict(loc)
+
+      if self.disk is not None and ip in self.disk:
+         stamp, loc = self.disk[ip]
+         if now - stamp < self.ttl:
+            self._remember(ip, loc, stamp, todisk=False)
+            return dict(loc)
+         del self.disk[ip]
+
+      return None
+
+
+   def _remember(self, ip, loc, stamp=None, todisk=True):
+      if stamp is None:
+         stamp = time.time()
+      self.memory.pop(ip, None)
+      self.memory[ip] = (stamp, loc)
+      while len(self.memory) > self.cachesize:
+         self.memory.popitem(last=False)
+      if todisk and self.disk is not None:
+         self.disk[ip] = (stamp, loc)
+
+
+   def sync(self):
+      self.lock.acquire()
+      try:
+         if self.disk is not None:
+            self.disk.sync()
+      finally:
+         self.lock.release()
+
+
+   def close(self):
+      self.lock.acquire()
+      try:
+         if hasattr(self.backend, 'close'):
+            self.backend.close()
+         if self.disk is not None:
+            self.disk.close()
+            self.disk = None
+      finally:
+         self.lock.release()
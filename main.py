@@ -5,7 +5,16 @@ import difflib
 import select
 import os
 import threading
+import time
+import errno
+import struct
+import zlib
+import Queue
+import cStringIO
+import collections
 import getloc
+import pagestore
+import pagediff
 
 # this aint workin!
 #
@@ -20,13 +29,100 @@ import getloc
 import overlord
 
 # constants
-MAX_LISTEN_QUEUE = 10
+# thousands of vessels may report at once, keep the accept backlog deep
+MAX_LISTEN_QUEUE = socket.SOMAXCONN
 READ_SIZE = 4096
 
+# bounds for the adaptive reads used when receiving message bodies
+MIN_READ_SIZE = 4096
+MAX_READ_SIZE = 1024 * 1024
+
 VPT_LHEADER = 'vpts{'
 VPT_RHEADER = '}vpts'
 VPT_FIELDSEP = '='
 
+# binary framing. A vessel that speaks it says HELLO as soon as it connects
+#  and we answer with our own HELLO. The header is VPT_MAGIC followed by
+#  version, message type, flags, body length and a checksum of those fields
+VPT_MAGIC = '\x89vpt'
+VPT_VERSION = 1
+VPT_BHEADER_FORMAT = '!4sBBHII'
+VPT_BHEADER_SIZE = struct.calcsize(VPT_BHEADER_FORMAT)
+
+VPT_MSG_HELLO = 1
+VPT_MSG_URL = 2
+VPT_MSG_PAGE = 3
+# a vessel couldn't fetch a url, the body says why
+VPT_MSG_ERROR = 4
+# no more urls, sent to vessels that pipeline
+VPT_MSG_BYE = 5
+
+VPT_PROTO_TEXT = 'text'
+VPT_PROTO_BINARY = 'binary'
+
+# seconds to wait for a vessel's HELLO before falling back to the text header
+VPT_HELLO_WAIT = 2.0
+
+# frame flags. In a HELLO they say what the sender can do, the collector
+#  answers with the ones both sides share. On any other frame they describe
+#  the body, VPT_FLAG_ZLIB meaning it is a zlib stream
+VPT_FLAG_ZLIB = 0x1
+# in a HELLO, the vessel will take any number of urls over the connection
+#  and answer them in order
+VPT_FLAG_PIPELINE = 0x2
+VPT_CAPABILITIES = VPT_FLAG_ZLIB | VPT_FLAG_PIPELINE
+
+# most urls a vessel is sent ahead of the pages it has returned
+PIPELINE_DEPTH = 4
+
+# zlib level for messages we compress, and the smallest body worth it
+VPT_COMPRESS_LEVEL = 6
+VPT_COMPRESS_MIN = 512
+
+# most bytes a compressed page is inflated by in one step, so however much
+#  a piece expands it is accounted for a step at a time
+INFLATE_STEP = 256 * 1024
+
+# longest header we will buffer before deciding a peer is talking garbage
+MAX_HEADER_SIZE = 256
+
+# use the single poll loop collector instead of a thread per vessel
+EVENT_COLLECTOR = True
+
+# number of threads the event collector keeps for post processing pages
+#  (location lookup, diffing), independent of the number of vessels
+POSTPROCESS_WORKERS = 4
+
+# seconds a vessel may go without sending us anything before we drop it
+CONN_IDLE_TIMEOUT = 120
+
+# how often (in seconds) the collector loop wakes to look for idle vessels
+#  and ones that never said HELLO
+COLLECTOR_TICK = 0.5
+
+# bytes of distinct pages to hold in memory, and where pages go once that
+#  fills up (None keeps everything in memory)
+PAGESTORE_MEMORY = pagestore.DEFAULT_MAX_MEMORY
+PAGESTORE_SPILLDIR = None
+
+# where vessel locations are remembered between runs (None to not), and an
+#  optional csv of ip ranges to look them up in instead of asking geoplugin
+GEOCACHE_FILE = 'geocache'
+GEODB_FILE = None
+
+# most vessels we talk to at once, past this new connections wait in the
+#  listen backlog
+MAX_ACTIVE_VESSELS = 256
+
+# bytes of page data we let pile up between reading it off vessels and
+#  handing it to the page store. Once it runs out the collector stops
+#  accepting vessels and starting new pages until the workers catch up
+INFLIGHT_BYTE_BUDGET = 256 * 1024 * 1024
+
+# how many finished pages a post processing worker takes at once, so their
+#  vessels' locations can be looked up together
+LOCATE_BATCH = 16
+
 
 # globals
 threadlist = []
@@ -38,10 +134,31 @@ connlist_lock = threading.Lock()
 vptlist = []
 vptlist_lock = threading.Lock()
 
+# (url, vessel ip, vessel port) -> viewpoint, and -> why we have none
+#  (also under vptlist_lock). A url has one or the other, whichever came
+#  last. The port tells apart vessels sharing an ip (on one node or behind
+#  one NAT)
+vptresults = {}
+vptfailures = {}
+
+# bounds the thread per vessel path the same way
+connthread_slots = threading.BoundedSemaphore(MAX_ACTIVE_VESSELS)
+
 # dict of location: viewpoint[]
 locations = {}
 locations_lock = threading.Lock()
 
+# every page body we have, viewpoints only keep its hash
+pages = pagestore.pagestore(PAGESTORE_MEMORY, PAGESTORE_SPILLDIR)
+
+# diffs pages out of the store, remembering what it has already compared
+differ = pagediff.diffengine(pages)
+
+# finds where vessels are, opened by getgeolocator() the first time it is
+#  needed so importing us doesn't create the cache files
+geolocator = None
+geolocator_lock = threading.Lock()
+
 
 
 class ViewpointException(Exception):
@@ -50,16 +167,110 @@ class ViewpointException(Exception):
 
 
 
+class bytebudget():
+    """ Counts bytes of page data held in memory against a limit. One page
+    may take us past it, otherwise a page bigger than the whole budget
+    could never be read """
+
+    def __init__(self, limit=INFLIGHT_BYTE_BUDGET):
+        assert limit > 0, "Invalid byte budget"
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def charge(self, nbytes):
+        self.lock.acquire()
+        self.used += nbytes
+        self.peak = max(self.peak, self.used)
+        self.lock.release()
+
+    def release(self, nbytes):
+        self.lock.acquire()
+        self.used -= nbytes
+        self.lock.release()
+
+    def exhausted(self):
+        return self.used >= self.limit
+
+
+
+class collectorstats():
+    """ What the collector's flow control has been up to """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.peakqueued = 0
+        self.dequeued = 0
+        self.queuewait = 0.0
+        self.peakqueuewait = 0.0
+        self.pauses = 0
+        self.pausedtime = 0.0
+        self.pausedsince = None
+
+    def enqueue(self):
+        self.lock.acquire()
+        self.queued += 1
+        self.peakqueued = max(self.peakqueued, self.queued)
+        self.lock.release()
+
+    def dequeue(self, waited):
+        """ waited is how long the page sat in the work queue """
+        self.lock.acquire()
+        self.queued -= 1
+        self.dequeued += 1
+        self.queuewait += waited
+        self.peakqueuewait = max(self.peakqueuewait, waited)
+        self.lock.release()
+
+    def pause(self):
+        if self.pausedsince is None:
+            self.pauses += 1
+            self.pausedsince = time.time()
+
+    def resume(self):
+        if self.pausedsince is not None:
+            self.pausedtime += time.time() - self.pausedsince
+            self.pausedsince = None
+
+    def report(self, budget=None):
+        self.resume()
+        print "work queue: %s pages now, %s at most" % (self.queued, self.peakqueued)
+        if self.dequeued:
+            print "queue wait: %.3fs average, %.3fs at most" % \
+                (self.queuewait / self.dequeued, self.peakqueuewait)
+        print "paused %s times for %.3fs in all" % (self.pauses, self.pausedtime)
+        if budget is not None:
+            print "in flight: %s bytes at most of a %s byte budget" % (budget.peak, budget.limit)
+
+
+
 class viewpoint():
 
-    def __init__(self, url, ip, location, page):
+    def __init__(self, url, ip, location, page, store=None, port=None):
         self.url = url
-        self.page = page
         self.ip = ip
+        self.port = port
         self.location = location
+        if store is None:
+            store = pages
+        self.store = store
+        self.pagehash = store.add(page)
+
+    def getpage(self):
+        return self.store.get(self.pagehash)
+
+    def release(self):
+        """ Gives up our reference to the page, call before discarding """
+        if self.pagehash is not None:
+            self.store.release(self.pagehash)
+            self.pagehash = None
 
     def compute_diff(self, other_vpt):
-        None
+        """ Returns a list of (tag, removed, added) changes going from our
+        page to other_vpt's, empty if they saw the same thing """
+        return differ.diff(self.pagehash, other_vpt.pagehash)
 
 
 
@@ -74,6 +285,11 @@ class connection():
         self.ip = ip
         self.port = port
 
+        # what framing we talk to this vessel with, see negotiate()
+        self.proto = VPT_PROTO_TEXT
+        self.version = None
+        self.flags = 0
+
 
     def __del__(self):
         self.socket.close()
@@ -83,38 +299,110 @@ class connection():
 
 
 
+def _headerchecksum(version, msgtype, flags, length):
+    return zlib.adler32(struct.pack('!BBHI', version, msgtype, flags, length)) & 0xffffffff
+
+
+
+def packheader(msgtype, length, flags=0, version=VPT_VERSION):
+    """ Builds a binary frame header """
+    return struct.pack(VPT_BHEADER_FORMAT, VPT_MAGIC, version, msgtype, flags,
+                       length, _headerchecksum(version, msgtype, flags, length))
+
+
+
+def unpackheader(head):
+    """ Returns (version, msgtype, flags, length) from a binary frame header """
+
+    assert len(head) == VPT_BHEADER_SIZE
+
+    magic, version, msgtype, flags, length, checksum = struct.unpack(VPT_BHEADER_FORMAT, head)
+    if magic != VPT_MAGIC:
+        raise ViewpointException("Bad magic in message header")
+    if checksum != _headerchecksum(version, msgtype, flags, length):
+        raise ViewpointException("Corrupt message header")
+    if version > VPT_VERSION:
+        raise ViewpointException("Unsupported protocol version %s" % (version))
+
+    return version, msgtype, flags, length
+
+
+
+def _textheader(length):
+    return VPT_LHEADER+"length="+str(length)+VPT_RHEADER
+
+
+
 def _sendmsg(sockobj, msg):
     """ """
-    tosend = len(msg)
-    totbytes = 0
-    while len(msg) > 0:
-       bytessent = sockobj.send(msg)
-       msg = msg[bytessent:]   
-       totbytes += bytessent
+    sockobj.sendall(msg)
 
-    assert totbytes == tosend
 
 
-def _sendheader(sockobj, length):
-    """ """
-    msg = VPT_LHEADER+"length="+str(length)+VPT_RHEADER
-    _sendmsg(sockobj, msg)
+def sendmsg(sockobj, msg, proto=VPT_PROTO_TEXT, msgtype=VPT_MSG_URL, flags=0, level=0):
+    """ Frames msg and sends header and body in one write. A non zero level
+    zlib compresses the body, only do that for peers whose HELLO had
+    VPT_FLAG_ZLIB in it """
 
+    if proto == VPT_PROTO_BINARY:
+        if level and len(msg) >= VPT_COMPRESS_MIN:
+            msg = zlib.compress(msg, level)
+            flags |= VPT_FLAG_ZLIB
+        header = packheader(msgtype, len(msg), flags)
+    else:
+        header = _textheader(len(msg))
 
+    # python 2 sockets have no sendmsg to gather with, joining costs a
+    #  single copy and saves a syscall per message
+    _sendmsg(sockobj, header + msg)
 
-def sendmsg(sockobj, msg):
-    """ """
-    _sendheader(sockobj, len(msg))
-    _sendmsg(sockobj, msg)
-   
 
 
-def readheader(sock):
+def _recvexactly(sock, toread):
+    data = ""
+    while len(data) < toread:
+        chunk = sock.recv(toread - len(data))
+        if not chunk:
+            raise ViewpointException("Connection closed mid message")
+        data += chunk
+    return data
+
+
+
+def negotiate(conn, wait=VPT_HELLO_WAIT):
+    """ Picks the framing for a freshly accepted vessel. Vessels that speak
+    the binary framing say HELLO straight away, anyone that stays quiet for
+    wait seconds gets the text header """
+
+    if not select.select([conn.socket], [], [], wait)[0]:
+        conn.proto = VPT_PROTO_TEXT
+        return conn.proto
+
+    version, msgtype, flags, length = unpackheader(_recvexactly(conn.socket, VPT_BHEADER_SIZE))
+    if msgtype != VPT_MSG_HELLO:
+        raise ViewpointException("Expected HELLO, got message type %s" % (msgtype))
+    if length:
+        _recvexactly(conn.socket, length)
+
+    conn.proto = VPT_PROTO_BINARY
+    conn.version = min(version, VPT_VERSION)
+    conn.flags = flags & VPT_CAPABILITIES
+    _sendmsg(conn.socket, packheader(VPT_MSG_HELLO, 0, conn.flags, conn.version))
+
+    return conn.proto
+
 
-    chunk = sock.recv(READ_SIZE)
-    head = chunk
-    # loop until we have the left and right portions of the header
-    while VPT_RHEADER not in head and VPT_LHEADER not in head and len(chunk) > 0:
+
+def readheader(sock, head=""):
+
+    # loop until we have the right portion of the header. Only the bytes
+    #  that arrived since the last pass (plus enough overlap to catch a
+    #  split marker) are searched
+    searchfrom = 0
+    chunk = " " # junk so we can treat below as a do while
+    while head.find(VPT_RHEADER, searchfrom) < 0 and len(chunk) > 0 \
+            and len(head) <= MAX_HEADER_SIZE:
+        searchfrom = max(0, len(head) - len(VPT_RHEADER) + 1)
         chunk = sock.recv(READ_SIZE)
         head += chunk
 
@@ -122,60 +410,328 @@ def readheader(sock):
 
 
 
-def recvmsg(sock):
+def _nextreadsize(readsize, requested, got):
+    """ Grow reads while the socket keeps filling them, shrink when it
+    can't keep up, so slow vessels don't get huge idle buffers """
+
+    if got == requested:
+        return min(readsize * 2, MAX_READ_SIZE)
+    if got < requested / 2:
+        return max(readsize / 2, MIN_READ_SIZE)
+    return readsize
 
-    assert isinstance(sock, socket.socket)
 
-    chunk = readheader(sock)
-    headstoppos = chunk.find(VPT_RHEADER) + len(VPT_RHEADER)
-    if headstoppos <= len(VPT_RHEADER):
-        raise ViewpointException("Failed to get header for message")
 
-    head = chunk[:headstoppos]
-    msg = chunk[headstoppos:]
+def parseheader(head):
+    """ Returns the message length advertised in a complete header """
 
     # we want to isolate the value immediately after VPT_FIELDSEP
     #  and immediately before VPT_RHEADER
     try:
-        msglen = int(head.split(VPT_FIELDSEP)[1].split(VPT_RHEADER)[0])
-    except ValueError as e:
+        return int(head.split(VPT_FIELDSEP)[1].split(VPT_RHEADER)[0])
+    except (ValueError, IndexError) as e:
         raise ViewpointException("Failed to read header for message: %s" % (e))
 
-    toread = msglen - (len(chunk) - headstoppos)
-    while toread > 0 and len(chunk) > 0:
-        chunk = sock.recv(READ_SIZE)
-        msg += chunk
-        toread -= len(chunk)
 
-    assert len(msg) == msglen
 
-    return msg
+def _recvbody(sock, msglen, first, callback):
+    """ Reads the rest of a msglen byte body, first is whatever part of it
+    already came in with the header """
+
+    if callback is not None:
+        if first:
+            callback(memoryview(first))
+        # one buffer, reused for every piece of the body
+        buf = bytearray(min(MAX_READ_SIZE, msglen) or 1)
+        view = memoryview(buf)
+        received = len(first)
+        readsize = MIN_READ_SIZE
+        while received < msglen:
+            toread = min(readsize, msglen - received, len(buf))
+            got = sock.recv_into(view, toread)
+            if got == 0:
+                raise ViewpointException("Connection closed mid message")
+            callback(view[:got])
+            received += got
+            readsize = _nextreadsize(readsize, toread, got)
+
+        return msglen
+
+    buf = bytearray(msglen)
+    view = memoryview(buf)
+    view[:len(first)] = first
+    received = len(first)
+    readsize = MIN_READ_SIZE
+    while received < msglen:
+        toread = min(readsize, msglen - received)
+        got = sock.recv_into(view[received:], toread)
+        if got == 0:
+            raise ViewpointException("Connection closed mid message")
+        received += got
+        readsize = _nextreadsize(readsize, toread, got)
+
+    return str(buf)
+
+
+
+def _inflatesteps(inflater, data):
+    """ Yields what data inflates to, at most INFLATE_STEP bytes at a time,
+    so each step can be dealt with before the next is made """
+
+    while data:
+        yield inflater.decompress(data, INFLATE_STEP)
+        data = inflater.unconsumed_tail
+
+
+
+def _recvcompressed(sock, msglen, callback):
+    """ Reads a zlib body, inflating each piece as it arrives so we never
+    hold the whole compressed body and the expanded page at once """
+
+    inflater = zlib.decompressobj()
+    body = cStringIO.StringIO()
+    expanded = [0]
+
+    def deliver(out):
+        expanded[0] += len(out)
+        if callback is None:
+            body.write(out)
+        elif out:
+            callback(memoryview(out))
 
+    def inflate(piece):
+        for out in _inflatesteps(inflater, piece.tobytes()):
+            deliver(out)
 
+    _recvbody(sock, msglen, "", inflate)
+    deliver(inflater.flush())
+    if inflater.unused_data:
+        raise ViewpointException("Junk after compressed message")
 
-def get_viewpoint(connection, url):
-    """ Threads start execution here """
+    if callback is not None:
+        return expanded[0]
+    return body.getvalue()
 
+
+
+def recvframe(sock, callback=None):
+    """ Reads one message in either framing and returns (msgtype, flags,
+    body). Text framed messages carry no type so msgtype is None for them.
+
+    The header is parsed once and the body is read straight into a
+    preallocated buffer with recv_into. If callback is given the body is
+    not kept, instead callback is called with a memoryview of each piece as
+    it arrives (copy it if you need it after returning) and the message
+    length is returned in place of the body. Compressed bodies are inflated
+    as they arrive, so callback sees (and the length counts) the expanded
+    page """
+
+    assert isinstance(sock, socket.socket)
+
+    # both headers start with four fixed bytes, which tell them apart
+    prefix = _recvexactly(sock, len(VPT_MAGIC))
+    if prefix == VPT_MAGIC:
+        rest = _recvexactly(sock, VPT_BHEADER_SIZE - len(VPT_MAGIC))
+        version, msgtype, flags, msglen = unpackheader(prefix + rest)
+        if flags & VPT_FLAG_ZLIB and msgtype != VPT_MSG_HELLO:
+            return msgtype, flags, _recvcompressed(sock, msglen, callback)
+        return msgtype, flags, _recvbody(sock, msglen, "", callback)
+
+    chunk = readheader(sock, prefix)
+    headstoppos = chunk.find(VPT_RHEADER) + len(VPT_RHEADER)
+    if headstoppos <= len(VPT_RHEADER):
+        raise ViewpointException("Failed to get header for message")
+
+    msglen = parseheader(chunk[:headstoppos])
+    first = chunk[headstoppos:headstoppos+msglen]
+
+    return None, 0, _recvbody(sock, msglen, first, callback)
+
+
+
+def recvmsg(sock, callback=None):
+    """ Reads one message in either framing, see recvframe """
+    return recvframe(sock, callback)[2]
+
+
+
+def diff_viewpoints(vpts, baseline=None):
+    """ Groups vpts by the page they saw and diffs one page per group
+    against baseline's (by default the page most of them saw). Returns a
+    list of (pagehash, viewpoint[], changes), the baseline group first """
+
+    groups = {}
+    for vpt in vpts:
+        groups.setdefault(vpt.pagehash, []).append(vpt)
+
+    if not groups:
+        return []
+
+    if baseline is None:
+        basehash = max(groups, key=lambda pagehash: len(groups[pagehash]))
+    else:
+        basehash = baseline.pagehash
+
+    changes = differ.diffagainst(basehash, groups.keys())
+
+    results = [(basehash, groups.get(basehash, []), [])]
+    for pagehash in groups:
+        if pagehash != basehash:
+            results.append((pagehash, groups[pagehash], changes[pagehash]))
+    return results
+
+
+
+def _urllist(urls):
+    if isinstance(urls, basestring):
+        return [urls]
+    return list(urls)
+
+
+
+def sweeporder(urls, start):
+    """ urls rotated to begin at start, so vessels spread out over the list
+    instead of all asking for the same url first """
+    start = start % len(urls)
+    return urls[start:] + urls[:start]
+
+
+
+def readurls(args):
+    """ Turns command line arguments into a list of urls, @file reads the
+    urls (one a line, # for comments) from file """
+
+    urls = []
+    for arg in args:
+        if not arg.startswith('@'):
+            urls.append(arg)
+            continue
+        urlfile = open(arg[1:])
+        try:
+            for line in urlfile:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    urls.append(line)
+        finally:
+            urlfile.close()
+    return urls
+
+
+
+def get_viewpoint(connection, urls):
+    """ Threads start execution here. A vessel that can pipeline gets each
+    url in turn over the one connection, others just the first """
+
+    urls = _urllist(urls)
+    done = 0
     try:
-        sendmsg(connection.socket, url)
-        print "sent url %s to %s" % (url, connection.ip)
+        negotiate(connection)
+        pipelining = connection.proto == VPT_PROTO_BINARY and connection.flags & VPT_FLAG_PIPELINE
+        if not pipelining:
+            for url in urls[1:]:
+                record_failure(url, connection.ip, connection.port, "vessel can only fetch one url")
+            urls = urls[:1]
+
+        for url in urls:
+            sendmsg(connection.socket, url, connection.proto, VPT_MSG_URL)
+            print "sent url %s to %s" % (url, connection.ip)
+
+            msgtype, flags, page = recvframe(connection.socket)
+            done += 1
+            if msgtype == VPT_MSG_ERROR:
+                record_failure(url, connection.ip, connection.port, "vessel said: %s" % (page))
+                continue
+            print "recieved %s byte page for %s from %s" % (len(page), url, connection.ip)
+
+            record_viewpoint(url, connection.ip, connection.port, page)
+
+        if pipelining:
+            sendmsg(connection.socket, "", connection.proto, VPT_MSG_BYE)
+
+    except (ViewpointException, socket.error) as e:
+        for url in urls[done:]:
+            record_failure(url, connection.ip, connection.port, str(e))
+
+    finally:
+        connthread_slots.release()
+
+
+
+def getgeolocator():
+    """ Returns the locator, opening it the first time """
+
+    global geolocator
+    if geolocator is None:
+        geolocator_lock.acquire()
+        try:
+            if geolocator is None:
+                if GEODB_FILE is None:
+                    geolocator = getloc.locator(cachefile=GEOCACHE_FILE)
+                else:
+                    geolocator = getloc.locator(getloc.iprangedb(GEODB_FILE), GEOCACHE_FILE)
+        finally:
+            geolocator_lock.release()
+    return geolocator
+
+
+
+def _forget_viewpoint(key):
+    # drops any viewpoint we have for key, must hold vptlist_lock
+    old_vpt = vptresults.pop(key, None)
+    if old_vpt is not None:
+        vptlist.remove(old_vpt)
+        old_vpt.release()
 
-        page = recvmsg(connection.socket)
-        print "recieved %s byte page from %s" % (len(page), connection.ip)
 
-        # get location
-        location = getloc.stringify_location(getloc.get_location(connection.ip))
 
-        vpt = viewpoint(url, connection.ip, location, page)
+def record_viewpoint(url, ip, port, page):
+    """ Looks up where ip is and adds the view of url from the vessel at
+    ip:port to vptlist """
 
-        vptlist_lock.acquire()
-        vptlist.append(vpt)
+    # get location
+    location = getloc.stringify_location(getgeolocator().lookup(ip))
+
+    vpt = viewpoint(url, ip, location, page, port=port)
+
+    vptlist_lock.acquire()
+    # a vessel that sends the same url again replaces its earlier view
+    key = (url, ip, port)
+    _forget_viewpoint(key)
+    vptfailures.pop(key, None)
+    vptlist.append(vpt)
+    vptresults[key] = vpt
+    vptlist_lock.release()
+
+    print "got viewpoint for %s from %s" % (vpt.url, vpt.ip)
+
+    return vpt
+
+
+
+def discard_viewpoints():
+    """ Forgets every viewpoint we have, giving up their pages """
+
+    vptlist_lock.acquire()
+    try:
+        for vpt in vptlist:
+            vpt.release()
+        del vptlist[:]
+        vptresults.clear()
+    finally:
         vptlist_lock.release()
 
-        print "got viewpoint for %s from %s" % (vpt.url, vpt.ip)
 
-    except ViewpointException as e:
-        print "%s: Failed to get viewpoint for %s from %s" % (e, url, connection.ip)
+
+def record_failure(url, ip, port, reason):
+    """ Notes that we won't get the view of url from the vessel at ip:port """
+
+    vptlist_lock.acquire()
+    key = (url, ip, port)
+    _forget_viewpoint(key)
+    vptfailures[key] = reason
+    vptlist_lock.release()
+
+    print "%s: Failed to get viewpoint for %s from %s" % (reason, url, ip)
 
 
 
@@ -250,17 +806,17 @@ def establish_connection(localsock):
 
 
 
-def create_connthread(connection, url):
+def create_connthread(connection, urls):
 
-    assert connection and url
+    assert connection and urls
 
-    newthread = threading.Thread(target=get_viewpoint, args=[connection, url])
+    newthread = threading.Thread(target=get_viewpoint, args=[connection, urls])
 
     threadlist_lock.acquire()
     threadlist.append(newthread)
     threadlist_lock.release()
 
-    print "created %s to get %s from %s" % (newthread.name, url, connection.ip)
+    print "created %s to get %s urls from %s" % (newthread.name, len(_urllist(urls)), connection.ip)
 
     return newthread
 
@@ -275,7 +831,7 @@ def join_all_threads():
         threadlist_lock.release()
 
 
-def wait_for_conn(lsock, url):
+def wait_for_conn(lsock, urls):
     
     assert lsock > 0, "Invalid listening socket"
 
@@ -289,13 +845,561 @@ def wait_for_conn(lsock, url):
                 if 'q\n' in userstr:
                     fin = 1
             elif fd == lsock:
+                # leave vessels in the backlog until a thread frees up
+                connthread_slots.acquire()
                 conn = establish_connection(lsock)
-                newthread = create_connthread(conn, url)
+                newthread = create_connthread(conn, urls)
                 newthread.start()
 
 
+class vptsession():
+    """ Per vessel state for the event collector. We wait briefly for the
+    vessel's HELLO, then send it urls in whatever framing it speaks and
+    build up each framed reply as it trickles in. A vessel that can
+    pipeline is kept up to depth urls ahead and answers them in order, the
+    rest only get the first url """
+
+    def __init__(self, conn, urls, budget=None, depth=PIPELINE_DEPTH):
+        self.conn = conn
+        self.todo = collections.deque(urls)
+        # urls sent whose pages haven't come back yet, oldest first
+        self.outstanding = collections.deque()
+        # urls a vessel that can't pipeline will never get to
+        self.skipped = []
+        self.depth = depth
+        self.budget = budget
+        self.negotiating = True
+        self.outbuf = ""
+        self.head = ""
+        self.toskip = 0
+        # poll events we are registered for
+        self.mask = select.POLLIN
+        self.started = time.time()
+        self.lastactive = self.started
+        self._resetpage()
+
+
+    def _resetpage(self):
+        self.msgtype = None
+        self.msglen = None
+        self.buf = None
+        self.view = None
+        self.received = 0
+        self.readsize = MIN_READ_SIZE
+        # set while reading a compressed page, the page is inflated
+        #  into out
+        self.inflater = None
+        self.out = None
+        # bytes of the budget this page holds
+        self.charged = 0
+
+
+    def pipelining(self):
+        return self.conn.proto == VPT_PROTO_BINARY and self.conn.flags & VPT_FLAG_PIPELINE
+
+
+    def finished(self):
+        return not self.negotiating and not self.todo and not self.outstanding
+
+
+    def textfallback(self):
+        """ The vessel never said HELLO, so it gets the text header """
+        self.conn.proto = VPT_PROTO_TEXT
+        self._negotiated()
+
+
+    def _negotiated(self):
+        self.negotiating = False
+        if not self.pipelining():
+            self.skipped = list(self.todo)[1:]
+            self.todo = collections.deque(list(self.todo)[:1])
+        self._queueurls()
+
+
+    def _queueurls(self):
+        # keeps the vessel depth urls ahead of the pages we have back
+        while self.todo and len(self.outstanding) < self.depth:
+            url = self.todo.popleft()
+            self.outstanding.append(url)
+            if self.conn.proto == VPT_PROTO_BINARY:
+                self.outbuf += packheader(VPT_MSG_URL, len(url), version=self.conn.version) + url
+            else:
+                self.outbuf += _textheader(len(url)) + url
+
+        if self.finished() and self.pipelining():
+            self.outbuf += packheader(VPT_MSG_BYE, 0, version=self.conn.version)
+
+
+    def recv(self):
+        """ Reads what the socket has for us, returns True once a page (or
+        the vessel's error in place of one) is complete. Anything we need
+        to send in response ends up in outbuf """
+
+        if self.negotiating:
+            return self._recvhello()
+
+        if self.msglen is None:
+            if self.conn.proto == VPT_PROTO_BINARY:
+                toread = VPT_BHEADER_SIZE - len(self.head)
+            else:
+                toread = READ_SIZE
+            chunk = self.conn.socket.recv(toread)
+            if not chunk:
+                raise ViewpointException("Connection closed mid message")
+            return self.feed(chunk)
+
+        if self.inflater is not None:
+            return self._recvcompressed()
+
+        toread = min(self.readsize, self.msglen - self.received)
+        got = self.conn.socket.recv_into(self.view[self.received:], toread)
+        if got == 0:
+            raise ViewpointException("Connection closed mid message")
+        self.received += got
+        self.readsize = _nextreadsize(self.readsize, toread, got)
+
+        return self.received >= self.msglen
+
+
+    def _recvcompressed(self):
+        # the buffer is reused for every piece, only the inflated page
+        #  is kept
+        toread = min(self.readsize, self.msglen - self.received, len(self.buf))
+        got = self.conn.socket.recv_into(self.view, toread)
+        if got == 0:
+            raise ViewpointException("Connection closed mid message")
+        self.received += got
+        self.readsize = _nextreadsize(self.readsize, toread, got)
+
+        # a step at a time, each charged before the next is inflated
+        for out in _inflatesteps(self.inflater, self.view[:got].tobytes()):
+            self.charge(len(out))
+            self.out.write(out)
+
+        if self.received < self.msglen:
+            return False
+
+        out = self.inflater.flush()
+        self.charge(len(out))
+        self.out.write(out)
+        if self.inflater.unused_data:
+            raise ViewpointException("Junk after compressed message")
+        return True
+
+
+    def _recvhello(self):
+
+        if self.toskip:
+            # a newer vessel may put something in its HELLO we don't use
+            chunk = self.conn.socket.recv(min(self.toskip, READ_SIZE))
+        else:
+            chunk = self.conn.socket.recv(VPT_BHEADER_SIZE - len(self.head))
+        if not chunk:
+            raise ViewpointException("Connection closed during HELLO")
+
+        if self.toskip:
+            self.toskip -= len(chunk)
+        else:
+            self.head += chunk
+            if len(self.head) < VPT_BHEADER_SIZE:
+                return False
+
+            version, msgtype, flags, length = unpackheader(self.head)
+            if msgtype != VPT_MSG_HELLO:
+                raise ViewpointException("Expected HELLO, got message type %s" % (msgtype))
+            self.head = ""
+            self.toskip = length
+            self.conn.version = min(version, VPT_VERSION)
+            self.conn.flags = flags & VPT_CAPABILITIES
+
+        if not self.toskip:
+            self.conn.proto = VPT_PROTO_BINARY
+            self.outbuf = packheader(VPT_MSG_HELLO, 0, self.conn.flags, self.conn.version)
+            self._negotiated()
+
+        return False
+
+
+    def feed(self, data):
+        """ Takes header bytes, returns True once the page is complete """
+
+        if not self.outstanding:
+            raise ViewpointException("Got a message we didn't ask for")
+
+        self.head += data
+        if self.conn.proto == VPT_PROTO_BINARY:
+            if len(self.head) < VPT_BHEADER_SIZE:
+                return False
+            version, self.msgtype, flags, self.msglen = unpackheader(self.head)
+            if self.msgtype not in (VPT_MSG_PAGE, VPT_MSG_ERROR):
+                raise ViewpointException("Expected a page, got message type %s" % (self.msgtype))
+            self.head = ""
+
+            if flags & VPT_FLAG_ZLIB:
+                self.inflater = zlib.decompressobj()
+                self.out = cStringIO.StringIO()
+                self.buf = bytearray(min(MAX_READ_SIZE, self.msglen) or 1)
+                self.view = memoryview(self.buf)
+                self.charge(len(self.buf))
+                return self.msglen == 0
+            first = ""
+
+        else:
+            # only the header is ever rescanned, and it is tiny
+            headstoppos = self.head.find(VPT_RHEADER)
+            if headstoppos < 0:
+                if len(self.head) > MAX_HEADER_SIZE:
+                    raise ViewpointException("Failed to get header for message")
+                return False
+
+            headstoppos += len(VPT_RHEADER)
+            self.msgtype = VPT_MSG_PAGE
+            self.msglen = parseheader(self.head[:headstoppos])
+            first = self.head[headstoppos:headstoppos+self.msglen]
+
+        self.head = ""
+
+        # the rest of the page is read straight into here
+        self.buf = bytearray(self.msglen)
+        self.view = memoryview(self.buf)
+        self.charge(self.msglen)
+        self.view[:len(first)] = first
+        self.received = len(first)
+
+        return self.received >= self.msglen
+
+
+    def charge(self, nbytes):
+        if self.budget is not None:
+            self.budget.charge(nbytes)
+        self.charged += nbytes
+
+
+    def waitingforpage(self):
+        """ True between pages, the point where we can hold off reading
+        without stranding a buffer """
+        return not self.negotiating and self.msglen is None and not self.head
+
+
+    def takepage(self):
+        """ Hands over the page just completed as (url, msgtype, body,
+        bytes charged to the budget) and asks for the next url """
+
+        if self.inflater is not None:
+            body = self.out.getvalue()
+        else:
+            body = str(self.buf)
+        page = (self.outstanding.popleft(), self.msgtype, body, self.charged)
+
+        self._resetpage()
+        self._queueurls()
+        return page
+
+
+
+def _create_poller():
+    """ epoll where we have it, plain poll otherwise. Also returns what
+    to multiply a timeout in seconds by for that poller """
+
+    if hasattr(select, 'epoll'):
+        return select.epoll(), 1
+    return select.poll(), 1000
+
+
+
+class collector():
+    """ Gathers viewpoints from every vessel over a single poll loop rather
+    than a thread per connection. Finished pages are handed off to a fixed
+    pool of worker threads for the slow bits (location lookup, diffing).
+
+    Each vessel is asked for every url in urls over its one connection, up
+    to depth at a time. Vessels start at different points in the list so
+    every url gets early results, and pages are recorded (and passed to
+    onresult, if given) in the order they complete.
+
+    At most maxvessels are talked to at once, and pages read but not yet
+    stored count against a byte budget. When either runs out we stop
+    accepting, and when the budget runs out we also stop reading new pages
+    (ones already started are finished so their memory can be freed) """
+
+    def __init__(self, lsock, urls, numworkers=POSTPROCESS_WORKERS,
+                 maxvessels=MAX_ACTIVE_VESSELS, budget=INFLIGHT_BYTE_BUDGET,
+                 depth=PIPELINE_DEPTH, onresult=None):
+
+        assert lsock and urls
+        assert numworkers > 0, "Need at least one post processing worker"
+        assert maxvessels > 0, "Need to allow at least one vessel"
+        assert depth > 0, "Need to allow at least one url in flight"
+
+        self.lsock = lsock
+        self.urls = _urllist(urls)
+        self.depth = depth
+        self.onresult = onresult
+        self.poller, self.timescale = _create_poller()
+
+        # fd -> vptsession
+        self.sessions = {}
+        # where in urls the next vessel starts
+        self.nextstart = 0
+
+        self.maxvessels = maxvessels
+        self.budget = bytebudget(budget)
+        self.stats = collectorstats()
+        self.accepting = True
+        # fds of sessions we have stopped reading from for the budget
+        self.held = set()
+
+        self.workqueue = Queue.Queue()
+        self.workers = []
+        for workercount in range(numworkers):
+            worker = threading.Thread(target=self._postprocess)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+
+    def run(self):
+        """ Loops until q is entered on stdin """
+
+        self.lsock.setblocking(0)
+        self.poller.register(self.lsock.fileno(), select.POLLIN)
+        self.poller.register(sys.stdin.fileno(), select.POLLIN)
+
+        print "Waiting for incoming connections...\nq to exit"
+        fin = 0
+        while not fin:
+            for fd, event in self.poller.poll(COLLECTOR_TICK * self.timescale):
+                if fd == sys.stdin.fileno():
+                    userstr = readall(sys.stdin)
+                    if 'q\n' in userstr:
+                        fin = 1
+                elif fd == self.lsock.fileno():
+                    self._accept()
+                else:
+                    self._service(fd, event)
+
+            self._check_timers()
+            self._update_flow()
+
+        self.shutdown()
+
+
+    def shutdown(self):
+        """ Drops unfinished vessels and waits for the workers to drain """
+
+        if self.accepting:
+            self.poller.unregister(self.lsock.fileno())
+        self.poller.unregister(sys.stdin.fileno())
+        for fd in self.sessions.keys():
+            self._drop(fd, "collector shutting down")
+
+        for worker in self.workers:
+            self.workqueue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+        self.stats.report(self.budget)
+
+
+    def _accept(self):
+        # the listening socket is non blocking so take everything queued
+        while len(self.sessions) < self.maxvessels:
+            try:
+                sockobj, addrinfo = self.lsock.accept()
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+
+            sockobj.setblocking(0)
+            conn = connection(addrinfo[0], addrinfo[1], sockobj)
+            urls = sweeporder(self.urls, self.nextstart)
+            self.nextstart += 1
+            self.sessions[sockobj.fileno()] = vptsession(conn, urls, self.budget, self.depth)
+            # vessels that speak the binary framing say HELLO first
+            self.poller.register(sockobj.fileno(), select.POLLIN)
+            print "connection to %s established" % (conn.ip)
+
+        self._update_flow()
+
+
+    def _service(self, fd, event):
+
+        session = self.sessions.get(fd)
+        if session is None:
+            return
+
+        try:
+            if event & select.POLLOUT and session.outbuf:
+                sent = session.conn.socket.send(session.outbuf)
+                session.outbuf = session.outbuf[sent:]
+                if not session.outbuf and session.outstanding:
+                    print "sent urls up to %s to %s" % (session.outstanding[-1], session.conn.ip)
+
+            if event & select.POLLIN:
+                if session.waitingforpage() and self.budget.exhausted():
+                    self._hold(fd)
+                    return
+                if session.recv():
+                    self._deliver(session)
+                    if session.finished():
+                        self._finish(fd)
+                        return
+
+            elif not event & select.POLLOUT and \
+                    event & (select.POLLERR | select.POLLHUP | select.POLLNVAL):
+                raise ViewpointException("Connection error")
+
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self._drop(fd, str(e))
+            return
+        except ViewpointException as e:
+            self._drop(fd, str(e))
+            return
+
+        session.lastactive = time.time()
+        self._rearm(fd, session)
+
+
+    def _rearm(self, fd, session):
+        # read unless held for the budget, write while we have something
+        mask = 0
+        if fd not in self.held:
+            mask = select.POLLIN
+        if session.outbuf:
+            mask |= select.POLLOUT
+        if mask != session.mask:
+            self.poller.modify(fd, mask)
+            session.mask = mask
+
+
+    def _deliver(self, session):
+        url, msgtype, body, charged = session.takepage()
+        if msgtype == VPT_MSG_ERROR:
+            self.budget.release(charged)
+            record_failure(url, session.conn.ip, session.conn.port, "vessel said: %s" % (body))
+            return
+
+        print "recieved %s byte page for %s from %s" % (len(body), url, session.conn.ip)
+        # the budget is given back once the page is in the store
+        self.stats.enqueue()
+        self.workqueue.put((time.time(), charged, (url, session.conn.ip, session.conn.port, body)))
+
+
+    def _finish(self, fd):
+        session = self.sessions.pop(fd)
+        self.poller.unregister(fd)
+        # a pipelining vessel is owed a BYE, if it doesn't fit in the
+        #  socket buffer the close will do
+        try:
+            if session.outbuf:
+                session.conn.socket.send(session.outbuf)
+        except socket.error:
+            None
+        session.conn.socket.close()
+        for url in session.skipped:
+            record_failure(url, session.conn.ip, session.conn.port, "vessel can only fetch one url")
+
+
+    def _drop(self, fd, reason):
+        session = self.sessions.pop(fd)
+        self.held.discard(fd)
+        self.poller.unregister(fd)
+        session.conn.socket.close()
+        self.budget.release(session.charged)
+        for url in list(session.outstanding) + list(session.todo) + session.skipped:
+            record_failure(url, session.conn.ip, session.conn.port, reason)
+
+
+    def _hold(self, fd):
+        # stop reading until the budget has room, see _update_flow
+        self.held.add(fd)
+        self._rearm(fd, self.sessions[fd])
+        self.stats.pause()
+
+
+    def _update_flow(self):
+        """ Pauses or resumes accepting and reading to match how many
+        vessels we have and what is left of the byte budget """
+
+        starved = self.budget.exhausted()
+        full = starved or len(self.sessions) >= self.maxvessels
+
+        if full and self.accepting:
+            self.poller.unregister(self.lsock.fileno())
+            self.accepting = False
+            self.stats.pause()
+        elif not full and not self.accepting:
+            self.poller.register(self.lsock.fileno(), select.POLLIN)
+            self.accepting = True
+
+        if not starved and self.held:
+            now = time.time()
+            held = self.held
+            self.held = set()
+            for fd in held:
+                self._rearm(fd, self.sessions[fd])
+                # being held isn't the vessel's fault
+                self.sessions[fd].lastactive = now
+
+        if self.accepting and not self.held:
+            self.stats.resume()
+
+
+    def _check_timers(self):
+        now = time.time()
+        for fd, session in self.sessions.items():
+            if fd in self.held:
+                continue
+            if session.negotiating and now - session.started > VPT_HELLO_WAIT:
+                session.textfallback()
+                self._rearm(fd, session)
+            elif now - session.lastactive > CONN_IDLE_TIMEOUT:
+                self._drop(fd, "Timed out")
+
+
+    def _postprocess(self):
+        # worker threads start here
+        while True:
+            batch = [self.workqueue.get()]
+            while batch[-1] is not None and len(batch) < LOCATE_BATCH:
+                try:
+                    batch.append(self.workqueue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            stopping = batch[-1] is None
+            if stopping:
+                batch.pop()
+
+            now = time.time()
+            for queuedat, charged, work in batch:
+                self.stats.dequeue(now - queuedat)
+
+            # warms the location cache for record_viewpoint
+            try:
+                getgeolocator().lookup_many([work[1] for queuedat, charged, work in batch])
+            except Exception as e:
+                print "Failed to look up vessel locations: %s" % (e)
+
+            for queuedat, charged, work in batch:
+                try:
+                    vpt = record_viewpoint(*work)
+                    if self.onresult is not None:
+                        self.onresult(vpt)
+                except Exception as e:
+                    print "Failed to process viewpoint for %s from %s: %s" % (work[0], work[1], e)
+                self.budget.release(charged)
+
+            if stopping:
+                return
+
+
+
 def usage():
-    print "Usage: <ip> <port> <url>"
+    print "Usage: <geniuser> <ip> <port> <url|@urlfile> ..."
 
 
 
@@ -335,14 +1439,20 @@ def main():
     geniuser = sys.argv[1]
     thisip = sys.argv[2]
     thisport = sys.argv[3]
-    urltoview = sys.argv[4]
+    urlstoview = readurls(sys.argv[4:])
+
+    # forks the diff processes, so before any of our threads exist
+    differ.startpool()
 
     repythread = threading.Thread(target=run_repy_clients, args=[geniuser, thisip, thisport])
     repythread.start()
 
     sock = setup_listener(thisip, thisport, MAX_LISTEN_QUEUE)
-    listenthread = threading.Thread(target=wait_for_conn, args=[sock, urltoview])
-    #wait_for_conn(sock, urltoview)
+    if EVENT_COLLECTOR:
+        collector(sock, urlstoview).run()
+    else:
+        listenthread = threading.Thread(target=wait_for_conn, args=[sock, urlstoview])
+        #wait_for_conn(sock, urltoview)
 
     
 
@@ -351,9 +1461,20 @@ def main():
     close_all_connections()
     # TODO: terminate repy thread!!
     
-    for vpt in vptlist:
-        print "view from %s at %s" % (str(vpt.location), vpt.ip)
-        print vpt.page
+    for url in urlstoview:
+        print "views of %s" % (url)
+        vpts = [vpt for vpt in vptlist if vpt.url == url]
+        for pagehash, vpts, changes in diff_viewpoints(vpts):
+            print "%s vessels saw page %s" % (len(vpts), pagehash)
+            for vpt in vpts:
+                print "view from %s at %s:%s" % (str(vpt.location), vpt.ip, vpt.port)
+            for tag, removed, added in changes:
+                print "%s: -%s +%s" % (tag, list(removed), list(added))
+
+    discard_viewpoints()
+    differ.close()
+    if geolocator is not None:
+        geolocator.close()
 
 
 if __name__ == "__main__":
@@ -13,9 +13,6 @@
    nonportable module.
 """
 
-# for sleep
-import time
-
 # needed for cpu, disk, and memory handling
 import nonportable
 
@@ -85,6 +82,68 @@ fungible_resource_lock_table = nanny_resource_limits.fungible_resource_lock_tabl
 renewable_resource_update_time = nanny_resource_limits.renewable_resource_update_time
 
 
+# tattle_quantity charges the consumption table for a batch of a renewable 
+# resource at a time.   The thread that paid then uses that credit without
+# the resource's lock until it runs out, when it pays for the next batch 
+# (and blocks if the resource is over its limit).   A batch is this fraction
+# of a second's worth of the resource.   Whatever a thread hasn't used when
+# it exits is given back by refund_exited_thread_credit().
+TATTLE_CREDIT_FRACTION = 0.01
+
+# The calling thread's credits, a dict of resource -> amount paid for but 
+# not used yet.   Use get_thread_credits() to get it.
+thread_credit = threading.local()
+
+# Every thread's credits as a list of (thread, credits), so that what exited
+# threads didn't use can be given back.   Protected by thread_credit_lock.
+thread_credit_registry = []
+thread_credit_lock = threading.Lock()
+
+
+
+# Returns the calling thread's credits
+def get_thread_credits():
+  try:
+    return thread_credit.credits
+  except AttributeError:
+    credits = {}
+    thread_credit.credits = credits
+
+    thread_credit_lock.acquire()
+    try:
+      thread_credit_registry.append((threading.currentThread(), credits))
+    finally:
+      thread_credit_lock.release()
+
+    return credits
+
+
+
+# Gives the credit that exited threads didn't use back to the consumption
+# table.   Repy runs every event in a new thread, so without this each short
+# lived thread would pay for a batch it never uses.   Must hold the 
+# resource's lock.
+def refund_exited_thread_credit(resource):
+  thread_credit_lock.acquire()
+  try:
+    stillregistered = []
+    for thread, credits in thread_credit_registry:
+      # The thread is gone, so nothing else will touch its credits
+      if not thread.isAlive() and resource in credits:
+        refund = credits.pop(resource)
+        if refund > resource_consumption_table[resource]:
+          resource_consumption_table[resource] = 0.0
+        else:
+          resource_consumption_table[resource] = resource_consumption_table[resource] - refund
+
+      if thread.isAlive() or credits:
+        stillregistered.append((thread, credits))
+
+    thread_credit_registry[:] = stillregistered
+  finally:
+    thread_credit_lock.release()
+
+
 # Updates the values in the consumption table (taking the current time into 
 # account)
 def update_resource_consumption_table(resource):
@@ -116,24 +175,104 @@ def update_resource_consumption_table(resource):
 
 
 
-# I want to wait until a resource can be used again...
-def sleep_until_resource_drains(resource):
+# Threads that have to wait for a renewable resource are woken by a single
+# timer thread, in the order they started waiting, and wait without holding
+# the resource's lock.   The timer only runs while something is waiting.
+# This condition protects the waiter lists and the flag below, and is 
+# notified when a waiter is added.
+resource_waiter_condition = threading.Condition()
+
+# resource -> list of [deadline, grantlock] in the order the threads blocked
+resource_waiters = {}
+
+# Is there a ResourceGrantTimer running?
+resource_timer_running = False
+
+
+
+# Works out when the resource will have drained enough for the calling thread
+# and puts it in line to be woken then.   Returns the lock to pass to 
+# wait_for_resource_grant(), or None if there's no need to wait.   Must hold 
+# the resource's lock (with the consumption table up to date).
+def schedule_resource_wait(resource):
+  global resource_timer_running
 
   # It'll never drain!
   if resource_restriction_table[resource] == 0:
     raise Exception, "Resource '"+resource+"' limit set to 0, won't drain!"
-    
 
-  # We may need to go through this multiple times because other threads may
-  # also block and consume resources.
-  while resource_consumption_table[resource] > resource_restriction_table[resource]:
+  overage = resource_consumption_table[resource] - resource_restriction_table[resource]
+  if overage <= 0:
+    return None
+
+  # Whatever the threads ahead of us consume is already in the table, so 
+  # this deadline is never before theirs
+  deadline = renewable_resource_update_time[resource] + overage / resource_restriction_table[resource]
+
+  # Released by the timer thread when it's our turn
+  grantlock = threading.Lock()
+  grantlock.acquire()
+
+  resource_waiter_condition.acquire()
+  try:
+    if resource not in resource_waiters:
+      resource_waiters[resource] = []
+    resource_waiters[resource].append([deadline, grantlock])
+
+    if resource_timer_running:
+      # It may be sleeping until a later deadline
+      resource_waiter_condition.notify()
+    else:
+      resource_timer_running = True
+      ResourceGrantTimer().start()
+  finally:
+    resource_waiter_condition.release()
 
-    # Sleep until we're expected to be under quota
-    sleeptime = (resource_consumption_table[resource] - resource_restriction_table[resource]) / resource_restriction_table[resource]
+  return grantlock
 
-    time.sleep(sleeptime)
 
-    update_resource_consumption_table(resource)
+
+# Blocks until the timer thread grants what schedule_resource_wait() lined up.
+# Must not hold the resource's lock.
+def wait_for_resource_grant(grantlock):
+  grantlock.acquire()
+
+
+
+# Wakes the threads waiting for renewable resources once their deadlines pass.
+# It exits when no one is waiting, because repy takes any extra thread as a
+# pending event and won't exit while it's around.
+class ResourceGrantTimer(threading.Thread):
+
+  def __init__(self):
+    threading.Thread.__init__(self, name="ResourceGrantTimer")
+
+
+  def run(self):
+    global resource_timer_running
+
+    resource_waiter_condition.acquire()
+    try:
+      while True:
+        thetime = nonportable.getruntime()
+
+        # Wake everyone whose turn has come, and find the next deadline
+        nextdeadline = None
+        for waiters in resource_waiters.values():
+          while waiters and waiters[0][0] <= thetime:
+            waiters.pop(0)[1].release()
+
+          if waiters and (nextdeadline is None or waiters[0][0] < nextdeadline):
+            nextdeadline = waiters[0][0]
+
+        if nextdeadline is None:
+          resource_timer_running = False
+          return
+
+        resource_waiter_condition.wait(nextdeadline - thetime)
+
+    finally:
+      resource_waiter_condition.release()
 
 
 
@@ -232,6 +371,15 @@ def tattle_quantity(resource, quantity):
     # enabled. -Brent
     tracebackrepy.handle_internalerror("Resource '" + resource + 
         "' has a negative quantity " + str(quantity) + "!", 132)
+
+  # If this thread has already paid for it, there's nothing else to do.   
+  # (Having credit also means we weren't over the limit when we last 
+  # checked, so a quantity of 0 needn't block.)
+  credits = get_thread_credits()
+  credit = credits.get(resource, 0.0)
+  if quantity <= credit and credit > 0:
+    credits[resource] = credit - quantity
+    return
     
   # get the lock for this resource
   renewable_resource_lock_table[resource].acquire()
@@ -248,15 +396,26 @@ def tattle_quantity(resource, quantity):
       # enabled. -Brent
       tracebackrepy.handle_internalerror("Resource '" + resource + 
           "' is not renewable!", 133)
+
+    refund_exited_thread_credit(resource)
   
 
-    resource_consumption_table[resource] = resource_consumption_table[resource] + quantity
-    # I'll block if I'm over...
-    sleep_until_resource_drains(resource)
+    # Pay for what the credit doesn't cover and for the next batch
+    batch = resource_restriction_table[resource] * TATTLE_CREDIT_FRACTION
+    resource_consumption_table[resource] = resource_consumption_table[resource] + quantity - credit + batch
+    credits[resource] = batch
+
+    # Get in line if I'm over...
+    grantlock = schedule_resource_wait(resource)
   
   finally:
     # release the lock for this resource
     renewable_resource_lock_table[resource].release()
+
+  # I'll block until it's my turn (without the lock, so other threads can 
+  # get in line behind me meanwhile)
+  if grantlock is not None:
+    wait_for_resource_grant(grantlock)
     
 
 
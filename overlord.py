@@ -159,6 +159,7 @@ import logging
 import os
 import os.path
 import sys
+import threading
 import time
 from datetime import datetime, timedelta
 
@@ -169,6 +170,129 @@ from datetime import datetime, timedelta
 import experimentlib as explib
 
 
+
+
+class DeploymentProgress:
+  """
+  <Purpose>
+    Keeps count of how a pipelined deployment is going. Each vessel passes
+    through the stages in Overlord.DEPLOY_STAGES, and for every stage we
+    track how many vessels are in it, how many got through it, how many
+    failed in it and the total time spent in it. Also records when the first
+    vessel was verified to be running and when the deployment finished.
+
+    All methods are thread safe.
+  """
+
+  def __init__(self, stages, vessel_count):
+    self.lock = threading.Lock()
+    self.vessel_count = vessel_count
+    self.start_time = time.time()
+    self.first_running_time = None
+    self.end_time = None
+
+    self.active = {}
+    self.succeeded = {}
+    self.failed = {}
+    self.stage_seconds = {}
+    for stage in stages:
+      self.active[stage] = 0
+      self.succeeded[stage] = 0
+      self.failed[stage] = 0
+      self.stage_seconds[stage] = 0.0
+
+
+
+  def stage_started(self, stage):
+    self.lock.acquire()
+    try:
+      self.active[stage] += 1
+    finally:
+      self.lock.release()
+
+
+
+  def stage_finished(self, stage, elapsed, success):
+    self.lock.acquire()
+    try:
+      self.active[stage] -= 1
+      self.stage_seconds[stage] += elapsed
+      if success:
+        self.succeeded[stage] += 1
+      else:
+        self.failed[stage] += 1
+    finally:
+      self.lock.release()
+
+
+
+  def vessel_running(self):
+    self.lock.acquire()
+    try:
+      if self.first_running_time is None:
+        self.first_running_time = time.time()
+    finally:
+      self.lock.release()
+
+
+
+  def finished(self):
+    self.end_time = time.time()
+
+
+
+  def time_to_first_running(self):
+    """
+    Seconds from the start of the deployment until a vessel was verified as
+    running, or None if none has been yet.
+    """
+    if self.first_running_time is None:
+      return None
+    return self.first_running_time - self.start_time
+
+
+
+  def total_time(self):
+    """
+    Seconds the deployment took, or has taken so far if it isn't finished.
+    """
+    if self.end_time is None:
+      return time.time() - self.start_time
+    return self.end_time - self.start_time
+
+
+
+  def summary(self, stages):
+    """
+    Returns a one line description of the deployment, suitable for logging.
+    """
+    self.lock.acquire()
+    try:
+      parts = []
+      for stage in stages:
+        done = self.succeeded[stage] + self.failed[stage]
+        average = 0.0
+        if done:
+          average = self.stage_seconds[stage] / done
+        parts.append(stage + ": " + str(self.succeeded[stage]) + " ok, " +
+                     str(self.failed[stage]) + " failed, " + str(self.active[stage]) +
+                     " active, %.2fs avg" % average)
+    finally:
+      self.lock.release()
+
+    first_running = self.time_to_first_running()
+    if first_running is None:
+      first_running = "never"
+    else:
+      first_running = "%.2fs" % first_running
+
+    return (str(self.vessel_count) + " vessels; " + "; ".join(parts) +
+            "; first running after " + first_running + ", total %.2fs" % self.total_time())
+
+
+
+
+
 class Overlord:
   
   # CONFIGURATION
@@ -183,6 +307,23 @@ class Overlord:
   # time to sleep before starting a new polling loop.
   VESSEL_POLLING_PERIOD = 15 * 60
 
+  # The number of nodes to query at once when polling vessel status. Each
+  # node is only contacted once per polling loop no matter how many of our
+  # vessels are on it.
+  STATUS_POLLING_THREADS = 20
+
+  # Pipelined deployment. Each vessel moves on to its next stage as soon as its
+  # previous one completes, rather than waiting for every other vessel. These
+  # are the number of vessels allowed in each stage at once.
+  DEPLOY_STAGES = ['upload', 'start', 'verify']
+  DEPLOY_UPLOAD_THREADS = 10
+  DEPLOY_START_THREADS = 20
+  DEPLOY_VERIFY_THREADS = 20
+
+  # How long to wait after starting a vessel before checking that it is still
+  # running, in seconds. This catches programs that die straight away.
+  DEPLOY_VERIFY_DELAY = 1
+
   # The minimum time between vessel renewals, in seconds. The time may be longer
   # in practice because of the time it takes to run through the polling loop.
   # Note: 86400 seconds = 1 day
@@ -485,18 +626,22 @@ class Overlord:
   
     # Clear the list of successful_handlers for a new operation
     self.successful_handlers = []
+
+    # Every vessel gets the same bytes, so only read them once
+    file_list = self._read_files(filename_list)
   
-    explib.run_parallelized(vessel_handlers, self._upload_to_vessels_helper, filename_list)
+    explib.run_parallelized(vessel_handlers, self._upload_to_vessels_helper, file_list)
 
     return self.successful_handlers
     
 
   # Helper function to upload_to_vessels in order to make use of Experiment
   # Library's run_parallelized()
-  def _upload_to_vessels_helper(self, vessel, filename_list):
-    for filename in filename_list:  
+  def _upload_to_vessels_helper(self, vessel, file_list):
+    for filename, filedata in file_list:  
       try:
-        explib.upload_file_to_vessel(vessel, self.config['identity'], filename)
+        explib.upload_data_to_vessel(vessel, self.config['identity'], filedata,
+                                     os.path.basename(filename))
       
       except explib.NodeCommunicationError:
         self.logger.error("Failed to upload '" + filename + "' to vessel " + self.vessel_location(vessel))
@@ -563,6 +708,183 @@ class Overlord:
 
 
 
+  def deploy_to_vessels(self, vessel_handlers, filename_list, program_filename, *vessel_args):
+    """
+    <Purpose>
+      Uploads a list of files to a set of vessels, starts a program on them
+      and checks that it is running. Unlike calling upload_to_vessels and then
+      run_on_vessels, each vessel is started as soon as its own upload is
+      done and checked as soon as it has started, so the first vessels are up
+      and running long before the slowest upload completes.
+
+      The files are read once and the same data is sent to every vessel. The
+      number of vessels in each stage at once is limited by the
+      DEPLOY_*_THREADS settings.
+
+    <Arguments>
+      vessel_handlers
+        A list of vesselhandles of vessels to deploy on.
+      filename_list
+        The filenames of the files to upload.
+      program_filename
+        The filename of the program to run.
+      *vessel_args
+        Optional additional arguments required by the program to be run on
+        vessels.
+
+    <Exceptions>
+      IOError
+        If one of the files can't be read.
+
+    <Side Effects>
+      Logger will make an entry for each vessel that fails a stage, and a
+      summary of the deployment at the end.
+      The progress of the deployment is kept in self.deploy_progress, a
+      DeploymentProgress, which may be inspected while it is running.
+
+    <Returns>
+      A list of vesselhandles of vessels that are running the program.
+    """
+    self.logger.info("Deploying '" + str(filename_list) + "' to " + str(len(vessel_handlers)) +
+                     " vessels, running '" + program_filename + "'")
+
+    file_list = self._read_files(filename_list)
+    vessel_args = [str(arg) for arg in list(vessel_args)]
+
+    # Only so many vessels may be in each stage at once
+    stage_limits = {
+      'upload': threading.BoundedSemaphore(self.DEPLOY_UPLOAD_THREADS),
+      'start': threading.BoundedSemaphore(self.DEPLOY_START_THREADS),
+      'verify': threading.BoundedSemaphore(self.DEPLOY_VERIFY_THREADS),
+      }
+
+    self.deploy_progress = DeploymentProgress(self.DEPLOY_STAGES, len(vessel_handlers))
+
+    # A vessel holds a thread for its whole trip through the pipeline, so
+    # have enough threads to keep every stage busy, plus enough for the
+    # vessels the start stage finishes during DEPLOY_VERIFY_DELAY to wait it out
+    num_threads = self.DEPLOY_UPLOAD_THREADS + self.DEPLOY_START_THREADS + self.DEPLOY_VERIFY_THREADS
+    if self.DEPLOY_VERIFY_DELAY:
+      num_threads += self.DEPLOY_START_THREADS
+
+    successlist, failurelist = explib.run_parallelized(vessel_handlers, self._deploy_to_vessel,
+                                                       file_list, program_filename, vessel_args,
+                                                       stage_limits, num_threads=num_threads)
+    self.deploy_progress.finished()
+
+    for vessel, errormsg in failurelist:
+      self.logger.error("Error deploying to vessel " + vessel + ": " + errormsg)
+
+    running_handlers = []
+    for vessel, running in successlist:
+      if running:
+        running_handlers.append(vessel)
+
+    self.logger.info("Deployment finished, " + self.deploy_progress.summary(self.DEPLOY_STAGES))
+
+    return running_handlers
+
+
+
+  # Takes one vessel through every stage of deploy_to_vessels(). Returns
+  # whether the vessel ended up running the program.
+  def _deploy_to_vessel(self, vessel, file_list, program_filename, vessel_args, stage_limits):
+    if not self._deploy_stage(vessel, 'upload', stage_limits, self._deploy_upload, file_list):
+      return False
+
+    if not self._deploy_stage(vessel, 'start', stage_limits, self._deploy_start,
+                              program_filename, vessel_args):
+      return False
+
+    # Give the program a chance to die before checking on it. This is done
+    # before taking a verify slot so that the slots are only held while
+    # talking to the node.
+    if self.DEPLOY_VERIFY_DELAY:
+      time.sleep(self.DEPLOY_VERIFY_DELAY)
+
+    if not self._deploy_stage(vessel, 'verify', stage_limits, self._deploy_verify, program_filename):
+      return False
+
+    self.deploy_progress.vessel_running()
+    return True
+
+
+
+  # Runs one stage for a vessel within that stage's concurrency limit,
+  # recording its progress
+  def _deploy_stage(self, vessel, stage, stage_limits, func, *args):
+    stage_limits[stage].acquire()
+    try:
+      self.deploy_progress.stage_started(stage)
+      start = time.time()
+      success = False
+      try:
+        success = func(vessel, *args)
+      finally:
+        self.deploy_progress.stage_finished(stage, time.time() - start, success)
+    finally:
+      stage_limits[stage].release()
+
+    return success
+
+
+
+  def _deploy_upload(self, vessel, file_list):
+    for filename, filedata in file_list:
+      try:
+        explib.upload_data_to_vessel(vessel, self.config['identity'], filedata,
+                                     os.path.basename(filename))
+      except explib.SeattleExperimentError:
+        self.logger.error("Failed to upload '" + filename + "' to vessel " + self.vessel_location(vessel))
+        return False
+
+    return True
+
+
+
+  def _deploy_start(self, vessel, program_filename, vessel_args):
+    try:
+      explib.start_vessel(vessel, self.config['identity'], program_filename, vessel_args)
+    except explib.SeattleExperimentError:
+      self.logger.error("Failed to start '" + program_filename + "' on vessel " + self.vessel_location(vessel))
+      return False
+
+    return True
+
+
+
+  def _deploy_verify(self, vessel, program_filename):
+    try:
+      status = explib.get_vessel_status(vessel, self.config['identity'])
+    except explib.SeattleExperimentError:
+      self.logger.error("Failed to get the status of vessel " + self.vessel_location(vessel))
+      return False
+
+    if status != explib.VESSEL_STATUS_STARTED:
+      self.logger.error("'" + program_filename + "' is not running on vessel " +
+                        self.vessel_location(vessel) + ", status is " + status)
+      return False
+
+    self.logger.debug("Verified '" + program_filename + "' is running on vessel " + self.vessel_location(vessel))
+    return True
+
+
+
+  # Returns a list of (filename, contents) for the given filenames
+  def _read_files(self, filename_list):
+    file_list = []
+    for filename in filename_list:
+      fileobj = open(filename, "r")
+      try:
+        file_list.append((filename, fileobj.read()))
+      finally:
+        fileobj.close()
+    return file_list
+
+
+
+
+
   def release_vessels(self, vessel_handlers):
     """
     <Purpose>
@@ -669,8 +991,9 @@ def default_acquire_vessels(overlord, vessel_handlers):
 # DEFAULT INITIATE VESSEL
 def default_initiate_vessels(overlord, fresh_handlers, vessel_handlers, *args):
 
-  successful_handlers = overlord.upload_to_vessels(fresh_handlers, [overlord.config['program_filename']])
-  successful_handlers = overlord.run_on_vessels(successful_handlers, overlord.config['program_filename'], *args)
+  # Vessels are started and checked as soon as their upload is done
+  successful_handlers = overlord.deploy_to_vessels(fresh_handlers, [overlord.config['program_filename']],
+                                                   overlord.config['program_filename'], *args)
       
       
   # Identify and release any failed vessels.
@@ -710,14 +1033,14 @@ def default_remove_vessels(overlord, vessel_handlers):
   # Remove any stopped vessels.
   stopped_vessels = []
   
+  # One query per node, with the nodes queried in parallel. Vessels whose
+  # status couldn't be determined are left out and count as stopped.
+  vessel_statuses = explib.get_vessel_statuses(vessel_handlers, overlord.config['identity'],
+                                               overlord.STATUS_POLLING_THREADS)
+
   for vessel in vessel_handlers:
-    try:
-      vessel_status = explib.get_vessel_status(vessel, overlord.config['identity'])
-    except:
+    if vessel_statuses.get(vessel) != explib.VESSEL_STATUS_STARTED:
       stopped_vessels.append(vessel)
-    else:
-      if vessel_status != explib.VESSEL_STATUS_STARTED:
-        stopped_vessels.append(vessel)
 
   if len(stopped_vessels) > 0:
     overlord.logger.info('Releasing ' + str(len(stopped_vessels)) + ' stopped vessels')
@@ -0,0 +1,211 @@
+""" Diffs viewpoint pages. Pages are split into tags and lines of text once
+per distinct page, identical pages are never diffed (they share a hash),
+and pairwise results are remembered so comparing thousands of viewpoints
+only costs one diff per distinct page version. Big batches of diffs are
+farmed out to a pool of processes, if one was started with startpool()
+before any other threads were.
+"""
+
+import re
+import difflib
+import threading
+import multiprocessing
+from collections import OrderedDict
+
+# how many tokenized pages and pairwise diffs to remember
+TOKEN_CACHE_SIZE = 256
+DIFF_CACHE_SIZE = 4096
+
+# don't bother starting processes for fewer diffs than this
+PARALLEL_MIN = 8
+
+# splits html into tags and the text between them
+TAG_RE = re.compile(r'(<[^>]*>)')
+
+
+
+class lrucache():
+    """ A dict that forgets the least recently used entries past maxsize """
+
+    def __init__(self, maxsize):
+        assert maxsize > 0, "Invalid cache size"
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            if key not in self.entries:
+                return default
+            value = self.entries.pop(key)
+            self.entries[key] = value
+            return value
+        finally:
+            self.lock.release()
+
+    def put(self, key, value):
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+
+def tokenize(page):
+    """ Breaks a page into a tuple of tags and stripped lines of text, so
+    a change is reported as the tag or line that changed """
+
+    tokens = []
+    for piece in TAG_RE.split(page):
+        if piece.startswith('<'):
+            tokens.append(piece)
+            continue
+        for line in piece.splitlines():
+            line = line.strip()
+            if line:
+                tokens.append(line)
+    return tuple(tokens)
+
+
+
+def difftokens(atokens, btokens):
+    """ Returns the differences between two token sequences as a list of
+    (tag, removed tokens, added tokens), tag being one of 'replace',
+    'delete' or 'insert'. Identical sequences give an empty list """
+
+    # versions of a page mostly differ in a region or two, so peel off the
+    #  common ends and only hand the middle to difflib
+    start = 0
+    limit = min(len(atokens), len(btokens))
+    while start < limit and atokens[start] == btokens[start]:
+        start += 1
+    aend = len(atokens)
+    bend = len(btokens)
+    while aend > start and bend > start and atokens[aend - 1] == btokens[bend - 1]:
+        aend -= 1
+        bend -= 1
+
+    matcher = difflib.SequenceMatcher(None, atokens[start:aend], btokens[start:bend])
+    changes = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != 'equal':
+            changes.append((tag, atokens[start + i1:start + i2], btokens[start + j1:start + j2]))
+    return changes
+
+
+
+def _diffworker(args):
+    # runs in a pool process, so it must be a plain module level function.
+    #  Takes a chunk of pages to diff against the same base so the base is
+    #  only pickled once per chunk
+    basetokens, tokenlist = args
+    return [difftokens(basetokens, tokens) for tokens in tokenlist]
+
+
+
+class diffengine():
+
+    def __init__(self, store, processes=None, tokencache=TOKEN_CACHE_SIZE,
+                 diffcache=DIFF_CACHE_SIZE):
+        """ store is the pagestore holding the pages we are asked about,
+        processes the size of the pool startpool() makes (defaults to the
+        number of cpus) """
+
+        self.store = store
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self.tokens = lrucache(tokencache)
+        self.diffs = lrucache(diffcache)
+
+        self.pool = None
+        self.pool_lock = threading.Lock()
+
+
+    def gettokens(self, pagehash):
+        tokens = self.tokens.get(pagehash)
+        if tokens is None:
+            tokens = tokenize(self.store.get(pagehash))
+            self.tokens.put(pagehash, tokens)
+        return tokens
+
+
+    def diff(self, ahash, bhash):
+        """ Returns the changes going from page ahash to page bhash """
+
+        if ahash == bhash:
+            return []
+
+        changes = self.diffs.get((ahash, bhash))
+        if changes is None:
+            changes = difftokens(self.gettokens(ahash), self.gettokens(bhash))
+            self.diffs.put((ahash, bhash), changes)
+        return changes
+
+
+    def diffagainst(self, basehash, pagehashes):
+        """ Diffs each distinct page in pagehashes against basehash, returns
+        a dict of pagehash: changes """
+
+        results = {}
+        todo = []
+        for pagehash in set(pagehashes):
+            if pagehash == basehash:
+                results[pagehash] = []
+                continue
+            changes = self.diffs.get((basehash, pagehash))
+            if changes is None:
+                todo.append(pagehash)
+            else:
+                results[pagehash] = changes
+
+        pool = self.pool
+        if len(todo) < PARALLEL_MIN or pool is None:
+            for pagehash in todo:
+                results[pagehash] = self.diff(basehash, pagehash)
+            return results
+
+        # one chunk per process, each carrying the base once
+        basetokens = self.gettokens(basehash)
+        chunks = [todo[i::self.processes] for i in range(self.processes)]
+        chunks = [chunk for chunk in chunks if chunk]
+        work = [(basetokens, [self.gettokens(pagehash) for pagehash in chunk]) for chunk in chunks]
+        for chunk, changelist in zip(chunks, pool.map(_diffworker, work, 1)):
+            for pagehash, changes in zip(chunk, changelist):
+                self.diffs.put((basehash, pagehash), changes)
+                results[pagehash] = changes
+
+        return results
+
+
+    def startpool(self):
+        """ Starts the processes big batches of diffs go to. The pool is
+        made by forking, so call this before starting any threads (one
+        holding a lock when we fork would leave it held in the children).
+        Without it every diff is done in this process """
+
+        self.pool_lock.acquire()
+        try:
+            if self.pool is None and self.processes > 1:
+                self.pool = multiprocessing.Pool(self.processes)
+        finally:
+            self.pool_lock.release()
+
+
+    def close(self):
+        self.pool_lock.acquire()
+        try:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+        finally:
+            self.pool_lock.release()
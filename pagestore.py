@@ -0,0 +1,212 @@
+""" Content addressed store for viewpoint pages. Hundreds of vessels often
+send back byte identical pages, so each distinct body is kept once, keyed
+by its hash, and viewpoints hold the hash instead of the page.
+
+Pages are reference counted. Unreferenced pages are kept as a cache until
+memory runs short, then they go first. Past that, if there is a spill
+directory, the least recently used referenced pages are written out to it
+and read back in when someone asks for them.
+"""
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+# bytes of page data to keep in memory before evicting
+DEFAULT_MAX_MEMORY = 256 * 1024 * 1024
+
+
+
+class PageStoreException(Exception):
+    """ """
+    None
+
+
+
+def hashpage(page):
+    return hashlib.sha1(page).hexdigest()
+
+
+
+class pagestore():
+
+    def __init__(self, maxmemory=DEFAULT_MAX_MEMORY, spilldir=None):
+
+        assert maxmemory >= 0, "Invalid memory limit"
+
+        self.maxmemory = maxmemory
+        self.spilldir = spilldir
+        if spilldir is not None and not os.path.isdir(spilldir):
+            os.makedirs(spilldir)
+
+        # hash -> page, least recently used first
+        self.inmemory = OrderedDict()
+        self.memoryused = 0
+
+        # hash -> number of viewpoints holding it, every page we know
+        #  about is in here (possibly with a count of 0)
+        self.refcounts = {}
+
+        # hashes whose page is (also) in the spill directory
+        self.ondisk = set()
+
+        self.lock = threading.Lock()
+
+
+    def add(self, page):
+        """ Stores page if we haven't seen it, takes a reference to it and
+        returns its hash """
+
+        pagehash = hashpage(page)
+
+        self.lock.acquire()
+        try:
+            if pagehash not in self.refcounts:
+                self.refcounts[pagehash] = 0
+            self.refcounts[pagehash] += 1
+
+            if pagehash in self.inmemory:
+                self._touch(pagehash)
+            elif pagehash not in self.ondisk:
+                self._keep(pagehash, page)
+                self._evict()
+        finally:
+            self.lock.release()
+
+        return pagehash
+
+
+    def addref(self, pagehash):
+        self.lock.acquire()
+        try:
+            if pagehash not in self.refcounts:
+                raise PageStoreException("Unknown page %s" % (pagehash))
+            self.refcounts[pagehash] += 1
+        finally:
+            self.lock.release()
+
+
+    def release(self, pagehash):
+        """ Drops a reference. An unreferenced page stays cached until
+        evicted if it is in memory, one that was spilled is removed """
+        self.lock.acquire()
+        try:
+            if not self.refcounts.get(pagehash):
+                raise PageStoreException("Page %s is not referenced" % (pagehash))
+            self.refcounts[pagehash] -= 1
+            if self.refcounts[pagehash] == 0:
+                # eviction only looks at what is in memory, so a page that
+                #  is only on disk would never be cleaned up
+                if pagehash not in self.inmemory:
+                    self._forget(pagehash)
+                else:
+                    self._evict()
+        finally:
+            self.lock.release()
+
+
+    def get(self, pagehash):
+        """ Returns the page with this hash, reading it back from the spill
+        directory if it was evicted """
+
+        self.lock.acquire()
+        try:
+            if pagehash in self.inmemory:
+                self._touch(pagehash)
+                return self.inmemory[pagehash]
+
+            if pagehash not in self.ondisk:
+                raise PageStoreException("Unknown page %s" % (pagehash))
+
+            spillfile = open(self._spillpath(pagehash), 'rb')
+            try:
+                page = spillfile.read()
+            finally:
+                spillfile.close()
+
+            self._keep(pagehash, page)
+            self._evict(keep=pagehash)
+            return page
+        finally:
+            self.lock.release()
+
+
+    def refcount(self, pagehash):
+        return self.refcounts.get(pagehash, 0)
+
+
+    def __contains__(self, pagehash):
+        return pagehash in self.refcounts
+
+
+    def __len__(self):
+        return len(self.refcounts)
+
+
+    def _spillpath(self, pagehash):
+        return os.path.join(self.spilldir, pagehash)
+
+
+    def _keep(self, pagehash, page):
+        self.inmemory[pagehash] = page
+        self.memoryused += len(page)
+
+
+    def _touch(self, pagehash):
+        # move to the most recently used end
+        self.inmemory[pagehash] = self.inmemory.pop(pagehash)
+
+
+    def _drop(self, pagehash):
+        self.memoryused -= len(self.inmemory.pop(pagehash))
+
+
+    def _forget(self, pagehash):
+        """ Removes every trace of an unreferenced page """
+        if pagehash in self.inmemory:
+            self._drop(pagehash)
+        if pagehash in self.ondisk:
+            self.ondisk.remove(pagehash)
+            try:
+                os.remove(self._spillpath(pagehash))
+            except OSError:
+                None
+        del self.refcounts[pagehash]
+
+
+    def _spill(self, pagehash):
+        if pagehash not in self.ondisk:
+            # write then rename so a crash never leaves half a page behind
+            tmppath = self._spillpath(pagehash) + '.tmp'
+            spillfile = open(tmppath, 'wb')
+            try:
+                spillfile.write(self.inmemory[pagehash])
+            finally:
+                spillfile.close()
+            os.rename(tmppath, self._spillpath(pagehash))
+            self.ondisk.add(pagehash)
+        self._drop(pagehash)
+
+
+    def _evict(self, keep=None):
+        """ Brings memory use under maxmemory. Must hold the lock """
+
+        if self.memoryused <= self.maxmemory:
+            return
+
+        # unreferenced pages go first, oldest first
+        for pagehash in self.inmemory.keys():
+            if self.memoryused <= self.maxmemory:
+                return
+            if self.refcounts[pagehash] == 0 and pagehash != keep:
+                self._forget(pagehash)
+
+        # then, if we can, referenced ones get written out
+        if self.spilldir is None:
+            return
+        for pagehash in self.inmemory.keys():
+            if self.memoryused <= self.maxmemory:
+                return
+            if pagehash != keep:
+                self._spill(pagehash)
@@ -47,25 +47,234 @@ class ParallelizeError(Exception):
 
 # This has information about all of the different parallel functions.
 # The keys are unique integers and the entries look like this:
-# {'abort':False, 'callfunc':callfunc, 'callargs':callargs,
-# 'targetlist':targetlist, 'availabletargetpositions':positionlist,
-# 'runninglist':runninglist, 'result':result}
+# {'abort':False, 'closed':False, 'callfunc':callfunc, 'callargs':callargs,
+# 'targetlist':targetlist, 'nexttarget':0, 'runninglist':runninglist,
+# 'completed':completed, ...}
 #
 # abort is used to determine if future events should be aborted.
+# closed is set once the handle has been closed, which also stops the events.
 # callfunc is the function to call
 # callargs are extra arguments to pass to the function
-# targetlist is the list of items to call the function with
+# targetlist is the list of items to call the function with.   It is never
+#    modified, workers take the item at nexttarget and move it along.
 # runninglist is used to track which events are executing
-# result is a dictionary that contains information about completed function.
-#    The format of result is:
-#      {'exception':list of tuples with (target, exception string), 
-#       'aborted':list of targets,
-#       'returned':list of tuples with (target, return value)}
+# completed is a list of (resulttype, target, value) in the order they 
+#    finished, resulttype being 'returned' (value is the return value), 
+#    'exception' (value is the exception string) or 'aborted' (value is None).
+#    This is the only record of the results, parallelize_getresults sorts it
+#    into the format it has always returned.
+# waiters is a list of locks held by callers waiting for something to change
+# statelock protects nexttarget, completed, runninglist and waiters.   It is
+#    held just long enough to take a target or add a result.
+#
+# For scaling, there is also:
+# maxevents is how many events we may grow to (None to never grow)
+# itemtimeout is how long a single call may take (None to let it run)
+# latency is a moving average of how long calls take
+# baselatency is what latency was before we added any workers
+# nextworkerid is the id to give the next worker we add
 # 
 parallelize_info_dict = {}
 
 
 
+
+# Wakes up everyone waiting on this handle.   The caller must hold the
+# handle's statelock.
+def _parallelize_notify(handleinfo):
+  for waitlock in handleinfo['waiters']:
+    _parallelize_wakeup(waitlock)
+  handleinfo['waiters'] = []
+
+
+
+def _parallelize_wakeup(waitlock):
+  # A waiter may be woken by both a result and its timer, only the first
+  # release matters
+  try:
+    waitlock.release()
+  except Exception:
+    pass
+
+
+
+# Blocks until more than seen results have completed, every worker is done
+# or the handle is closed, or until timeout seconds (None to wait forever)
+# have passed.   Doesn't poll, the workers wake us up.
+def _parallelize_waitforchange(handleinfo, seen, timeout):
+  if timeout is not None:
+    deadline = getruntime() + timeout
+
+  while True:
+    waitlock = getlock()
+    waitlock.acquire(True)
+
+    handleinfo['statelock'].acquire(True)
+    try:
+      if len(handleinfo['completed']) > seen or not handleinfo['runninglist'] or handleinfo['closed']:
+        return
+      if timeout is not None and getruntime() >= deadline:
+        return
+      handleinfo['waiters'].append(waitlock)
+    finally:
+      handleinfo['statelock'].release()
+
+    timerhandle = None
+    if timeout is not None:
+      try:
+        timerhandle = settimer(max(deadline - getruntime(), 0), _parallelize_wakeup, (waitlock,))
+      except Exception:
+        # Out of events.   We can still return once the state changes, but
+        # a short nap is the best we can do for the timeout.
+        sleep(min(max(deadline - getruntime(), 0), 0.1))
+        _parallelize_wakeup(waitlock)
+
+    # This blocks until a worker (or the timer) releases the lock
+    waitlock.acquire(True)
+
+    if timerhandle is not None:
+      canceltimer(timerhandle)
+
+    handleinfo['statelock'].acquire(True)
+    try:
+      if waitlock in handleinfo['waiters']:
+        handleinfo['waiters'].remove(waitlock)
+    finally:
+      handleinfo['statelock'].release()
+
+
+
+# Records a target as finished and wakes up anyone waiting for it
+def _parallelize_recordresult(handleinfo, resulttype, target, value):
+  handleinfo['statelock'].acquire(True)
+  try:
+    handleinfo['completed'].append((resulttype, target, value))
+    _parallelize_notify(handleinfo)
+  finally:
+    handleinfo['statelock'].release()
+
+
+
+# Takes the next target off the work queue.   Returns (True, target), or 
+# (False, None) once there are none left.
+def _parallelize_nexttarget(handleinfo):
+  handleinfo['statelock'].acquire(True)
+  try:
+    position = handleinfo['nexttarget']
+    if position >= len(handleinfo['targetlist']):
+      return (False, None)
+    handleinfo['nexttarget'] = position + 1
+    return (True, handleinfo['targetlist'][position])
+  finally:
+    handleinfo['statelock'].release()
+
+
+
+# Calls the user's function on target, returning (resulttype, value)
+def _parallelize_call(handleinfo, target):
+  try:
+    retvalue = handleinfo['callfunc'](target, *handleinfo['callargs'])
+  except Exception, e:
+    # always log on error.   We need to report what happened
+    return ('exception', str(e))
+  else:
+    return ('returned', retvalue)
+
+
+
+# Runs in its own event for calls with a timeout.   outcome is filled in 
+# and donelock released when the call returns.
+def _parallelize_timedcallevent(handleinfo, target, outcome, donelock):
+  outcome.append(_parallelize_call(handleinfo, target))
+  _parallelize_wakeup(donelock)
+
+
+
+# Calls the user's function on target, giving up on it after the handle's 
+# itemtimeout.   We can't stop a call part way through, so one that times 
+# out keeps running in its own event and its result is thrown away.
+def _parallelize_timedcall(handleinfo, target):
+  outcome = []
+  donelock = getlock()
+  donelock.acquire(True)
+
+  try:
+    settimer(0.0, _parallelize_timedcallevent, (handleinfo, target, outcome, donelock))
+  except Exception:
+    # Out of events, so just make the call ourselves
+    return _parallelize_call(handleinfo, target)
+
+  try:
+    timerhandle = settimer(handleinfo['itemtimeout'], _parallelize_wakeup, (donelock,))
+  except Exception:
+    timerhandle = None
+
+  donelock.acquire(True)
+
+  if timerhandle is not None:
+    canceltimer(timerhandle)
+
+  if outcome:
+    return outcome[0]
+  return ('exception', 'Timed out after '+str(handleinfo['itemtimeout'])+' seconds')
+
+
+
+# How slow (in seconds) calls must be on average before we'll add workers.
+# Quicker calls are limited by the CPU, not by waiting, so more workers 
+# won't help.
+parallelize_scale_min_latency = 0.1
+
+# We stop adding workers once calls are taking this many times longer than
+# they were before we added any.   By then whatever the calls are waiting on
+# is being swamped.
+parallelize_scale_backoff = 1.5
+
+# Weight given to the latest call in the moving average of call latency
+parallelize_latency_weight = 0.2
+
+
+
+# Adds latency to the moving average, and adds a worker if the calls are 
+# slow, there is work for it, we haven't hit maxevents, and the workers we 
+# have added so far haven't made calls much slower.
+def _parallelize_scale(handleinfo, latency):
+  handleinfo['statelock'].acquire(True)
+  try:
+    if handleinfo['latency'] is None:
+      handleinfo['latency'] = latency
+    else:
+      handleinfo['latency'] = handleinfo['latency'] * (1 - parallelize_latency_weight) + \
+          latency * parallelize_latency_weight
+
+    if handleinfo['maxevents'] is None or handleinfo['abort'] or handleinfo['closed']:
+      return
+    if len(handleinfo['runninglist']) >= handleinfo['maxevents']:
+      return
+    if len(handleinfo['targetlist']) - handleinfo['nexttarget'] <= len(handleinfo['runninglist']):
+      return
+    if handleinfo['latency'] < parallelize_scale_min_latency:
+      return
+    if handleinfo['baselatency'] is not None and \
+        handleinfo['latency'] > handleinfo['baselatency'] * parallelize_scale_backoff:
+      return
+
+    workerid = handleinfo['nextworkerid']
+    handleinfo['runninglist'].append(workerid)
+    try:
+      settimer(0.0, parallelize_execute_function, (handleinfo['handle'], workerid))
+    except Exception:
+      # out of events, we'll make do with what we have
+      handleinfo['runninglist'].remove(workerid)
+      return
+    handleinfo['nextworkerid'] = workerid + 1
+    if handleinfo['baselatency'] is None:
+      handleinfo['baselatency'] = handleinfo['latency']
+  finally:
+    handleinfo['statelock'].release()
+
+
+
 def parallelize_closefunction(parallelizehandle):
   """
    <Purpose>
@@ -90,11 +299,20 @@ def parallelize_closefunction(parallelizehandle):
   # There is no sense trying to check then delete, since there may be a race 
   # with multiple calls to this function.
   try:
+    handleinfo = parallelize_info_dict[parallelizehandle]
     del parallelize_info_dict[parallelizehandle]
   except KeyError:
     return False
-  else:
-    return True
+
+  # Don't leave anyone waiting on a handle that is gone
+  handleinfo['statelock'].acquire(True)
+  try:
+    handleinfo['closed'] = True
+    _parallelize_notify(handleinfo)
+  finally:
+    handleinfo['statelock'].release()
+
+  return True
 
     
 
@@ -167,6 +385,123 @@ def parallelize_isfunctionfinished(parallelizehandle):
 
 
 
+def parallelize_wait(parallelizehandle, timeout=None):
+  """
+   <Purpose>
+      Wait for a function to finish.   Unlike calling 
+      parallelize_isfunctionfinished in a loop, this returns as soon as the 
+      last event finishes.
+
+   <Arguments>
+      parallelizehandle:
+         The handle returned by parallelize_initfunction
+
+      timeout:
+         The most seconds to wait, or None (the default) to wait until the
+         function has finished.
+          
+
+   <Exceptions>
+      ParallelizeError is raised if the handle is unrecognized
+
+   <Side Effects>
+      May use an event for the timeout.
+
+   <Returns>
+      True if the function has finished, False if it is still has events 
+      running (the timeout expired, or the handle was closed while waiting)
+  """
+
+  try:
+    handleinfo = parallelize_info_dict[parallelizehandle]
+  except KeyError:
+    raise ParallelizeError("Cannot wait for the parallel execution of a non-existent handle:"+str(parallelizehandle))
+
+  if timeout is not None:
+    deadline = getruntime() + timeout
+
+  # Each wakeup is a result coming in, so keep waiting until none are left
+  while True:
+    handleinfo['statelock'].acquire(True)
+    try:
+      if not handleinfo['runninglist']:
+        return True
+      if handleinfo['closed']:
+        return False
+      seen = len(handleinfo['completed'])
+    finally:
+      handleinfo['statelock'].release()
+
+    if timeout is None:
+      _parallelize_waitforchange(handleinfo, seen, None)
+    else:
+      remaining = deadline - getruntime()
+      if remaining <= 0:
+        return False
+      _parallelize_waitforchange(handleinfo, seen, remaining)
+
+
+
+
+
+def parallelize_getnewresults(parallelizehandle, seen, timeout=None):
+  """
+   <Purpose>
+      Get results as they complete.   Returns the results that came in after 
+      the first seen results, waiting for at least one if there aren't any 
+      yet.   To handle every result as soon as it is available:
+
+        seen = 0
+        while True:
+          newresults = parallelize_getnewresults(handle, seen)
+          if not newresults:
+            break
+          seen = seen + len(newresults)
+          for resulttype, target, value in newresults:
+            ...
+
+   <Arguments>
+      parallelizehandle:
+         The handle returned by parallelize_initfunction
+
+      seen:
+         The number of results the caller has already been given.
+
+      timeout:
+         The most seconds to wait for a new result, or None (the default) to 
+         wait as long as the function is running.
+          
+   <Exceptions>
+      ParallelizeError is raised if the handle is unrecognized
+
+   <Side Effects>
+      May use an event for the timeout.
+
+   <Returns>
+      A list of (resulttype, target, value) in the order they completed, where
+      resulttype is 'returned' (value is the return value), 'exception' 
+      (value is the exception string) or 'aborted' (value is None).   An 
+      empty list means the function has finished and every result has been 
+      handed out, or the timeout expired.
+  """
+
+  try:
+    handleinfo = parallelize_info_dict[parallelizehandle]
+  except KeyError:
+    raise ParallelizeError("Cannot get results for the parallel execution of a non-existent handle:"+str(parallelizehandle))
+
+  _parallelize_waitforchange(handleinfo, seen, timeout)
+
+  handleinfo['statelock'].acquire(True)
+  try:
+    return handleinfo['completed'][seen:]
+  finally:
+    handleinfo['statelock'].release()
+
+
+
+
+
 def parallelize_getresults(parallelizehandle):
   """
    <Purpose>
@@ -191,12 +526,26 @@ def parallelize_getresults(parallelizehandle):
 
   
   try:
-    # I copy so that the user doesn't have to deal with the fact I may still
-    # be modifying it
-    return parallelize_info_dict[parallelizehandle]['result'].copy()
+    handleinfo = parallelize_info_dict[parallelizehandle]
   except KeyError:
     raise ParallelizeError("Cannot get results for the parallel execution of a non-existent handle:"+str(parallelizehandle))
 
+  # I copy so that the user doesn't have to deal with the fact I may still
+  # be modifying it
+  handleinfo['statelock'].acquire(True)
+  try:
+    completed = handleinfo['completed'][:]
+  finally:
+    handleinfo['statelock'].release()
+
+  result = {'exception':[],'returned':[],'aborted':[]}
+  for resulttype, target, value in completed:
+    if resulttype == 'aborted':
+      result['aborted'].append(target)
+    else:
+      result[resulttype].append((target, value))
+  return result
+
 
 
       
@@ -241,36 +590,97 @@ def parallelize_initfunction(targetlist, callerfunc,concurrentevents=5, *extrafu
       A handle used for status information, etc.
   """
 
+  return parallelize_initfunction_adaptive(targetlist, callerfunc, concurrentevents, 
+      None, None, extrafuncargs)
+
+
+
+
+
+def parallelize_initfunction_adaptive(targetlist, callerfunc, concurrentevents=5, 
+    maxevents=None, itemtimeout=None, extrafuncargs=()):
+  """
+   <Purpose>
+      Call a function with each argument in a list in parallel, like 
+      parallelize_initfunction, optionally adding events while the calls 
+      are slow and giving up on calls that take too long.
+
+   <Arguments>
+      targetlist, callerfunc, concurrentevents:
+          As for parallelize_initfunction.
+
+      maxevents:
+          The most events to grow to (default None, never grow).   Events 
+          are added one at a time while calls take at least 
+          parallelize_scale_min_latency seconds on average and adding them 
+          hasn't made calls noticeably slower.
+
+      itemtimeout:
+          The most seconds one call may take (default None, no limit).   A 
+          call that takes longer is reported as an exception and its worker
+          moves on.   The call itself can't be stopped, so it keeps an event
+          busy until it returns.   Each call uses an extra event when this 
+          is set.
+
+      extrafuncargs:
+          A tuple of extra arguments the function should be called with.
+
+   <Exceptions>
+      As for parallelize_initfunction.
+
+   <Side Effects>
+      Starts events, etc.
+
+   <Returns>
+      A handle used for status information, etc.
+  """
+
   parallelizehandle = uniqueid_getid()
 
   # set up the dict locally one line at a time to avoid a ginormous line
   handleinfo = {}
+  handleinfo['handle'] = parallelizehandle
   handleinfo['abort'] = False
+  handleinfo['closed'] = False
   handleinfo['callfunc'] = callerfunc
-  handleinfo['callargs'] = extrafuncargs
-  # make a copy of target list because 
+  handleinfo['callargs'] = tuple(extrafuncargs)
+  # make a copy of target list because the caller may change theirs
   handleinfo['targetlist'] = targetlist[:]
-  handleinfo['availabletargetpositions'] = range(len(handleinfo['targetlist']))
-  handleinfo['result'] = {'exception':[],'returned':[],'aborted':[]}
+  handleinfo['nexttarget'] = 0
   handleinfo['runninglist'] = []
+  handleinfo['completed'] = []
+  handleinfo['waiters'] = []
+  handleinfo['statelock'] = getlock()
+  handleinfo['maxevents'] = maxevents
+  handleinfo['itemtimeout'] = itemtimeout
+  handleinfo['latency'] = None
+  handleinfo['baselatency'] = None
 
   
   parallelize_info_dict[parallelizehandle] = handleinfo
 
   # don't start more threads than there are targets (duh!)
   threads_to_start = min(concurrentevents, len(handleinfo['targetlist']))
+  handleinfo['nextworkerid'] = threads_to_start
 
   for workercount in range(threads_to_start):
     # we need to append the workercount here because we can't return until 
     # this is scheduled without having race conditions
-    parallelize_info_dict[parallelizehandle]['runninglist'].append(workercount)
+    handleinfo['statelock'].acquire(True)
+    handleinfo['runninglist'].append(workercount)
+    handleinfo['statelock'].release()
     try:
       settimer(0.0, parallelize_execute_function, (parallelizehandle,workercount))
     except:
       # If I'm out of resources, stop
       # remove this worker (they didn't start)
-      parallelize_info_dict[parallelizehandle]['runninglist'].remove(workercount)
-      if not parallelize_info_dict[parallelizehandle]['runninglist']:
+      handleinfo['statelock'].acquire(True)
+      try:
+        handleinfo['runninglist'].remove(workercount)
+        noworkers = not handleinfo['runninglist']
+      finally:
+        handleinfo['statelock'].release()
+      if noworkers:
         parallelize_closefunction(parallelizehandle)
         raise Exception, "No events available!"
       break
@@ -282,56 +692,53 @@ def parallelize_initfunction(targetlist, callerfunc,concurrentevents=5, *extrafu
 def parallelize_execute_function(handle, myid):
   # This is internal only.   It's used to execute the user function...
 
+  # We only look the handle up once, after that closing it is noticed 
+  # through the closed flag
+  try:
+    handleinfo = parallelize_info_dict[handle]
+  except KeyError:
+    return
+
   # No matter what, an exception in me should not propagate up!   Otherwise,
   # we might result in the program's termination!
   try:
 
-    while True:
-      # separate this from below functionality to minimize scope of try block
-      thetargetlist = parallelize_info_dict[handle]['targetlist']
-      try:
-        mytarget = thetargetlist.pop()
-      except IndexError:
+    while not handleinfo['closed']:
+      gotone, mytarget = _parallelize_nexttarget(handleinfo)
+      if not gotone:
         # all items are gone, let's return
         return
 
       # if they want us to abort, put this in the aborted list
-      if parallelize_info_dict[handle]['abort']:
-        parallelize_info_dict[handle]['result']['aborted'].append(mytarget)
-
+      if handleinfo['abort']:
+        _parallelize_recordresult(handleinfo, 'aborted', mytarget, None)
+        continue
+
+      # otherwise process this normally
+      starttime = getruntime()
+      if handleinfo['itemtimeout'] is None:
+        resulttype, value = _parallelize_call(handleinfo, mytarget)
       else:
-        # otherwise process this normally
+        resulttype, value = _parallelize_timedcall(handleinfo, mytarget)
+      _parallelize_recordresult(handleinfo, resulttype, mytarget, value)
 
-        # limit the scope of the below try block...
-        callfunc = parallelize_info_dict[handle]['callfunc']
-        callargs = parallelize_info_dict[handle]['callargs']
-
-        try:
-          retvalue = callfunc(mytarget,*callargs)
-        except Exception, e:
-          # always log on error.   We need to report what happened
-          parallelize_info_dict[handle]['result']['exception'].append((mytarget,str(e)))
-        else:
-          # success, add it to the dict...
-          parallelize_info_dict[handle]['result']['returned'].append((mytarget,retvalue))
-
-
-  except KeyError:
-    # A KeyError is normal if they've closed the handle
-    return
+      _parallelize_scale(handleinfo, getruntime() - starttime)
 
   except Exception, e:
     print 'Internal Error: Exception in parallelize_execute_function',e
 
   finally:
     # remove my entry from the list of running worker threads...
+    handleinfo['statelock'].acquire(True)
     try:
-      parallelize_info_dict[handle]['runninglist'].remove(myid)
-    except (ValueError, KeyError):
-      pass
-    
-
-    
-
+      try:
+        handleinfo['runninglist'].remove(myid)
+      except ValueError:
+        pass
+      # the last one out wakes up anyone waiting for the function to finish
+      if not handleinfo['runninglist']:
+        _parallelize_notify(handleinfo)
+    finally:
+      handleinfo['statelock'].release()
 
 ### Automatically generated by repyhelper.py ### /home/stredger/Documents/vpts/viewpoints/parallelize.repy
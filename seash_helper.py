@@ -213,8 +213,7 @@ def contact_targets(targetlist, func,*args):
   
   phandle = parallelize_initfunction(targetlist, func, MAX_CONTACT_WORKER_THREAD_COUNT, *args)
 
-  while not parallelize_isfunctionfinished(phandle):
-    sleep(.1)
+  parallelize_wait(phandle)
   
   # I'm going to change the format slightly...
   resultdict = parallelize_getresults(phandle)
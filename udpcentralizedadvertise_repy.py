@@ -142,6 +142,51 @@ def _udpcentralizedadvertise_communicate(datastringtosend, timeout, queryid):
 
 
 
+# Like _udpcentralizedadvertise_communicate, but sends many requests at once
+# from the same port.   pendingrequests maps each query id to the request 
+# to send.   Returns a dict of query id -> response for the queries answered 
+# within timeout.
+def _udpcentralizedadvertise_communicate_many(pendingrequests, timeout):
+  if mycontext['udprequestport'] == 0 or mycontext['udprequestport'] is None:
+    mycontext['udprequestport'] = _getusableport()
+
+  udprequestport = mycontext['udprequestport']
+
+  starttime = getruntime()
+  responses = {}
+
+  # The response socket stays open until every query is answered, rather
+  # than closing after the first response like _listenformessage.
+  udpresponsesocket = recvmess(getmyip(), udprequestport, _listenformessages)
+
+  try:
+    for queryid in pendingrequests:
+      sendmess(udpservername, udpserverport, pendingrequests[queryid], getmyip(), udprequestport)
+
+    while getruntime() < starttime + timeout:
+
+      for entry in mycontext['advertise_response'][:]:
+        entryid = entry[len(entry) - 1]
+        if entryid in pendingrequests:
+          mycontext['advertise_response'].remove(entry)
+          responses[entryid] = entry
+        elif entryid in failed_querylist:
+          # a late answer to a query that was given up on
+          mycontext['advertise_response'].remove(entry)
+
+      if len(responses) == len(pendingrequests):
+        break
+
+      sleep(0.01) # Strongly recommend NOT to set this any higher.
+
+    return responses
+
+  finally:
+    stopcomm(udpresponsesocket)
+
+
+
+
 # This is our roundabout solution for a UDP callback.
 # Could crash. Probably should if something bad happens.
 def _listenformessage(remoteIP, remoteport, message, commhandle):
@@ -153,6 +198,19 @@ def _listenformessage(remoteIP, remoteport, message, commhandle):
 
 
 
+# The callback for _udpcentralizedadvertise_communicate_many, which leaves
+# the socket open for the responses still to come.
+def _listenformessages(remoteIP, remoteport, message, commhandle):
+  try:
+    mycontext['advertise_response'].append(serialize_deserializedata(message))
+  except ValueError:
+    # Not something the server sent us
+    pass
+  return
+
+
+
+
 # A dummy function for getusableport.
 def _dummy_function(remoteIP, remoteport, message, commhandle):
   return
@@ -248,6 +306,76 @@ def udpcentralizedadvertise_announce(key, value, ttlval):
 
 
 
+def udpcentralizedadvertise_announce_many(entrylist):
+  """
+   <Purpose>
+     Announce many key / value pairs into the CHT.   All of the requests go
+     out together from one port, and only the unanswered ones are resent.
+
+   <Arguments>
+     entrylist: a list of (key, value, ttlval) tuples, each as for
+                udpcentralizedadvertise_announce.
+
+   <Exceptions>
+     TypeError if a ttlval is of the wrong type.
+
+     ValueError if a ttlval is not positive 
+
+     Various network exceptions are raised by udp messages
+
+   <Side Effects>
+     The CHT will store the key / value pairs.
+
+   <Returns>
+     A list with an entry for each in entrylist, None if it was stored, or
+     the exception that stopped it (as udpcentralizedadvertise_announce would 
+     have raised).
+  """
+  # check everything before sending anything
+  pendingrequests = {}
+  requestindex = {}
+  for key, value, ttlval in entrylist:
+    key = str(key)
+    value = str(value)
+
+    if not type(ttlval) is int and not type(ttlval) is long:
+      raise TypeError("Invalid type '"+str(type(ttlval))+"' for ttlval.")
+
+    if ttlval < 1:
+      raise ValueError("The argument ttlval must be positive, not '"+str(ttlval)+"'")
+
+    unique_request_id = uniqueid_getid()
+    pendingrequests[unique_request_id] = serialize_serializedata(('PUT',key,value,ttlval, unique_request_id))
+    requestindex[unique_request_id] = len(requestindex)
+
+  resultlist = [None] * len(entrylist)
+
+  # We'll loop through and resend what wasn't answered, increasing the 
+  # timeout each time
+  for thistimeout in udpcentralizedservertimeouts:
+    if not pendingrequests:
+      break
+
+    responses = _udpcentralizedadvertise_communicate_many(pendingrequests, thistimeout)
+
+    for unique_request_id in responses:
+      del pendingrequests[unique_request_id]
+      response = responses[unique_request_id]
+
+      if type(response) is not tuple or len(response) != 2 or type(response[0]) is not str:
+        resultlist[requestindex[unique_request_id]] = UDPCentralAdvertiseError("UDP Centralized announce received invalid response '"+str(response)+"'")
+      elif response[0] != 'OK':
+        resultlist[requestindex[unique_request_id]] = UDPCentralAdvertiseError("UDP Centralized announce failed with '"+response[0]+"'")
+
+  # fell through all of the timeout values...
+  for unique_request_id in pendingrequests:
+    failed_querylist.append(unique_request_id)
+    resultlist[requestindex[unique_request_id]] = UDPCentralAdvertiseError("UDP Centralized announce timed out!")
+
+  return resultlist
+
+
+
 def udpcentralizedadvertise_lookup(key, maxvals=100):
   """
    <Purpose>